@@ -0,0 +1,216 @@
+"""
+Journal of the callbacks of the data servers, accepted without being processed.
+
+Each accepted callback is appended to the journal of its job, in a directory of the working directory
+of the dispatcher, shared by the worker processes. A background coalescer takes the journals periodically,
+and processes only the latest callback of each job: a single monitor update and notification decision
+for a burst of progress callbacks, the previous ones being superseded.
+
+The callbacks completing a job (done, failed) are not journaled, they supersede the pending ones of their job.
+The processing of the callbacks of a job is serialized across the worker processes by a lock file in the journal
+directory, so that a pending callback taken by a process is not processed after the one completing the job.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import threading
+import contextlib
+import typing
+
+from .lock_manager import LockManager, LockTimeout
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('call_back_journal')
+
+default_journal_dir_name = '.call_back_journal'
+final_call_back_actions = ['done', 'failed']
+
+journal_suffix = '.jsonl'
+taken_suffix = '.taken'
+
+_key_pattern = re.compile(r'^[A-Za-z0-9]+$')
+
+# the processing of a callback (monitor update, notifications) can take a while
+job_lock_timeout_s = 600
+
+
+def is_final_call_back(call_back_values) -> bool:
+    return call_back_values.get('action') in final_call_back_actions
+
+
+class CallBackJournal:
+    def __init__(self, journal_dir=None):
+        if journal_dir is None:
+            journal_dir = default_journal_dir_name
+        self.journal_dir = os.path.abspath(journal_dir)
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+    @staticmethod
+    def get_key(call_back_values) -> typing.Optional[str]:
+        """
+        returns the key of the journal of the job of the callback, None if the callback can not be journaled
+        """
+        session_id = call_back_values.get('session_id')
+        job_id = call_back_values.get('job_id')
+        if not isinstance(session_id, str) or not isinstance(job_id, str) or \
+                _key_pattern.match(session_id) is None or _key_pattern.match(job_id) is None:
+            return None
+        return f"{session_id}_{job_id}"
+
+    def journal_path(self, key):
+        return os.path.join(self.journal_dir, key + journal_suffix)
+
+    def append(self, call_back_values) -> bool:
+        key = self.get_key(call_back_values)
+        if key is None:
+            return False
+        entry = dict(accepted_time=time.time(), call_back_values=call_back_values)
+        # a single write of a line in append mode is not interleaved with the ones of other processes
+        with open(self.journal_path(key), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return True
+
+    def keys(self) -> typing.List[str]:
+        try:
+            return sorted(name[:-len(journal_suffix)] for name in os.listdir(self.journal_dir)
+                          if name.endswith(journal_suffix))
+        except FileNotFoundError:
+            return []
+
+    def take(self, key) -> typing.List[dict]:
+        """
+        removes the journal of the job, and returns its entries
+        """
+        taken_path = f"{self.journal_path(key)}.{uuid.uuid4().hex}{taken_suffix}"
+        try:
+            # the callbacks appended from now on go to a new journal
+            os.replace(self.journal_path(key), taken_path)
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        try:
+            with open(taken_path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning("skipping a truncated entry of the callbacks journal %s", key)
+        finally:
+            os.remove(taken_path)
+        return entries
+
+
+class CallBackCoalescer:
+    def __init__(self, journal, process_call_back, interval_s):
+        self.journal = journal
+        self.process_call_back = process_call_back
+        self.interval_s = interval_s
+
+        self._job_locks = LockManager(timeout_s=job_lock_timeout_s, name='call_back_lock')
+        self._closed = threading.Event()
+
+        self._thread = threading.Thread(target=self._run, name='call_back_coalescer', daemon=True)
+        self._thread.start()
+
+    @contextlib.contextmanager
+    def job_lock(self, key, timeout_s=None):
+        """
+        holds the lock of the callbacks of the job, shared by the worker processes
+        """
+        with self._job_locks.lock(key, lock_dir=self.journal.journal_dir, timeout_s=timeout_s):
+            yield
+
+    def accept(self, call_back_values) -> bool:
+        """
+        journals the callback, returns False if it has to be processed right away
+        """
+        if is_final_call_back(call_back_values):
+            return False
+        return self.journal.append(call_back_values)
+
+    def discard(self, call_back_values) -> int:
+        """
+        drops the pending callbacks of the job, superseded by call_back_values, and returns their number
+        """
+        key = self.journal.get_key(call_back_values)
+        if key is None:
+            return 0
+        entries = self.journal.take(key)
+        if len(entries) > 0:
+            logger.info("%s pending callbacks of %s superseded by the %s callback",
+                        len(entries), key, call_back_values.get('action'))
+        return len(entries)
+
+    def flush(self) -> int:
+        """
+        processes the latest pending callback of each job, and returns the number of jobs processed
+        """
+        n_processed = 0
+        for key in self.journal.keys():
+            try:
+                # not to hold up the other jobs
+                with self.job_lock(key, timeout_s=self.interval_s):
+                    entries = self.journal.take(key)
+                    if len(entries) == 0:
+                        continue
+                    latest_entry = max(entries, key=lambda e: e['accepted_time'])
+                    logger.info("processing the latest of %s pending callbacks of %s", len(entries), key)
+                    try:
+                        self.process_call_back(latest_entry['call_back_values'], latest_entry['accepted_time'])
+                    except Exception as e:
+                        logger.error("unable to process the callback of %s: %s", key, repr(e))
+                    n_processed += 1
+            except LockTimeout:
+                # left in the journal, for the next flush
+                logger.warning("the callbacks of %s are still being processed, not processed now", key)
+        return n_processed
+
+    def _run(self):
+        while not self._closed.wait(self.interval_s):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("unable to process the pending callbacks: %s", repr(e))
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+
+_call_back_coalescer = None
+_call_back_coalescer_pid = None
+_call_back_coalescer_options = {}
+_call_back_coalescer_lock = threading.Lock()
+
+
+def configure_call_back_coalescer(disp_conf, process_call_back):
+    """
+    sets the interval of the coalescing of the callbacks from the dispatcher configuration,
+    and the function processing a callback, called with its values and the time it was accepted
+    """
+    global _call_back_coalescer, _call_back_coalescer_options
+    with _call_back_coalescer_lock:
+        if _call_back_coalescer is not None and _call_back_coalescer_pid == os.getpid():
+            _call_back_coalescer.close()
+        _call_back_coalescer = None
+        _call_back_coalescer_options = dict(interval_s=disp_conf.call_back_coalescing_interval_s,
+                                            process_call_back=process_call_back)
+
+
+def get_call_back_coalescer() -> typing.Optional[CallBackCoalescer]:
+    """
+    returns the coalescer of the process, or None if the callbacks are processed synchronously
+    """
+    global _call_back_coalescer, _call_back_coalescer_pid
+    with _call_back_coalescer_lock:
+        if not _call_back_coalescer_options.get('interval_s'):
+            return None
+        # the thread is not inherited by the forked processes
+        if _call_back_coalescer is None or _call_back_coalescer_pid != os.getpid():
+            _call_back_coalescer = CallBackCoalescer(CallBackJournal(), **_call_back_coalescer_options)
+            _call_back_coalescer_pid = os.getpid()
+        return _call_back_coalescer
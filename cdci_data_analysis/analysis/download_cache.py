@@ -0,0 +1,172 @@
+"""
+Content-addressed cache of the archives prepared for the download of the products.
+
+Each archive is identified by the job_id, the list of the archived files (with their
+size and mtime) and the archive mode (type of archive, name and compression level),
+so that repeated downloads of the same products are served from the cache,
+and any change in the files gives a new entry.
+
+The cache is a directory in the working directory of the dispatcher, its size is bounded
+by removing the least recently used archives; the entries of a job are removed with its scratch directory.
+"""
+
+import os
+import json
+import shutil
+import uuid
+import typing
+import hashlib
+
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('download_cache')
+
+default_cache_dir_name = '.download_cache'
+
+
+class DownloadCacheEntry(typing.NamedTuple):
+    path: str
+    key: str
+    job_id: str
+    size: int
+    mtime: float
+
+
+def make_download_cache_key(job_id, file_list, archive_mode) -> str:
+    """
+    returns the key of the archive of the files in file_list, for the job job_id,
+    archive_mode being a json-serializable description of the archive
+    """
+    files_info = []
+    for file_path in sorted(file_list):
+        st = os.stat(file_path)
+        files_info.append([os.path.basename(file_path), st.st_size, st.st_mtime_ns])
+
+    digest = hashlib.md5(json.dumps([files_info, archive_mode]).encode()).hexdigest()
+    return f"{job_id}_{digest}"
+
+
+class DownloadCache:
+    def __init__(self, cache_dir=None, max_size=None):
+        if cache_dir is None:
+            cache_dir = default_cache_dir_name
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key) -> typing.Optional[str]:
+        """
+        returns the path of the cached archive, if any, marking it as recently used
+        """
+        path = self.entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, file_path) -> str:
+        """
+        moves the archive file_path to the cache, and returns its new path
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.entry_path(key)
+        # moved first next to its final path, in case file_path is on another file system
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.move(file_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict(keep=[key])
+        return path
+
+    def entries(self) -> typing.List[DownloadCacheEntry]:
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as scan:
+                for entry in scan:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append(DownloadCacheEntry(path=entry.path,
+                                                      key=entry.name,
+                                                      job_id=entry.name.split('_')[0],
+                                                      size=st.st_size,
+                                                      mtime=st.st_mtime))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def evict(self, max_size=None, keep=(), dry_run=False) -> typing.List[DownloadCacheEntry]:
+        """
+        removes the least recently used archives, until the size of the cache is within max_size,
+        and returns the removed entries
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if max_size is None:
+            return []
+
+        entries = sorted(self.entries(), key=lambda e: e.mtime)
+        total_size = sum(e.size for e in entries)
+        removed = []
+        for entry in entries:
+            if total_size <= max_size:
+                break
+            if entry.key in keep:
+                continue
+            if dry_run or self._remove(entry):
+                removed.append(entry)
+                total_size -= entry.size
+        return removed
+
+    def remove_entries(self, job_ids=None, older_than=None, dry_run=False) -> typing.List[DownloadCacheEntry]:
+        """
+        removes the archives of the given jobs, and those not used since older_than (a timestamp),
+        and returns the removed entries
+        """
+        removed = []
+        for entry in self.entries():
+            if (job_ids is not None and entry.job_id in job_ids) or \
+                    (older_than is not None and entry.mtime < older_than):
+                if dry_run or self._remove(entry):
+                    removed.append(entry)
+        return removed
+
+    @staticmethod
+    def _remove(entry) -> bool:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("unable to remove the cached archive %s: %s", entry.path, repr(e))
+            return False
+        return True
+
+
+def remove_download_dirs(older_than, wd='.', dry_run=False) -> typing.List[str]:
+    """
+    removes the temporary directories of the downloads (download_*) not modified since older_than (a timestamp),
+    and returns them
+    """
+    removed = []
+    with os.scandir(wd) as scan:
+        for entry in scan:
+            if not (entry.name.startswith('download_') and entry.is_dir(follow_symlinks=False)):
+                continue
+            try:
+                if entry.stat().st_mtime >= older_than:
+                    continue
+                if not dry_run:
+                    shutil.rmtree(entry.path)
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                logger.warning("unable to remove the download directory %s: %s", entry.path, repr(e))
+                continue
+            removed.append(entry.path)
+    return removed
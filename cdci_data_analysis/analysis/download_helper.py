@@ -0,0 +1,128 @@
+"""
+Helpers for the download of the products: generation, on the fly and with bounded memory,
+of the gzip-compressed content of a file and of the tar.gz archive of a list of files.
+"""
+
+import os
+import functools
+import gzip
+import stat
+import tarfile
+import typing
+
+download_chunk_size = 1024 * 1024
+default_compression_level = 9
+
+
+class _ChunksBuffer:
+    """
+    file-like object collecting what is written to it, until it is taken
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _skip_empty_chunks(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for chunk in func(*args, **kwargs):
+            if chunk:
+                yield chunk
+    return wrapper
+
+
+def _iter_file_chunks(file_path, chunk_size):
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+@_skip_empty_chunks
+def iter_gzip_file(file_path,
+                   compression_level=default_compression_level,
+                   chunk_size=download_chunk_size) -> typing.Iterator[bytes]:
+    """
+    yields the gzip-compressed content of file_path, reading it chunk by chunk
+    """
+    buffer = _ChunksBuffer()
+    with gzip.GzipFile(filename=os.path.basename(file_path), fileobj=buffer, mode='wb',
+                       compresslevel=compression_level) as gz:
+        for chunk in _iter_file_chunks(file_path, chunk_size):
+            gz.write(chunk)
+            yield buffer.take()
+    yield buffer.take()
+
+
+def _iter_tar_members(file_path, arcname):
+    st = os.stat(file_path)
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.mode = stat.S_IMODE(st.st_mode)
+    tarinfo.mtime = st.st_mtime
+    if stat.S_ISDIR(st.st_mode):
+        tarinfo.type = tarfile.DIRTYPE
+        yield file_path, tarinfo
+        for name in sorted(os.listdir(file_path)):
+            yield from _iter_tar_members(os.path.join(file_path, name), '%s/%s' % (arcname, name))
+    else:
+        tarinfo.size = st.st_size
+        yield file_path, tarinfo
+
+
+@_skip_empty_chunks
+def iter_tar_gz(file_list, out_dir,
+                compression_level=default_compression_level,
+                chunk_size=download_chunk_size) -> typing.Iterator[bytes]:
+    """
+    yields the content of the tar.gz archive of the files in file_list, within the directory out_dir of the archive,
+    equivalent to the one built with tarfile, but writing the content of each file chunk by chunk
+    """
+    buffer = _ChunksBuffer()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=compression_level) as gz:
+        offset = 0
+        for name in file_list:
+            if name is None:
+                continue
+            for file_path, tarinfo in _iter_tar_members(name, '%s/%s' % (out_dir, os.path.basename(name))):
+                header = tarinfo.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+                gz.write(header)
+                offset += len(header)
+                if tarinfo.isreg():
+                    size = 0
+                    for chunk in _iter_file_chunks(file_path, chunk_size):
+                        # the file might be growing, what is in the header is added
+                        chunk = chunk[:tarinfo.size - size]
+                        gz.write(chunk)
+                        size += len(chunk)
+                        yield buffer.take()
+                        if size >= tarinfo.size:
+                            break
+                    if size < tarinfo.size:
+                        raise OSError("file %s changed size while being archived" % file_path)
+                    remainder = size % tarfile.BLOCKSIZE
+                    if remainder > 0:
+                        gz.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+                    offset += size + (tarfile.BLOCKSIZE - remainder if remainder > 0 else 0)
+                yield buffer.take()
+
+        # end of archive, as written by tarfile
+        gz.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+        offset += tarfile.BLOCKSIZE * 2
+        remainder = offset % tarfile.RECORDSIZE
+        if remainder > 0:
+            gz.write(tarfile.NUL * (tarfile.RECORDSIZE - remainder))
+    yield buffer.take()
@@ -11,6 +11,8 @@ import copy
 import uuid
 import glob
 import re
+import random
+import threading
 
 from typing import Optional, Tuple, Dict
 
@@ -24,7 +26,7 @@ from astropy import units as u
 from astroquery.simbad import Simbad
 import xml.etree.ElementTree as ET
 
-from cdci_data_analysis.analysis import tokenHelper
+from cdci_data_analysis.analysis import tokenHelper, scratch_layout
 from ..analysis.exceptions import RequestNotUnderstood, InternalError, RequestNotAuthorized
 from ..flask_app.templates import body_article_product_gallery
 from ..app_logging import app_logging
@@ -36,9 +38,9 @@ logger = app_logging.getLogger('drupal_helper')
 
 n_max_tries = 10
 retry_sleep_s = .5
-
-total_n_successful_post_requests = 0
-total_n_post_request_retries = 0
+max_retry_sleep_s = 30
+default_request_timeout_s = (10, 300)
+default_pool_maxsize = 10
 
 
 class ContentType(Enum):
@@ -146,8 +148,272 @@ def get_parents_term(decoded_token, term, group=None, disp_conf=None, sentry_dsn
     return output_list
 
 
-# TODO extend to support the sending of the requests also in other formats besides hal_json
-# not necessary at the moment, but perhaps in the future it will be
+class GalleryEndpointMetrics:
+    """
+    number of requests, retries and failures, and latency of the requests, to an endpoint of the product gallery
+
+    the counters are updated from the concurrent request threads, always under the lock of the metrics
+    """
+    def __init__(self):
+        self.n_requests = 0
+        self.n_successful_requests = 0
+        self.n_failed_requests = 0
+        self.n_retries = 0
+        self.total_latency_s = 0.
+        self.max_latency_s = 0.
+        self._lock = threading.Lock()
+
+    def add_request(self, latency_s, successful):
+        with self._lock:
+            self.n_requests += 1
+            if successful:
+                self.n_successful_requests += 1
+            self.total_latency_s += latency_s
+            self.max_latency_s = max(self.max_latency_s, latency_s)
+
+    def add_retry(self):
+        with self._lock:
+            self.n_retries += 1
+
+    def add_failure(self):
+        with self._lock:
+            self.n_failed_requests += 1
+
+    @property
+    def average_latency_s(self):
+        with self._lock:
+            return self._average_latency_s()
+
+    @property
+    def average_retries(self):
+        with self._lock:
+            if self.n_successful_requests == 0:
+                return 0.
+            return self.n_retries / self.n_successful_requests
+
+    def get_retries(self):
+        with self._lock:
+            return self.n_retries, self.n_successful_requests
+
+    def _average_latency_s(self):
+        if self.n_requests == 0:
+            return 0.
+        return self.total_latency_s / self.n_requests
+
+    def as_dict(self):
+        with self._lock:
+            return dict(n_requests=self.n_requests,
+                        n_successful_requests=self.n_successful_requests,
+                        n_failed_requests=self.n_failed_requests,
+                        n_retries=self.n_retries,
+                        average_latency_s=self._average_latency_s(),
+                        max_latency_s=self.max_latency_s)
+
+
+class GalleryClient:
+    """
+    client of the product gallery, sending the requests through a pooled session,
+    retrying them with an exponential backoff, and keeping the metrics of each endpoint
+    """
+    def __init__(self,
+                 timeout=default_request_timeout_s,
+                 n_max_tries=n_max_tries,
+                 retry_sleep_s=retry_sleep_s,
+                 max_retry_sleep_s=max_retry_sleep_s,
+                 pool_maxsize=default_pool_maxsize):
+        self.timeout = timeout
+        self.n_max_tries = n_max_tries
+        self.retry_sleep_s = retry_sleep_s
+        self.max_retry_sleep_s = max_retry_sleep_s
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    @staticmethod
+    def get_endpoint(method, url):
+        # the ids and the other parameters in the path are not relevant for the endpoint
+        path = urllib.parse.urlparse(url).path
+        path = re.sub(r'/[^/]*(\d|@)[^/]*', '/{id}', path)
+        return f"{method.upper()} {path}"
+
+    def endpoint_metrics(self, endpoint) -> GalleryEndpointMetrics:
+        with self._metrics_lock:
+            if endpoint not in self._metrics:
+                self._metrics[endpoint] = GalleryEndpointMetrics()
+            return self._metrics[endpoint]
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            return {endpoint: metrics.as_dict() for endpoint, metrics in self._metrics.items()}
+
+    @property
+    def average_retries(self):
+        with self._metrics_lock:
+            retries = [metrics.get_retries() for metrics in self._metrics.values()]
+        n_retries = sum(n for n, _ in retries)
+        n_successful_requests = sum(n for _, n in retries)
+        if n_successful_requests == 0:
+            return 0.
+        return n_retries / n_successful_requests
+
+    def get_retry_sleep_s(self, n_retry):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_retry_sleep_s, self.retry_sleep_s * 2 ** n_retry))
+
+    # TODO extend to support the sending of the requests also in other formats besides hal_json
+    # not necessary at the moment, but perhaps in the future it will be
+    def execute_request(self,
+                        url,
+                        params=None,
+                        data=None,
+                        method='get',
+                        headers=None,
+                        files=None,
+                        request_format='hal_json',
+                        sentry_dsn=None):
+        if method not in ['get', 'post', 'patch', 'delete']:
+            raise NotImplementedError
+
+        if params is None:
+            params = {}
+        params['_format'] = request_format
+        if method != 'get' and data is None:
+            data = {}
+
+        metrics = self.endpoint_metrics(self.get_endpoint(method, url))
+        n_tries_left = self.n_max_tries
+        while True:
+            t0 = time.time()
+            try:
+                if method == 'get':
+                    res = self.session.get(url,
+                                           params={**params},
+                                           headers=headers,
+                                           timeout=self.timeout)
+                elif method == 'delete':
+                    res = self.session.delete(url,
+                                              params={**params},
+                                              data=data,
+                                              headers=headers,
+                                              timeout=self.timeout)
+                else:
+                    res = self.session.request(method,
+                                               url,
+                                               params={**params},
+                                               data=data,
+                                               files=files,
+                                               headers=headers,
+                                               timeout=self.timeout)
+
+                if res.status_code == 403:
+                    try:
+                        response_json = res.json()
+                        # a 403 has been noticed to be returned in two different cases:
+                        # * for not-valid token
+                        # * not-completed request
+                        error_msg = response_json['message']
+                    except json.decoder.JSONDecodeError:
+                        error_msg = res.text
+                    raise RequestNotAuthorized(error_msg)
+
+                elif res.status_code not in [200, 201, 204]:
+                    metrics.add_request(time.time() - t0, successful=False)
+                    metrics.add_failure()
+                    logger.warning(f"there seems to be some problem in completing a request to the product gallery:\n"
+                                   f"the requested url {url} lead to the error {res.text}, "
+                                   "this might be due to an error in the url or the page requested no longer exists, "
+                                   "please check it and try to issue again the request")
+                    drupal_helper_error_message = res.text
+                    # handling specific case of a not recognized/invalid argument
+                    m = re.search(r'<em(.*)>InvalidArgumentException</em>:(.*)</em>\)', res.text)
+                    if m is not None:
+                        drupal_helper_error_message = re.sub('<[^<]+?>', '', m.group())
+
+                    if sentry_dsn is not None:
+                        sentry.capture_message(f'issue in completing a request to the product gallery: '
+                                               f'the requested url {url} lead to the error '
+                                               f'{drupal_helper_error_message}')
+                    else:
+                        logger.warning("sentry not used")
+
+                    raise InternalError('issue when performing a request to the product gallery',
+                                        status_code=500,
+                                        payload={'drupal_helper_error_message': drupal_helper_error_message})
+
+                metrics.add_request(time.time() - t0, successful=True)
+                return res
+
+            except (ConnectionError,
+                    RequestNotAuthorized,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as e:
+                metrics.add_request(time.time() - t0, successful=False)
+
+                n_tries_left -= 1
+                average_retries_request = self.average_retries
+
+                if n_tries_left > 0:
+                    metrics.add_retry()
+                    if self.n_max_tries - n_tries_left > average_retries_request:
+                        logger.warning(f"a request to the url {url} of the product gallery is taking more time than expected, "
+                                       "we will investigate the problem and solve it as soon as possible")
+                    else:
+                        logger.warning(f"there seems to be some problem in completing the request to the url {url} of the product gallery,"
+                                       " this is possibly temporary and we will retry the same request shortly")
+
+                    sleep_s = self.get_retry_sleep_s(self.n_max_tries - n_tries_left - 1)
+                    logger.debug(f"{e} exception during a request to the url {url} of the product gallery\n"
+                                 f"{n_tries_left} tries left, sleeping {sleep_s:.2f} seconds until retry\n"
+                                 f"average retries per request since dispatcher start: "
+                                 f"{average_retries_request:.2f}")
+                    time.sleep(sleep_s)
+                else:
+                    metrics.add_failure()
+                    logger.warning(f"an issue occurred when performing a request to the product gallery, "
+                                   f"this prevented us to complete the request to the url: {url} \n"
+                                   f"this is likely to be a connection related problem, we are investigating and "
+                                   f"try to solve it as soon as possible")
+                    sentry.capture_message(f'exception when performing a request to the product gallery: {repr(e)}')
+                    raise InternalError('issue when performing a request to the product gallery',
+                                        status_code=500,
+                                        payload={'drupal_helper_error_message': str(e)})
+
+
+_gallery_client = None
+_gallery_client_pid = None
+_gallery_client_options = {}
+_gallery_client_lock = threading.Lock()
+
+
+def configure_gallery_client(disp_conf):
+    """
+    sets the options of the client of the product gallery from the dispatcher configuration
+    """
+    global _gallery_client, _gallery_client_options
+    with _gallery_client_lock:
+        _gallery_client_options = dict(timeout=(disp_conf.product_gallery_connect_timeout_s,
+                                                disp_conf.product_gallery_read_timeout_s),
+                                       n_max_tries=disp_conf.product_gallery_n_max_tries,
+                                       retry_sleep_s=disp_conf.product_gallery_retry_sleep_s,
+                                       max_retry_sleep_s=disp_conf.product_gallery_max_retry_sleep_s)
+        _gallery_client = None
+
+
+def get_gallery_client() -> GalleryClient:
+    global _gallery_client, _gallery_client_pid
+    with _gallery_client_lock:
+        # the connections of the pool can not be shared with the forked processes
+        if _gallery_client is None or _gallery_client_pid != os.getpid():
+            _gallery_client = GalleryClient(**_gallery_client_options)
+            _gallery_client_pid = os.getpid()
+        return _gallery_client
+
+
 def execute_drupal_request(url,
                            params=None,
                            data=None,
@@ -156,126 +422,14 @@ def execute_drupal_request(url,
                            files=None,
                            request_format='hal_json',
                            sentry_dsn=None):
-    n_tries_left = n_max_tries
-    global total_n_successful_post_requests, total_n_post_request_retries
-    while True:
-        try:
-            if method == 'get':
-                if params is None:
-                    params = {}
-                params['_format'] = request_format
-                res = requests.get(url,
-                                   params={**params},
-                                   headers=headers)
-
-            elif method == 'post':
-                if data is None:
-                    data = {}
-                if params is None:
-                    params = {}
-                params['_format'] = request_format
-                res = requests.post(url,
-                                    params={**params},
-                                    data=data,
-                                    files=files,
-                                    headers=headers
-                                    )
-            elif method == 'patch':
-                if data is None:
-                    data = {}
-                if params is None:
-                    params = {}
-                params['_format'] = request_format
-                res = requests.patch(url,
-                                     params={**params},
-                                     data=data,
-                                     files=files,
-                                     headers=headers
-                                     )
-            elif method == 'delete':
-                if data is None:
-                    data = {}
-                if params is None:
-                    params = {}
-                params['_format'] = request_format
-                res = requests.delete(url,
-                                      params={**params},
-                                      data=data,
-                                      headers=headers
-                                      )
-            else:
-                raise NotImplementedError
-            if res.status_code == 403:
-                try:
-                    response_json = res.json()
-                    # a 403 has been noticed to be returned in two different cases:
-                    # * for not-valid token
-                    # * not-completed request
-                    error_msg = response_json['message']
-                except json.decoder.JSONDecodeError:
-                    error_msg = res.text
-                raise RequestNotAuthorized(error_msg)
-
-            elif res.status_code not in [200, 201, 204]:
-                logger.warning(f"there seems to be some problem in completing a request to the product gallery:\n"
-                               f"the requested url {url} lead to the error {res.text}, "
-                               "this might be due to an error in the url or the page requested no longer exists, "
-                               "please check it and try to issue again the request")
-                drupal_helper_error_message = res.text
-                # handling specific case of a not recognized/invalid argument
-                m = re.search(r'<em(.*)>InvalidArgumentException</em>:(.*)</em>\)', res.text)
-                if m is not None:
-                    drupal_helper_error_message = re.sub('<[^<]+?>', '', m.group())
-
-                if sentry_dsn is not None:
-                    sentry.capture_message(f'issue in completing a request to the product gallery: '
-                                           f'the requested url {url} lead to the error '
-                                           f'{drupal_helper_error_message}')
-                else:
-                    logger.warning("sentry not used")
-
-                raise InternalError('issue when performing a request to the product gallery',
-                                    status_code=500,
-                                    payload={'drupal_helper_error_message': drupal_helper_error_message})
-            else:
-                total_n_successful_post_requests += 1
-
-            return res
-
-        except (ConnectionError,
-                RequestNotAuthorized,
-                requests.exceptions.ConnectionError,
-                requests.exceptions.Timeout) as e:
-
-            n_tries_left -= 1
-            total_n_post_request_retries += 1
-            if total_n_successful_post_requests == 0:
-                average_retries_request = 0
-            else:
-                average_retries_request = total_n_post_request_retries/total_n_successful_post_requests
-
-            if n_tries_left > 0:
-                if n_max_tries - n_tries_left > average_retries_request:
-                    logger.warning(f"a request to the url {url} of the product gallery is taking more time than expected, "
-                                   "we will investigate the problem and solve it as soon as possible")
-                else:
-                    logger.warning(f"there seems to be some problem in completing the request to the url {url} of the product gallery,"
-                                   " this is possibly temporary and we will retry the same request shortly")
-
-                logger.debug(f"{e} exception during a request to the url {url} of the product gallery\n"
-                             f"{n_tries_left} tries left, sleeping {retry_sleep_s} seconds until retry\n"
-                             f"average retries per request since dispatcher start: "
-                             f"{average_retries_request:.2f}")
-                time.sleep(retry_sleep_s)
-            else:
-                logger.warning(f"an issue occurred when performing a request to the product gallery, "
-                               f"this prevented us to complete the request to the url: {url} \n"
-                               f"this is likely to be a connection related problem, we are investigating and "
-                               f"try to solve it as soon as possible")
-                sentry.capture_message(f'exception when performing a request to the product gallery: {repr(e)}')                
-                raise InternalError('issue when performing a request to the product gallery',
-                                    status_code=500,
-                                    payload={'drupal_helper_error_message': str(e)})
+    return get_gallery_client().execute_request(url,
+                                                params=params,
+                                                data=data,
+                                                method=method,
+                                                headers=headers,
+                                                files=files,
+                                                request_format=request_format,
+                                                sentry_dsn=sentry_dsn)
 
 
 def get_drupal_request_headers(gallery_jwt_token=None):
@@ -1194,7 +1348,7 @@ def post_data_product_to_gallery(product_gallery_url, gallery_jwt_token, convert
         # in case job_id is passed then it automatically extracts time, instrument and product_type information
         # related to the specific job, and uses them unless provided by the user
 
-        job_id_scratch_dir_list = glob.glob(f'scratch_sid_*_jid_{job_id}*')
+        job_id_scratch_dir_list = scratch_layout.get_scratch_layout().find_job_scratch_dirs(job_id)
         analysis_parameters_json_content_original = None
 
         if len(job_id_scratch_dir_list) >= 1:
@@ -8,25 +8,24 @@ import typing
 
 from ..flask_app.sentry import sentry
 
-from ..analysis import tokenHelper
+from ..analysis import tokenHelper, template_helper, notification_ledger
 import smtplib
 import ssl
 import os
 import re
 import time
-import glob
 import black
 import base64
 import logging
 from urllib import parse
 import zlib
 import json
-from jinja2 import Environment, FileSystemLoader
 from bs4 import BeautifulSoup
 
 from ..app_logging import app_logging
 from ..analysis.exceptions import BadRequest, MissingRequestParameter
 from ..analysis.hash import make_hash
+from ..analysis.job_registry import update_job_registry
 from ..analysis.time_helper import validate_time
 
 from datetime import datetime
@@ -70,6 +69,13 @@ def humanize_future(timestamp: float):
     return humanize_interval(float(timestamp) - time_.time())
 
 
+template_helper.register_template_environment('email',
+                                               ['email.html', 'incident_report_email.html'],
+                                               filters=dict(timestamp2isot=timestamp2isot,
+                                                            humanize_age=humanize_age,
+                                                            humanize_future=humanize_future))
+
+
 def textify_email(html):
     html = re.sub('<title>.*?</title>', '', html)
     html = re.sub('<a href=(.*?)>(.*?)</a>', r'\2: \1', html)
@@ -179,35 +185,18 @@ def check_scw_list_length(
 
 
 def get_first_submitted_email_time(scratch_dir):
-    first_submitted_email_time = None
-    submitted_email_pattern = os.path.join(
-        scratch_dir,
-        'email_history',
-        'email_submitted_*.email'
-    )
-    submitted_email_files = sorted(glob.glob(submitted_email_pattern), key=os.path.getmtime)
-
-    if len(submitted_email_files) >= 1:
-        f_name, f_ext = os.path.splitext(os.path.basename(submitted_email_files[0]))
-        f_name_split = f_name.split('_')
-        if len(f_name_split) == 4:
-            try:
-                validate_time(f_name_split[3])
-                first_submitted_email_time = float(f_name_split[3])
-            except (ValueError, OverflowError, TypeError, OSError) as e:
-                email_helper_logger.warning(f'Error when extracting the time of the first submitted email.'
-                                            f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
-                first_submitted_email_time = None
-                sentry.capture_message(f'Error when extracting the time of the first submitted email.'
-                               f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
-        else:
-            email_helper_logger.warning(f'Error when extracting the time of the first submitted email: '
-                                        f'the name of the email file has been found not properly formatted, therefore, '
-                                        f'the time of the first submitted email could not be extracted.')
+    first_submitted_email_time = notification_ledger.get_notification_summary(scratch_dir, 'email', 'submitted').first_submitted_time
+
+    if first_submitted_email_time is not None:
+        try:
+            validate_time(first_submitted_email_time)
+            first_submitted_email_time = float(first_submitted_email_time)
+        except (ValueError, OverflowError, TypeError, OSError) as e:
+            email_helper_logger.warning(f'Error when extracting the time of the first submitted email.'
+                                        f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
             first_submitted_email_time = None
-            sentry.capture_message(f'Error when extracting the time of the first submitted email: '
-                           f'the name of the email file has been found not properly formatted, therefore, '
-                           f'the time of the first submitted email could not be extracted.')
+            sentry.capture_message(f'Error when extracting the time of the first submitted email.'
+                           f'The value extracted {first_submitted_email_time} raised the following error:\n{e}')
 
     return first_submitted_email_time
 
@@ -224,11 +213,6 @@ def send_incident_report_email(
 
     sending_time = time_.time()
 
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     email_data = {
         'request': {
             'job_id': job_id,
@@ -239,7 +223,7 @@ def send_incident_report_email(
         'content': incident_content
     }
 
-    template = env.get_template('incident_report_email.html')
+    template = template_helper.get_template('email', 'incident_report_email.html')
     email_body_html = template.render(**email_data)
 
     email_subject = re.search("<title>(.*?)</title>", email_body_html).group(1)
@@ -284,16 +268,10 @@ def send_job_email(
         time_request=None,
         request_url="",
         api_code="",
-        scratch_dir=None):
+        scratch_dir=None,
+        outbox=None):
     sending_time = time_.time()
 
-    # let's get the needed email template;
-    # TODO: should get from pkgresources or so
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     # api_code = adapt_line_length_api_code(api_code, line_break="\n", add_line_continuation="\\")
     api_code_no_token = re.sub('"token": ".*?"', '"token": "<PLEASE-INSERT-YOUR-TOKEN-HERE>"', api_code)
     api_code_no_token = wrap_python_code(api_code_no_token)
@@ -367,7 +345,7 @@ and if this is not what you expected, you probably need to modify the request pa
             'permanent_url': permanent_url,
         }
     }
-    template = env.get_template('email.html')
+    template = template_helper.get_template('email', 'email.html')
     email_body_html = template.render(**email_data)
 
     email_subject = re.search("<title>(.*?)</title>", email_body_html).group(1)
@@ -378,6 +356,25 @@ and if this is not what you expected, you probably need to modify the request pa
         open("debug_email_lines_too_long.text", "w").write(email_text)
         raise EMailNotSent(f"email not sent, lines too long!")
 
+    if outbox is not None:
+        # delivered in the background, which also stores it in the email history once sent
+        message, receivers_email_addresses = build_email_message(config.sender_email_address,
+                                                                 config.cc_receivers_email_addresses,
+                                                                 config.bcc_receivers_email_addresses,
+                                                                 tokenHelper.get_token_user_email_address(decoded_token),
+                                                                 email_data['oda_site']['contact'],
+                                                                 email_subject,
+                                                                 email_text,
+                                                                 email_body_html,
+                                                                 attachment=api_code_email_attachment)
+        outbox.enqueue_email(message,
+                             receivers_email_addresses,
+                             status,
+                             scratch_dir,
+                             sending_time=sending_time,
+                             first_submitted_time=time_request)
+        return message
+
     message = send_email(config.smtp_server,
                          config.smtp_port,
                          config.sender_email_address,
@@ -399,30 +396,20 @@ and if this is not what you expected, you probably need to modify the request pa
     return message
 
 
-def send_email(smtp_server,
-               smtp_port,
-               sender_email_address,
-               cc_receivers_email_addresses,
-               bcc_receivers_email_addresses,
-               receiver_email_addresses,
-               reply_to_email_address,
-               email_subject,
-               email_text,
-               email_body_html,
-               smtp_server_password,
-               logger,
-               sending_time=None,
-               scratch_dir=None,
-               attachment=None
-               ):
-
-    server = None
-    logger.info(f"Sending email through the smtp server: {smtp_server}:{smtp_port}")
+def build_email_message(sender_email_address,
+                        cc_receivers_email_addresses,
+                        bcc_receivers_email_addresses,
+                        receiver_email_addresses,
+                        reply_to_email_address,
+                        email_subject,
+                        email_text,
+                        email_body_html,
+                        attachment=None):
+    """
+    returns the message, and the list of all its receivers (bcc ones included)
+    """
     # Create the plain-text and HTML version of your message,
     # since emails with HTML content might be, sometimes, not supported
-
-    n_tries_left = num_email_sending_max_tries
-
     if not isinstance(receiver_email_addresses, list):
         receiver_email_addresses = [receiver_email_addresses]
     if cc_receivers_email_addresses is None:
@@ -448,21 +435,60 @@ def send_email(smtp_server,
     message.attach(part1)
     message.attach(part2)
 
+    return message, receivers_email_addresses
+
+
+def open_smtp_connection(smtp_server, smtp_port, sender_email_address, smtp_server_password, logger) -> smtplib.SMTP:
+    # Create a secure SSL context
+    context = ssl.create_default_context()
+    server = smtplib.SMTP(smtp_server, smtp_port)
+    # just for testing purposes, not ssl is established
+    if smtp_server != "localhost":
+        try:
+            server.starttls(context=context)
+        except Exception as e:
+            logger.warning(f'unable to start TLS: {e}')
+    if smtp_server_password is not None and smtp_server_password != '':
+        server.login(sender_email_address, smtp_server_password)
+    return server
+
+
+def send_email(smtp_server,
+               smtp_port,
+               sender_email_address,
+               cc_receivers_email_addresses,
+               bcc_receivers_email_addresses,
+               receiver_email_addresses,
+               reply_to_email_address,
+               email_subject,
+               email_text,
+               email_body_html,
+               smtp_server_password,
+               logger,
+               sending_time=None,
+               scratch_dir=None,
+               attachment=None
+               ):
+
+    server = None
+    logger.info(f"Sending email through the smtp server: {smtp_server}:{smtp_port}")
+
+    n_tries_left = num_email_sending_max_tries
+
+    message, receivers_email_addresses = build_email_message(sender_email_address,
+                                                             cc_receivers_email_addresses,
+                                                             bcc_receivers_email_addresses,
+                                                             receiver_email_addresses,
+                                                             reply_to_email_address,
+                                                             email_subject,
+                                                             email_text,
+                                                             email_body_html,
+                                                             attachment=attachment)
+
     while True:
         try:
-            # Create a secure SSL context
-            context = ssl.create_default_context()
-            #
             # Try to log in to server and send email
-            server = smtplib.SMTP(smtp_server, smtp_port)
-            # just for testing purposes, not ssl is established
-            if smtp_server != "localhost":
-                try:
-                    server.starttls(context=context)
-                except Exception as e:
-                    logger.warning(f'unable to start TLS: {e}')
-            if smtp_server_password is not None and smtp_server_password != '':
-                server.login(sender_email_address, smtp_server_password)
+            server = open_smtp_connection(smtp_server, smtp_port, sender_email_address, smtp_server_password, logger)
             server.sendmail(sender_email_address, receivers_email_addresses, message.as_string())
             logger.info("email successfully sent")
 
@@ -533,6 +559,10 @@ def store_status_email_info(message, status, scratch_dir, logger, sending_time=N
     with open(os.path.join(path_email_history_folder, email_file_name), 'w+') as outfile:
         outfile.write(message.as_string())
 
+    notification_ledger.record_notification(scratch_dir, 'email', status, sending_time, first_submitted_time, email_file_name)
+
+    update_job_registry(scratch_dir)
+
 
 def store_not_sent_email(email_body, scratch_dir, sending_time=None):
     path_email_history_folder = os.path.join(scratch_dir, 'email_history')
@@ -544,6 +574,8 @@ def store_not_sent_email(email_body, scratch_dir, sending_time=None):
     with open(path_email_history_folder + '/not_sent_email_' + str(sending_time) + '.email', 'w+') as outfile:
         outfile.write(email_body)
 
+    update_job_registry(scratch_dir)
+
 
 def store_incident_report_email_info(message, scratch_dir, sending_time=None):
     path_email_history_folder = scratch_dir + '/email_history'
@@ -555,6 +587,8 @@ def store_incident_report_email_info(message, scratch_dir, sending_time=None):
     with open(path_email_history_folder + '/indident_report_email_' + str(sending_time) +'.email', 'w+') as outfile:
         outfile.write(message.as_string())
 
+    update_job_registry(scratch_dir)
+
 
 def store_email_api_code_attachment(api_code, status, scratch_dir, sending_time=None):
     # email folder
@@ -634,30 +668,14 @@ def is_email_to_send_run_query(logger, status, time_original_request, scratch_di
         logger.info("email_sending_job_submitted_interval: %s", email_sending_job_submitted_interval)
         log_additional_info_obj['email_sending_job_submitted_interval'] = f'{email_sending_job_submitted_interval}, {info_parameter}'
 
-        email_history_dir = os.path.join(scratch_dir + '/email_history')
-        logger.info("email_history_dir: %s", email_history_dir)
-
-        email_history_dirs_same_job_id = f"scratch_*_{job_id}*/email_history"
-        logger.info("email_history_dirs_same_job_id: %s", email_history_dirs_same_job_id)
-
-        # find all
-        submitted_email_pattern = os.path.join(
-                email_history_dirs_same_job_id,
-                'email_submitted_*.email'
-            )
-        submitted_email_files = glob.glob(submitted_email_pattern)
+        submitted_emails_summary = notification_ledger.get_job_notification_summary(job_id, 'email', 'submitted',
+                                                                                    scratch_dir=scratch_dir)
+        submitted_email_files = submitted_emails_summary.file_names
         logger.info("submitted_email_files: %s as %s", len(submitted_email_files), submitted_email_files)
         log_additional_info_obj['submitted_email_files'] = submitted_email_files
 
-        if len(submitted_email_files) >= 1:
-            times = []
-            for f in submitted_email_files:
-                f_name, f_ext = os.path.splitext(os.path.basename(f))
-                if f_ext == '.email' and f_name:
-                    times.append(float(f_name.split('_')[2]))
-
-            time_last_email_submitted_sent = max(times)
-            time_from_last_submitted_email = time_check - float(time_last_email_submitted_sent)
+        if submitted_emails_summary.last_sending_time is not None:
+            time_from_last_submitted_email = time_check - submitted_emails_summary.last_sending_time
             interval_ok = time_from_last_submitted_email > email_sending_job_submitted_interval
 
         logger.info("interval_ok: %s", interval_ok)
@@ -732,7 +750,8 @@ def is_email_to_send_callback(logger, status, time_original_request, scratch_dir
             logger.info("email_sending_timeout and duration_query > timeout_threshold_email %s",
                         email_sending_timeout and duration_query > timeout_threshold_email)
 
-            done_email_files = glob.glob(f'scratch_*_jid_{job_id}*/email_history/email_done_*')
+            done_email_files = notification_ledger.get_job_notification_summary(job_id, 'email', 'done',
+                                                                                scratch_dir=scratch_dir).file_names
             log_additional_info_obj['done_email_files'] = done_email_files
             if len(done_email_files) >= 1:
                 logger.info("the email cannot be sent because the number of done emails sent is too high: %s", len(done_email_files))
@@ -1,6 +1,7 @@
+import functools
 import hashlib
-import subprocess
 import json
+import threading
 from collections import OrderedDict
 
 default_kw_black_list = ('session_id',
@@ -14,6 +15,48 @@ default_kw_black_list = ('session_id',
                  'async_dispatcher')
 
 
+# note that even strings change hash() value between python invocations, so it's not safe to do so
+def format_hash(x):
+    return hashlib.md5(
+        json.dumps(sorted(x)).encode()
+    ).hexdigest()[:16]
+
+
+# the leaves longer than this (e.g. the selected_catalog) are cached by the digest of their serialization,
+# not to keep them in memory
+max_short_leaf_size = 256
+max_cached_long_leaves = 1024
+
+_long_leaf_hashes = OrderedDict()
+_long_leaf_hashes_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=8192)
+def _format_short_leaf_hash(dumped_leaf):
+    return format_hash(dumped_leaf)
+
+
+def _format_long_leaf_hash(dumped_leaf):
+    leaf_digest = hashlib.md5(dumped_leaf.encode()).digest()
+    with _long_leaf_hashes_lock:
+        if leaf_digest in _long_leaf_hashes:
+            _long_leaf_hashes.move_to_end(leaf_digest)
+            return _long_leaf_hashes[leaf_digest]
+
+    leaf_hash = format_hash(dumped_leaf)
+    with _long_leaf_hashes_lock:
+        _long_leaf_hashes[leaf_digest] = leaf_hash
+        if len(_long_leaf_hashes) > max_cached_long_leaves:
+            _long_leaf_hashes.popitem(last=False)
+    return leaf_hash
+
+
+def _format_leaf_hash(dumped_leaf):
+    if len(dumped_leaf) <= max_short_leaf_size:
+        return _format_short_leaf_hash(dumped_leaf)
+    return _format_long_leaf_hash(dumped_leaf)
+
+
 def make_hash(o):
     """
     Makes a hash from a dictionary, list, tuple or set to any level, that contains
@@ -21,24 +64,23 @@ def make_hash(o):
     dictionaries).
 
     """
-
-    # note that even strings change hash() value between python invocations, so it's not safe to do so
-    def format_hash(x): return hashlib.md5(
-        json.dumps(sorted(x)).encode()
-    ).hexdigest()[:16]
-
     if isinstance(o, (set, tuple, list)):
-        return format_hash(tuple(map(make_hash, o)))
+        return format_hash([make_hash(x) for x in o])
 
     elif isinstance(o, (dict, OrderedDict)):
-        return make_hash(tuple(o.items()))        
+        return make_hash(tuple(o.items()))
 
     # this takes care of various strange objects which can not be properly represented
-    return format_hash(json.dumps(o))
+    return _format_leaf_hash(json.dumps(o))
 
 
-def make_hash_file(file_path):
-    command = ["md5sum", file_path]
+file_hash_chunk_size = 1024 * 1024
 
-    output = subprocess.check_output(command)
-    return output.decode().split()[0]
+
+def make_hash_file(file_path):
+    # same digest as md5sum, without spawning a process
+    file_hash = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(file_hash_chunk_size), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
@@ -21,12 +21,15 @@ Module API
 from __future__ import absolute_import, division, print_function
 
 import os
+import copy
 from builtins import (bytes, str, open, super, range,
                       zip, round, input, int, pow, object, map, zip)
 
 import string
 import json
 import logging
+import threading
+import typing
 import yaml
 import validators
 
@@ -36,10 +39,10 @@ from urllib.parse import urlencode
 
 from cdci_data_analysis.analysis.queries import _check_is_base_query
 from .parameters import POSIXPath
-from ..analysis import tokenHelper, parameters
+from ..analysis import tokenHelper, parameters, ownership_registry
 from .catalog import BasicCatalog
 from .products import QueryOutput
-from .queries import ProductQuery, SourceQuery, InstrumentQuery
+from .queries import BaseQuery, ProductQuery, SourceQuery, InstrumentQuery
 from .io_helper import upload_file, upload_files_request
 
 from .exceptions import RequestNotUnderstood, RequestNotAuthorized, InternalError, ProductProcessingError
@@ -49,6 +52,8 @@ from oda_api.api import DispatcherAPI, RemoteException, Unauthorized, Dispatcher
 
 __author__ = "Andrea Tramacere"
 
+logger = logging.getLogger(__name__)
+
 # Standard library
 # eg copy
 # absolute import rg:from copy import deepcopy
@@ -89,6 +94,20 @@ class DataServerQueryClassNotSet(Exception):
     pass
 
 
+class SetParsPlanEntry(typing.NamedTuple):
+    query_index: int
+    par_index: int
+    name: str
+    is_posix_path: bool
+    units_name: typing.Optional[str]
+    par_format_name: typing.Optional[str]
+
+
+class SetParsPlan(typing.NamedTuple):
+    par_entries: typing.Tuple[SetParsPlanEntry, ...]
+    known_argument_names: typing.FrozenSet[str]
+
+
 class Instrument:
     def __init__(self,
                  instr_name,
@@ -130,9 +149,35 @@ class Instrument:
         
         self.allow_unknown_arguments = allow_unknown_arguments
 
+        # compiled by get_set_pars_plan, for each product_type
+        self._set_pars_plans = {}
+
     def __repr__(self):
         return f"[ {self.__class__.__name__} : {self.name} ]"
 
+    def clone(self):
+        """
+        returns a copy of the instrument, to be used for a single request, with its own queries and parameters objects:
+        the parameters metadata are shared with the original instrument, while their values are set only in the copy
+        """
+        memo = {}
+
+        def _clone(v):
+            if isinstance(v, BaseQuery):
+                return v.clone(memo)
+            elif type(v) is list:
+                return [_clone(x) for x in v]
+            return parameters.clone_parameters(v, memo)
+
+        new_instrument = copy.copy(self)
+        for k, v in self.__dict__.items():
+            new_instrument.__dict__[k] = _clone(v)
+        # updated from the dispatcher configuration when the request is processed
+        if 'data_server_conf_dict' in self.__dict__:
+            new_instrument.data_server_conf_dict = copy.deepcopy(self.data_server_conf_dict)
+
+        return new_instrument
+
     def set_data_server_conf_dict(self,data_serve_conf_file):
         conf_dict=None
         #print ('--> setting set_data_server_conf_dict for', self.name,'from data_serve_conf_file',data_serve_conf_file)
@@ -150,59 +195,84 @@ class Instrument:
     def _check_names(self):
         pass
 
+    def get_set_pars_plan(self, product_type=None):
+        """
+        returns the plan used by set_pars_from_dic to normalize the parameters of the given product_type,
+        it is compiled once and shared with the copies of the instrument (see clone): the parameters are
+        referenced by their position within the queries, and not directly.
+        The parameters not to be included depend on the request, a plan is compiled for each of their sets
+        """
+        plan_key = (product_type, frozenset(params_not_to_be_included))
+        plan = self._set_pars_plans.get(plan_key)
+        if plan is None:
+            if product_type is not None:
+                query_obj = self.get_query_by_name(self.get_product_query_name(product_type))
+                # loop over the list of parameters for the requested query,
+                # but also of the instrument query and source query
+                queries_list = [query_obj, self.instrumet_query, self.src_query]
+            else:
+                queries_list = self._queries_list
+
+            par_entries = []
+            for query in queries_list:
+                query_index = self._queries_list.index(query)
+                for par_index, par in enumerate(query.parameters):
+                    # this is required because in some cases a parameter is set without a name (eg UserCatalog),
+                    # or they don't have to set (eg scw_list)
+                    if par.name is not None and par.name not in params_not_to_be_included:
+                        par_entries.append(SetParsPlanEntry(query_index=query_index,
+                                                            par_index=par_index,
+                                                            name=par.name,
+                                                            is_posix_path=isinstance(par, POSIXPath),
+                                                            units_name=par.units_name,
+                                                            par_format_name=par.par_format_name))
+
+            known_argument_names = set(non_parameter_args)
+            for query in self._queries_list:
+                for par in query.parameters:
+                    known_argument_names.update(par.argument_names_list)
+
+            plan = SetParsPlan(par_entries=tuple(par_entries),
+                               known_argument_names=frozenset(known_argument_names))
+            self._set_pars_plans[plan_key] = plan
+
+        return plan
+
     def set_pars_from_dic(self, arg_dic, verbose=False):
-        product_type = arg_dic.get('product_type', None)
-        if product_type is not None:
-            query_name = self.get_product_query_name(product_type)
-            query_obj = self.get_query_by_name(query_name)
-            # loop over the list of parameters for the requested query,
-            # but also of the instrument query and source query
-            param_list = (query_obj.parameters +
-                          self.instrumet_query.parameters +
-                          self.src_query.parameters)
-        else:
-            param_list = [par for _query in self._queries_list for par in _query.parameters]
+        plan = self.get_set_pars_plan(arg_dic.get('product_type', None))
 
         updated_arg_dic = arg_dic.copy()
-        
-        for par in param_list:
-            self.logger.info("before normalizing, set_pars_from_dic>> par: %s par.name: %s par.value: %s par_dic[par.name]: %s",
-                             par, par.name, par.value, arg_dic.get(par.name, None))
-            # this is required because in some cases a parameter is set without a name (eg UserCatalog),
-            # or they don't have to set (eg scw_list)
-            if par.name is not None and par.name not in params_not_to_be_included:
-                if isinstance(par, POSIXPath) and par.name + '_type' in arg_dic and arg_dic[par.name + '_type'] == 'file'\
-                        and par.name not in arg_dic:
-                    par.value = None
-
-                # set the value for par to a default format,
-                # or to a default value if this is not included within the request
-                updated_arg_dic[par.name] = par.set_value_from_form(arg_dic, verbose=verbose)
-                if par.units_name is not None:
-                    if par.default_units is not None:
-                        updated_arg_dic[par.units_name] = par.default_units
-                    else:
-                        raise InternalError("Error when setting the parameter %s: "
-                                            "default unit not specified" % par.name)
-                if par.par_format_name is not None:
-                    if par.par_default_format is not None:
-                        updated_arg_dic[par.par_format_name] = par.par_default_format
-                    else:
-                        raise InternalError("Error when setting the parameter %s: "
-                                            "default format not specified" % par.name)
 
-            self.logger.info("after normalizing, set_pars_from_dic>> par: %s par.name: %s par.value: %s par_dic[par.name]: %s",
-                             par, par.name, par.value, arg_dic.get(par.name, None))
+        for entry in plan.par_entries:
+            par = self._queries_list[entry.query_index]._parameters_list[entry.par_index]
+            if entry.is_posix_path and arg_dic.get(entry.name + '_type') == 'file' and entry.name not in arg_dic:
+                par.value = None
+
+            # set the value for par to a default format,
+            # or to a default value if this is not included within the request
+            updated_arg_dic[entry.name] = par.set_value_from_form(arg_dic, verbose=verbose)
+            if entry.units_name is not None:
+                if par.default_units is not None:
+                    updated_arg_dic[entry.units_name] = par.default_units
+                else:
+                    raise InternalError("Error when setting the parameter %s: "
+                                        "default unit not specified" % entry.name)
+            if entry.par_format_name is not None:
+                if par.par_default_format is not None:
+                    updated_arg_dic[entry.par_format_name] = par.par_default_format
+                else:
+                    raise InternalError("Error when setting the parameter %s: "
+                                        "default format not specified" % entry.name)
 
-            if par.name == "scw_list":
-                self.logger.info("set_pars_from_dic>> scw_list is %s", par.value)
+        if verbose:
+            self.logger.info("set_pars_from_dic>> normalized parameters: %s",
+                             {entry.name: updated_arg_dic[entry.name] for entry in plan.par_entries})
 
         if arg_dic.get('allow_unknown_args', None):
             self.allow_unknown_arguments = arg_dic.get('allow_unknown_args', 'False') == 'True'
-        known_argument_names = non_parameter_args + self.get_arguments_name_list()
         self.unknown_arguments_name_list = []
         for k in list(updated_arg_dic.keys()):
-            if k not in known_argument_names:
+            if k not in plan.known_argument_names:
                 if not self.allow_unknown_arguments:
                     updated_arg_dic.pop(k) 
                     self.logger.warning("argument '%s' is in the request but not used by instrument '%s', removing it", k, self.name)
@@ -735,30 +805,9 @@ class Instrument:
             user_email = 'public'
             user_roles = []
 
-        update_file = False
+        registry = ownership_registry.get_ownership_registry(request_files_dir)
         for file_name in uploaded_files_obj:
-            file_hash = uploaded_files_obj[file_name]
-            ownership_file_path = os.path.join(request_files_dir, f'{file_hash}_ownerships.json')
-            if not os.path.exists(ownership_file_path):
-                ownerships = dict(
-                    user_emails=[user_email],
-                    user_roles=user_roles
-                )
-                update_file = True
-            else:
-                with open(ownership_file_path) as ownership_file:
-                    ownerships = json.load(ownership_file)
-            if user_email not in ownerships['user_emails']:
-                ownerships['user_emails'].append(user_email)
-                update_file = True
-            if not all(role in ownerships['user_roles'] for role in user_roles):
-                set_user_roles = set(ownerships['user_roles'])
-                set_user_roles |= set(user_roles)
-                ownerships['user_roles'] = list(set_user_roles)
-                update_file = True
-            if update_file:
-                with open(ownership_file_path, 'w') as ownership_file:
-                    json.dump(ownerships, ownership_file)
+            registry.add_ownerships(uploaded_files_obj[file_name], user_email, user_roles)
 
     def set_input_products(self, par_dic, input_file_path,input_prod_list_name):
         if input_file_path is None:
@@ -871,12 +920,129 @@ def build_catalog(cat_dic,catalog_selected_objects=None):
 
     return user_catalog
 
+class InstrumentFactoryIndexEntry(typing.NamedTuple):
+    name: str
+    factory: typing.Callable
+    instrument_query: InstrumentQuery
+
+
 class InstrumentFactoryIterator:
     def __init__(self):
         self._partlist = []
+        self._index = None
+        self._index_size = None
+        self._accessible_instrument_names = {}
+        self._prototypes = {}
+        self._prototypes_lock = threading.Lock()
         
     def extend(self, lst):
         self._partlist.append(lst)
+        self.invalidate_index()
     
     def __iter__(self):
-        return (y for x in self._partlist for y in x)
\ No newline at end of file
+        return (y for x in self._partlist for y in x)
+
+    def __len__(self):
+        return sum(len(x) for x in self._partlist)
+
+    def invalidate_index(self):
+        self._index = None
+        self._accessible_instrument_names = {}
+        self._prototypes = {}
+
+    def build_index(self):
+        """
+        builds the table of the factories with the name and the instrument query of their instrument,
+        the instrument is built only if the factory does not expose them as instr_name and instrument_query
+        """
+        index = []
+        for instrument_factory in self:
+            _instrument = None
+            if hasattr(instrument_factory, 'instr_name'):
+                instr_name = instrument_factory.instr_name
+            else:
+                _instrument = instrument_factory()
+                instr_name = _instrument.name
+
+            if hasattr(instrument_factory, 'instrument_query'):
+                instrument_query = instrument_factory.instrument_query
+            else:
+                if _instrument is None:
+                    _instrument = instrument_factory()
+                instrument_query = _instrument.instrumet_query
+
+            index.append(InstrumentFactoryIndexEntry(name=instr_name,
+                                                     factory=instrument_factory,
+                                                     instrument_query=instrument_query))
+
+        self._index = index
+        self._index_by_name = {}
+        for entry in index:
+            # as when iterating over the factories, the last one with a given name is used
+            if entry.name in self._index_by_name:
+                logger.warning("more than one instrument factory for the instrument %s", entry.name)
+            self._index_by_name[entry.name] = entry
+        self._index_size = len(self)
+        self._accessible_instrument_names = {}
+        self._prototypes = {}
+
+        return index
+
+    @property
+    def index(self) -> typing.List[InstrumentFactoryIndexEntry]:
+        # the lists of factories exposed by the plugins might be extended after their loading
+        if self._index is None or self._index_size != len(self):
+            self.build_index()
+        return self._index
+
+    @property
+    def instrument_names(self) -> typing.List[str]:
+        return [entry.name for entry in self.index]
+
+    def get_entry(self, instrument_name) -> typing.Optional[InstrumentFactoryIndexEntry]:
+        self.index
+        return self._index_by_name.get(instrument_name)
+
+    def get_accessible_instrument_names(self, roles=None, email=None) -> typing.List[str]:
+        key = (tuple(sorted(roles)) if roles is not None else None, email)
+        if key not in self._accessible_instrument_names:
+            if len(self._accessible_instrument_names) > 1024:
+                self._accessible_instrument_names = {}
+            self._accessible_instrument_names[key] = [entry.name for entry in self.index
+                                                      if entry.instrument_query.check_instrument_access(roles, email)]
+        return self._accessible_instrument_names[key]
+
+    def get_instrument(self, instrument_name, use_prototype=True):
+        """
+        returns a new instrument, to be used for a single request.
+
+        With use_prototype, the instruments of the factories declaring instrument_prototype_pool = True are built
+        only once, as a prototype, and each request gets a copy of it (see Instrument.clone), instead of building it
+        again. Only the queries and the parameters are copied, the other attributes of the instrument are shared
+        by the requests: the instruments of the other factories, possibly keeping there some state of the request,
+        are built for each request
+        """
+        entry = self.get_entry(instrument_name)
+        if entry is None:
+            return None
+
+        if not use_prototype or not getattr(entry.factory, 'instrument_prototype_pool', False):
+            return entry.factory()
+
+        prototype = self._prototypes.get(instrument_name)
+        if prototype is None:
+            with self._prototypes_lock:
+                prototype = self._prototypes.get(instrument_name)
+                if prototype is None:
+                    prototype = entry.factory()
+                    self._prototypes[instrument_name] = prototype
+
+        if not isinstance(prototype, Instrument):
+            return entry.factory()
+
+        try:
+            return prototype.clone()
+        except Exception as e:
+            logger.warning("unable to copy the prototype of the instrument %s, building it: %s",
+                           instrument_name, repr(e))
+            return entry.factory()
@@ -32,13 +32,19 @@ __author__ = "Andrea Tramacere"
 # eg copy
 # absolute import rg:from copy import deepcopy
 import  os
+import hashlib
+import tempfile
 from pathlib import Path
 from astropy.io import fits as pf
 from flask import request
 from werkzeug.utils import secure_filename
 import decorator
 
-from .hash import make_hash_file
+from .hash import file_hash_chunk_size
+
+# the umask can only be read by setting it, this is done once, before the threads serving the requests are started
+_umask = os.umask(0o022)
+os.umask(_umask)
 
 # Dependencies
 # eg numpy 
@@ -204,24 +210,63 @@ def upload_file(name, dir):
             return None
 
         filename = secure_filename(file.filename)
+        # the temporary directories are created when the first file is uploaded
+        os.makedirs(dir, exist_ok=True)
         file_path = os.path.join(dir, filename)
         file.save(file_path)
         return file_path
 
 
+def upload_hashed_file(name, dir):
+    """
+    streams the uploaded file to dir, computing the md5 hash of its content on the way,
+    and stores it under its hash, unless a file with the same content is already there.
+
+    Returns the hash, or None if no file was uploaded
+    """
+    if name not in request.files:
+        return None
+
+    file = request.files[name]
+    if file.filename == '' or file.filename is None:
+        return None
+
+    os.makedirs(dir, exist_ok=True)
+    file_hash = hashlib.md5()
+    temp_fd, temp_file_path = tempfile.mkstemp(prefix='.upload_', dir=dir)
+    try:
+        with os.fdopen(temp_fd, 'wb') as temp_file:
+            for chunk in iter(lambda: file.stream.read(file_hash_chunk_size), b''):
+                file_hash.update(chunk)
+                temp_file.write(chunk)
+
+        file_name = file_hash.hexdigest()
+        file_path = os.path.join(dir, file_name)
+        if os.path.exists(file_path):
+            # the files are content-addressed, the one already stored is kept
+            os.remove(temp_file_path)
+        else:
+            # mkstemp creates the file readable only by its owner,
+            # the stored files get the mode of the files created with the umask of the process
+            os.chmod(temp_file_path, 0o666 & ~_umask)
+            os.replace(temp_file_path, file_path)
+    except Exception:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+
+    return file_name
+
+
 def upload_files_request(request, upload_dir):
     uploaded_files_obj = {}
     if request.method == 'POST':
         for f in request.files:
             # TODO needed since those two files are extracted in a previous step
             if f != 'user_scw_list_file' and f != 'user_catalog_file':
-                f_path = upload_file(f, upload_dir)
-                if f_path is not None:
-                    file_hash = make_hash_file(f_path)
-                    new_file_name = file_hash
-                    new_file_path = os.path.join(upload_dir, new_file_name)
-                    uploaded_files_obj[f] = new_file_name
-                    os.rename(f_path, new_file_path)
+                file_hash = upload_hashed_file(f, upload_dir)
+                if file_hash is not None:
+                    uploaded_files_obj[f] = file_hash
     return uploaded_files_obj
 
 
@@ -1,4 +1,11 @@
+import io
 import os.path
+import time
+import uuid
+import hashlib
+import typing
+import threading
+import contextlib
 import psycopg2.extensions
 
 import numpy as np
@@ -7,7 +14,8 @@ import astropy.units as u
 
 from queryparser.adql import ADQLQueryTranslator
 from queryparser.exceptions import QuerySyntaxError
-from psycopg2 import connect, DatabaseError
+from psycopg2 import DatabaseError
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 
 from ..app_logging import app_logging
 from ..analysis.exceptions import RequestNotUnderstood
@@ -17,6 +25,22 @@ from astropy import constants
 
 logger = app_logging.getLogger('ivoa_helper')
 
+default_pool_max_connections = 5
+default_fetch_chunk_size = 1000
+pool_wait_timeout_s = 30
+
+_connection_pools = {}
+_connection_pools_semaphores = {}
+_connection_pools_lock = threading.Lock()
+
+default_metadata_cache_ttl_s = 300
+# touched to invalidate the tableset documents cached by all the worker processes
+metadata_cache_invalidation_file_name = '.tap_tables_invalidated'
+
+_metadata_cache = {}
+_metadata_cache_invalidation_time = None
+_metadata_cache_lock = threading.Lock()
+
 
 def map_psql_type_code_to_vo_datatype(type_code):
     type_db = psycopg2.extensions.string_types[type_code]
@@ -69,6 +93,7 @@ def run_metadata_query(**kwargs):
     vo_psql_pg_user = kwargs.get('vo_psql_pg_user', None)
     vo_psql_pg_password = kwargs.get('vo_psql_pg_password', None)
     vo_psql_pg_db = kwargs.get('vo_psql_pg_db', None)
+    vo_psql_pg_pool_max_connections = kwargs.get('vo_psql_pg_pool_max_connections', None)
     # following https://wiki.ivoa.net/internal/IVOA/VODataService/VODataService-v1.1wd.html
     xml_output_root = ET.Element('vod:tableset', {
         'xmlns:vod': 'http://www.ivoa.net/xml/VODataService/v1.1',
@@ -82,10 +107,67 @@ def run_metadata_query(**kwargs):
                                           vo_psql_pg_port=vo_psql_pg_port,
                                           vo_psql_pg_user=vo_psql_pg_user,
                                           vo_psql_pg_password=vo_psql_pg_password,
-                                          vo_psql_pg_db=vo_psql_pg_db)
+                                          vo_psql_pg_db=vo_psql_pg_db,
+                                          pool_max_connections=vo_psql_pg_pool_max_connections)
 
     return ET.tostring(xml_output_root, encoding='unicode')
 
+def get_metadata_cache_invalidation_time():
+    try:
+        invalidation_time = os.stat(metadata_cache_invalidation_file_name).st_mtime
+    except FileNotFoundError:
+        invalidation_time = None
+    with _metadata_cache_lock:
+        if _metadata_cache_invalidation_time is not None:
+            invalidation_time = max(invalidation_time or 0, _metadata_cache_invalidation_time)
+    return invalidation_time
+
+
+def invalidate_metadata_cache():
+    """
+    invalidates the cached tableset documents, of this process and of the other worker processes
+    """
+    global _metadata_cache_invalidation_time
+    with _metadata_cache_lock:
+        _metadata_cache_invalidation_time = time.time()
+    with open(metadata_cache_invalidation_file_name, 'a'):
+        os.utime(metadata_cache_invalidation_file_name)
+    logger.info('TAP tables metadata cache invalidated')
+
+
+def run_cached_metadata_query(metadata_cache_ttl_s=None, **kwargs) -> dict:
+    """
+    returns the tableset document of run_metadata_query, cached for metadata_cache_ttl_s seconds or until invalidated,
+    with its etag and the time it was last modified
+    """
+    if metadata_cache_ttl_s is None:
+        metadata_cache_ttl_s = default_metadata_cache_ttl_s
+
+    cache_key = tuple(kwargs.get(k, None) for k in ['vo_psql_pg_host', 'vo_psql_pg_port', 'vo_psql_pg_user',
+                                                    'vo_psql_pg_password', 'vo_psql_pg_db'])
+    invalidation_time = get_metadata_cache_invalidation_time()
+    with _metadata_cache_lock:
+        cached_metadata = _metadata_cache.get(cache_key)
+
+    now = time.time()
+    if cached_metadata is not None \
+            and now - cached_metadata['creation_time'] < metadata_cache_ttl_s \
+            and (invalidation_time is None or invalidation_time < cached_metadata['creation_time']):
+        return cached_metadata
+
+    tableset = run_metadata_query(**kwargs)
+    etag = hashlib.md5(tableset.encode()).hexdigest()
+    if cached_metadata is not None and cached_metadata['etag'] == etag:
+        last_modified = cached_metadata['last_modified']
+    else:
+        last_modified = now
+
+    metadata = dict(tableset=tableset, etag=etag, last_modified=last_modified, creation_time=now)
+    with _metadata_cache_lock:
+        _metadata_cache[cache_key] = metadata
+    return metadata
+
+
 def run_adql_query(query, **kwargs):
     parsed_query_obj = parse_adql_query(query)
 
@@ -96,26 +178,145 @@ def run_adql_query(query, **kwargs):
     vo_psql_pg_user = kwargs.get('vo_psql_pg_user', None)
     vo_psql_pg_password = kwargs.get('vo_psql_pg_password', None)
     vo_psql_pg_db = kwargs.get('vo_psql_pg_db', None)
+    vo_psql_pg_pool_max_connections = kwargs.get('vo_psql_pg_pool_max_connections', None)
+    vo_psql_pg_fetch_chunk_size = kwargs.get('vo_psql_pg_fetch_chunk_size', None)
     product_gallery_url = kwargs.get('product_gallery_url', None)
+    stream = kwargs.get('stream', False)
     result_query = run_query_from_product_gallery(psql_query,
                                                   vo_psql_pg_host=vo_psql_pg_host,
                                                   vo_psql_pg_port=vo_psql_pg_port,
                                                   vo_psql_pg_user=vo_psql_pg_user,
                                                   vo_psql_pg_password=vo_psql_pg_password,
                                                   vo_psql_pg_db=vo_psql_pg_db,
-                                                  product_gallery_url=product_gallery_url)
+                                                  product_gallery_url=product_gallery_url,
+                                                  pool_max_connections=vo_psql_pg_pool_max_connections,
+                                                  fetch_chunk_size=vo_psql_pg_fetch_chunk_size,
+                                                  stream=stream)
     return result_query
 
 
-def run_query_from_product_gallery(psql_query,
-                                   vo_psql_pg_host,
-                                   vo_psql_pg_port,
-                                   vo_psql_pg_user,
-                                   vo_psql_pg_password,
-                                   vo_psql_pg_db,
-                                   product_gallery_url=None
-                                   ):
-    connection = None
+def get_connection_pool(vo_psql_pg_host,
+                        vo_psql_pg_port,
+                        vo_psql_pg_user,
+                        vo_psql_pg_password,
+                        vo_psql_pg_db,
+                        pool_max_connections=None) -> typing.Tuple[ThreadedConnectionPool, threading.BoundedSemaphore]:
+    """
+    returns the pool of the connections to the product gallery database of the process,
+    with the semaphore bounding the number of connections lent
+    """
+    if pool_max_connections is None:
+        pool_max_connections = default_pool_max_connections
+
+    # the connections can not be inherited by forked processes
+    pool_key = (os.getpid(), vo_psql_pg_host, vo_psql_pg_port, vo_psql_pg_user, vo_psql_pg_password, vo_psql_pg_db)
+    with _connection_pools_lock:
+        connection_pool = _connection_pools.get(pool_key)
+        if connection_pool is None or connection_pool.closed:
+            connection_pool = ThreadedConnectionPool(0, pool_max_connections,
+                                                     host=vo_psql_pg_host,
+                                                     port=vo_psql_pg_port,
+                                                     database=vo_psql_pg_db,
+                                                     user=vo_psql_pg_user,
+                                                     password=vo_psql_pg_password)
+            _connection_pools_semaphores[pool_key] = threading.BoundedSemaphore(pool_max_connections)
+            _connection_pools[pool_key] = connection_pool
+            logger.info('Database connection pool created, with at most %s connections', pool_max_connections)
+        return connection_pool, _connection_pools_semaphores[pool_key]
+
+
+@contextlib.contextmanager
+def pooled_connection(vo_psql_pg_host,
+                      vo_psql_pg_port,
+                      vo_psql_pg_user,
+                      vo_psql_pg_password,
+                      vo_psql_pg_db,
+                      pool_max_connections=None):
+    """
+    lends a connection of the pool, waiting for one to be available, and gives it back
+    with the transaction rolled back, since the product gallery is only read
+    """
+    connection_pool, connection_pool_semaphore = get_connection_pool(vo_psql_pg_host,
+                                                                     vo_psql_pg_port,
+                                                                     vo_psql_pg_user,
+                                                                     vo_psql_pg_password,
+                                                                     vo_psql_pg_db,
+                                                                     pool_max_connections=pool_max_connections)
+    if not connection_pool_semaphore.acquire(timeout=pool_wait_timeout_s):
+        raise PoolError(f'no database connection available after {pool_wait_timeout_s} seconds')
+    try:
+        connection = connection_pool.getconn()
+        try:
+            yield connection
+        finally:
+            broken_connection = connection.closed != 0
+            if not broken_connection:
+                try:
+                    connection.rollback()
+                except DatabaseError as e:
+                    logger.warning(f"Error when releasing the database connection: {str(e)}")
+                    broken_connection = True
+            connection_pool.putconn(connection, close=broken_connection)
+    finally:
+        connection_pool_semaphore.release()
+
+
+def get_column_post_processing(column_name, datatype, product_gallery_url=None):
+    """
+    returns the function converting the values of a column of the query result to the ones of the VOTable
+    """
+    default_no_value = map_vo_type_to_vo_default_value(datatype)
+
+    if product_gallery_url is not None:
+        if column_name in {'file_uri', 'image_uri', 'access_url'}:
+            files_url = os.path.join(product_gallery_url, 'sites/default/files/')
+
+            def value_to_vo(value):
+                if isinstance(value, str):
+                    return ",".join(os.path.join(files_url, v.strip()) for v in value.split(','))
+                return default_no_value if value is None else value
+            return value_to_vo
+
+        if column_name in {'file_name', 'image_name'}:
+            def value_to_vo(value):
+                if isinstance(value, str):
+                    return ",".join(v.strip() for v in value.split(','))
+                return default_no_value if value is None else value
+            return value_to_vo
+
+        if column_name in {'path', 'path_alias', 'product_path'}:
+            def value_to_vo(value):
+                if isinstance(value, str):
+                    return os.path.join(product_gallery_url, value[1:] if value.startswith('/') else value)
+                return default_no_value if value is None else value
+            return value_to_vo
+
+    def value_to_vo(value):
+        return default_no_value if value is None else value
+    return value_to_vo
+
+
+def votable_xml(votable) -> str:
+    votable_xml_output = io.BytesIO()
+    votable.to_xml(votable_xml_output)
+    return votable_xml_output.getvalue().decode('utf-8')
+
+
+def rows_end_index(chunk_xml) -> int:
+    # start of the line closing the TABLEDATA
+    return chunk_xml.rindex('\n', 0, chunk_xml.rindex('</TABLEDATA>')) + 1
+
+
+def iter_votable_from_cursor(cursor, fetch_chunk_size, product_gallery_url=None):
+    """
+    fetches the result of the query executed by the cursor in chunks, and yields the VOTable serialization of the
+    result in pieces: the header with the rows of the first chunk, the rows of each next chunk, and the footer.
+    Each chunk is serialized by astropy, as a table with the same fields
+    """
+    columns_to_exclude = ['nid']
+
+    # with a server-side cursor, the description of the result is known after the first fetch
+    rows = cursor.fetchmany(fetch_chunk_size)
 
     # Create a new VOTable file with one resource and one table
     votable = VOTableFile()
@@ -124,92 +325,118 @@ def run_query_from_product_gallery(psql_query,
     table = Table(votable)
     resource.tables.append(table)
 
-    columns_to_exclude = ['nid']
-    indexes_to_exclude = []
+    columns = []
+    # loop over the description of the data result to define the fields of the output VOTable
+    for column_index, column in enumerate(cursor.description):
+        # purely drupal related, not related within the context of TAP
+        if column.name in columns_to_exclude:
+            continue
+        datatype = map_psql_type_code_to_vo_datatype(column.type_code)
+        f = Field(votable, ID=column.name, name=column.name, datatype=datatype, arraysize="*")
+        # TODO find a way to extract the column description from the DB
+        f.description = ''
+        f.values.null = map_vo_type_to_vo_default_value(datatype)
+        table.fields.append(f)
+        columns.append((column_index, column.name,
+                        get_column_post_processing(column.name, datatype, product_gallery_url=product_gallery_url)))
+
+    footer = None
+    while True:
+        table.create_arrays(len(rows))
+        if len(rows) > 0:
+            for column_index, column_name, value_to_vo in columns:
+                table.array[column_name] = [value_to_vo(row[column_index]) for row in rows]
+        chunk_xml = votable_xml(votable)
+
+        if footer is None:
+            if len(rows) == 0:
+                # empty result, without TABLEDATA
+                yield chunk_xml
+                return
+            footer_index = rows_end_index(chunk_xml)
+            footer = chunk_xml[footer_index:]
+            yield chunk_xml[:footer_index]
+        elif len(rows) > 0:
+            yield chunk_xml[chunk_xml.index('\n', chunk_xml.index('<TABLEDATA>')) + 1:rows_end_index(chunk_xml)]
+
+        if len(rows) < fetch_chunk_size:
+            break
+        rows = cursor.fetchmany(fetch_chunk_size)
+
+    yield footer
+
+
+def _iter_query_from_product_gallery(psql_query,
+                                     vo_psql_pg_host,
+                                     vo_psql_pg_port,
+                                     vo_psql_pg_user,
+                                     vo_psql_pg_password,
+                                     vo_psql_pg_db,
+                                     product_gallery_url=None,
+                                     pool_max_connections=None,
+                                     fetch_chunk_size=None):
+    if fetch_chunk_size is None:
+        fetch_chunk_size = default_fetch_chunk_size
 
     try:
-        with connect(
-            host=vo_psql_pg_host,
-            port=vo_psql_pg_port,
-            database=vo_psql_pg_db,
-            user=vo_psql_pg_user,
-            password=vo_psql_pg_password
-        ) as connection:
-            with connection.cursor() as cursor:
+        with pooled_connection(vo_psql_pg_host,
+                               vo_psql_pg_port,
+                               vo_psql_pg_user,
+                               vo_psql_pg_password,
+                               vo_psql_pg_db,
+                               pool_max_connections=pool_max_connections) as connection:
+            # server-side cursor, the result is kept by the server and fetched in chunks
+            with connection.cursor(name=f'tap_sync_{uuid.uuid4().hex}') as cursor:
+                cursor.itersize = fetch_chunk_size
                 cursor.execute(psql_query)
-                data = cursor.fetchall()
-                # loop over the description of the data result to define the fields of the output VOTable
-                for column_index, column in enumerate(cursor.description):
-                    # purely drupal related, not related within the context of TAP
-                    if column.name in columns_to_exclude:
-                        indexes_to_exclude.append(column_index)
-                        continue
-                    datatype = map_psql_type_code_to_vo_datatype(column.type_code)
-                    default_no_value = map_vo_type_to_vo_default_value(datatype)
-                    f = Field(votable, ID=column.name, name=column.name, datatype=datatype, arraysize="*")
-                    # TODO find a way to extract the column description from the DB
-                    f.description = ''
-                    f.values.null = default_no_value
-                    table.fields.append(f)
-                table.create_arrays(len(data))
-                for r_index, row in enumerate(data):
-                    table_row = list(row)
-                    table_entry = [""] * len(row)
-                    # for each column of a table_row
-                    for v_index, value in enumerate(table_row):
-                        # Get the column description and its corresponding datatype and default value in case of null in the DB
-                        # then create the field in the VOTable obj
-                        description = cursor.description[v_index]
-                        # purely drupal related, not related within the context of TAP
-                        if description.name in columns_to_exclude:
-                            continue
-                        table_entry[v_index] = value
-
-                        if product_gallery_url is not None:
-                            if description.name in {'file_uri', 'file_name', 'image_name', 'image_uri', 'access_url'} and value is not None and isinstance(value, str):
-                                value_list = [v.strip() for v in value.split(',')]
-                                if description.name == 'file_uri' or description.name == 'image_uri' or description.name == 'access_url':
-                                    for file_id, file_name in enumerate(value_list):
-                                        value_list[file_id] = os.path.join(product_gallery_url, 'sites/default/files/', file_name.strip())
-                                table_entry[v_index] = ",".join(value_list)
-                            if description.name in {'path', 'path_alias', 'product_path'} and value is not None and isinstance(value, str):
-                                if value.startswith('/'):
-                                    value = value[1:]
-                                table_entry[v_index] = os.path.join(product_gallery_url, value)
-
-                        datatype = map_psql_type_code_to_vo_datatype(description.type_code)
-                        default_no_value = map_vo_type_to_vo_default_value(datatype)
-                        if value is None:
-                            table_entry[v_index] = default_no_value
-
-                    # remove entry based on the index to excludes
-                    for index in indexes_to_exclude:
-                        del table_entry[index]
-
-                    table.array[r_index] = tuple(table_entry)
+                yield from iter_votable_from_cursor(cursor, fetch_chunk_size, product_gallery_url=product_gallery_url)
 
     except (Exception, DatabaseError) as e:
         logger.error(f"Error when querying to the Postgresql server: {str(e)}")
         raise e
 
-    finally:
-        if connection is not None:
-            cursor.close()
-            connection.close()
-            logger.info('Database connection closed')
 
+def _iter_started(first_chunk, chunks):
     try:
-        votable.to_xml('output.xml')
-        with open('output.xml', 'r') as f:
-            votable_xml_output = f.read()
-    except Exception as e:
-        logger.error(f"Error when writing the VOTable to XML: {str(e)}")
-        raise e
+        yield first_chunk
+        yield from chunks
     finally:
-        if os.path.exists('output.xml'):
-            os.remove('output.xml')
+        chunks.close()
+
+
+def run_query_from_product_gallery(psql_query,
+                                   vo_psql_pg_host,
+                                   vo_psql_pg_port,
+                                   vo_psql_pg_user,
+                                   vo_psql_pg_password,
+                                   vo_psql_pg_db,
+                                   product_gallery_url=None,
+                                   pool_max_connections=None,
+                                   fetch_chunk_size=None,
+                                   stream=False
+                                   ):
+    """
+    runs the query on the product gallery and returns the VOTable of the result,
+    or, with stream, an iterator over the pieces of its serialization.
+
+    The query is run, and the first chunk of the result fetched, before returning,
+    so that the errors of the query are raised here also with stream
+    """
+    chunks = _iter_query_from_product_gallery(psql_query,
+                                              vo_psql_pg_host,
+                                              vo_psql_pg_port,
+                                              vo_psql_pg_user,
+                                              vo_psql_pg_password,
+                                              vo_psql_pg_db,
+                                              product_gallery_url=product_gallery_url,
+                                              pool_max_connections=pool_max_connections,
+                                              fetch_chunk_size=fetch_chunk_size)
+    if not stream:
+        return "".join(chunks)
+
+    first_chunk = next(chunks)
+    return _iter_started(first_chunk, chunks)
 
-    return votable_xml_output
 
 def extract_metadata_from_product_gallery(xml_output_root,
                                           vo_psql_pg_host,
@@ -217,6 +444,7 @@ def extract_metadata_from_product_gallery(xml_output_root,
                                           vo_psql_pg_user,
                                           vo_psql_pg_password,
                                           vo_psql_pg_db,
+                                          pool_max_connections=None
                                           ):
     # gallery tables, views, and materialized views query
     tables_gallery_query = ("SELECT c.relnamespace::regnamespace::text AS table_schema, c.relname AS table_name, "
@@ -242,13 +470,12 @@ def extract_metadata_from_product_gallery(xml_output_root,
     columns_to_exclude = {'ivoa.obscore': 'nid'}
 
     try:
-        with connect(
-            host=vo_psql_pg_host,
-            port=vo_psql_pg_port,
-            database=vo_psql_pg_db,
-            user=vo_psql_pg_user,
-            password=vo_psql_pg_password
-        ) as connection:
+        with pooled_connection(vo_psql_pg_host,
+                               vo_psql_pg_port,
+                               vo_psql_pg_user,
+                               vo_psql_pg_password,
+                               vo_psql_pg_db,
+                               pool_max_connections=pool_max_connections) as connection:
             with connection.cursor() as cursor:
                 cursor.execute(tables_gallery_query)
                 data = cursor.fetchall()
@@ -312,12 +539,6 @@ def extract_metadata_from_product_gallery(xml_output_root,
         logger.error(f"Error when querying to the Postgresql server: {str(e)}")
         raise e
 
-    finally:
-        if connection is not None:
-            cursor.close()
-            connection.close()
-            logger.info('Database connection closed')
-
 
 def get_schema_element(table_set_element, schema_name):
     for schema_elem in table_set_element.findall('schema'):
@@ -25,10 +25,11 @@ from builtins import (bytes, str, open, super, range,
 
 
 __author__ = "Andrea Tramacere"
-import glob
+import fnmatch
 
 import json
 import  os
+import tempfile
 
 import logging
 
@@ -48,6 +49,10 @@ logger = logging.getLogger(__name__)
 # relative import eg: from .mod import f
 
 from ..analysis.io_helper import FilePath
+from ..analysis.job_registry import update_job_registry
+
+# summary of the job monitor files of a work dir, not matching job_monitor*
+job_monitor_summary_file_name = '.job_monitor_summary.json'
 
 
 class Job(object):
@@ -171,7 +176,7 @@ class Job(object):
             raise FileNotFoundError(f"no job_monitor.json found in {self.work_dir}")
         return last_modified_time
 
-    def updated_dataserver_monitor(self,):
+    def updated_dataserver_monitor(self, include_full_report_dict_list=True):
         # TODO: combine all files
         job_monitor_path = os.path.join(self.work_dir, 'job_monitor.json')
         try:
@@ -230,6 +235,8 @@ class Job(object):
             my_json_str = json.dumps(self.monitor)
             outfile.write(u'%s' % my_json_str)
 
+        update_job_registry(self.work_dir, status=self.monitor['status'])
+
     def get_call_back_url(self):
         if self.dispatcher_callback_url_base is not None:
             url = f'{self.dispatcher_callback_url_base}/{self.callback_handle}'
@@ -258,7 +265,7 @@ class Job(object):
         elif self.status == 'progress':
             query_new_status = 'progress'
         else:
-            job_monitor = self.updated_dataserver_monitor()
+            job_monitor = self.updated_dataserver_monitor(include_full_report_dict_list=False)
             if job_monitor['status'] == 'progress':
                 query_new_status = 'progress'
             else:
@@ -325,15 +332,91 @@ class OsaJob(Job):
                                   time_request=time_request)
 
 
-    def updated_dataserver_monitor(self,work_dir=None):
+    def _scan_job_files(self, work_dir):
+        job_files = {}
+        try:
+            with os.scandir(work_dir) as entries:
+                for entry in entries:
+                    if fnmatch.fnmatch(entry.name, 'job_monitor*.json'):
+                        try:
+                            stat = entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        job_files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+        except FileNotFoundError:
+            pass
+        return job_files
+
+    def _read_job_file_entry(self, job_file):
+        entry = dict(valid=False)
+        try:
+            with open(job_file, 'r') as infile:
+                try:
+                    monitor = json.load(infile)
+                except Exception as e:
+                    # happens in py3.9 at least
+                    infile.seek(0)
+                    monitor = json.load(infile)
+        except Exception:
+            return entry
+
+        if isinstance(monitor, dict):
+            # the list of the reports of the monitor of a previous update is not used
+            monitor.pop('full_report_dict_list', None)
+            entry['monitor'] = monitor
+            entry['valid'] = monitor.get('status') in self._allowed_job_status_values_
+        return entry
+
+    def _load_job_monitor_summary(self, work_dir):
+        """
+        returns the entries of the job monitor files, in the order they were written, parsing only the files
+        written since the summary cached in the work_dir was stored
+        """
+        summary_path = os.path.join(work_dir, job_monitor_summary_file_name)
+        try:
+            with open(summary_path) as f:
+                cached_entries = json.load(f)['job_files']
+        except (OSError, ValueError, KeyError, TypeError):
+            cached_entries = {}
+
+        job_files = self._scan_job_files(work_dir)
+
+        entries = {}
+        n_parsed = 0
+        for name, stat in job_files.items():
+            cached_entry = cached_entries.get(name)
+            if cached_entry is not None and cached_entry.get('stat') == stat:
+                entries[name] = cached_entry
+            else:
+                entries[name] = dict(self._read_job_file_entry(os.path.join(work_dir, name)), stat=stat)
+                n_parsed += 1
+
+        if n_parsed > 0 or entries.keys() != cached_entries.keys():
+            summary_tmp_path = None
+            try:
+                # a temporary file of its own, the summary can be stored by several threads at once
+                summary_tmp_fd, summary_tmp_path = tempfile.mkstemp(dir=work_dir,
+                                                                    prefix=job_monitor_summary_file_name + '.',
+                                                                    suffix='.tmp')
+                with os.fdopen(summary_tmp_fd, 'w') as f:
+                    json.dump(dict(job_files=entries), f)
+                os.replace(summary_tmp_path, summary_path)
+            except OSError as e:
+                logger.warning("unable to store the summary of the job monitor files in %s: %s", work_dir, repr(e))
+                if summary_tmp_path is not None and os.path.exists(summary_tmp_path):
+                    os.remove(summary_tmp_path)
+
+        logger.info("\033[33m found %s job log files in %s, %s of them parsed", len(job_files), work_dir, n_parsed)
+
+        return [entries[name] for name in sorted(entries, key=lambda name: (entries[name]['stat'][0], name))]
+
+    def updated_dataserver_monitor(self, work_dir=None, include_full_report_dict_list=True):
         if work_dir is None:
             work_dir=self.work_dir
         else:
             raise NotImplementedError
 
-        job_files_list = sorted(glob.glob(work_dir + '/job_monitor*.json'), key=os.path.getmtime)
-
-        logger.info("\033[33m found %s job log files in %s", len(job_files_list), work_dir)
+        job_file_entries = self._load_job_monitor_summary(work_dir)
 
         #print('OSA JOB get data server status form files',job_files_list)
         job_done=False
@@ -343,37 +426,30 @@ class OsaJob(Job):
 
         n_progress = 0
 
-        for job_file in job_files_list:
-            try:
-                with open(job_file, 'r') as infile:
-                    try:
-                        self.monitor = json.load(infile)
-                    except Exception as e:
-                        # happens in py3.9 at least
-                        infile.seek(0)
-                        self.monitor = json.load(infile)                    
-
-                    if self.monitor['status'] not in self._allowed_job_status_values_:
-                        raise Exception("not allowed status in file")
-                        #self.monitor['status']
-
-                    if self.monitor['status'] == 'done':
-                        job_done = True
-                    elif self.monitor['status'] == 'failed':
-                        job_failed = True
-
-                    if 'full_report_dict' in  self.monitor.keys():
-                        full_report_dict_list.append(self.monitor['full_report_dict'])
-
-                        if 'progressing' in self.monitor['full_report_dict'].keys():
-                            progress = True
-                            n_progress += 1
-
-            except Exception:
+        for entry in job_file_entries:
+            if 'monitor' in entry:
+                self.monitor = dict(entry['monitor'])
+
+            if not entry['valid']:
                 #TODO add sentry here
                 self.set_unaccessible()
+                continue
+
+            if self.monitor['status'] == 'done':
+                job_done = True
+            elif self.monitor['status'] == 'failed':
+                job_failed = True
+
+            if 'full_report_dict' in self.monitor.keys():
+                if include_full_report_dict_list:
+                    full_report_dict_list.append(self.monitor['full_report_dict'])
+
+                if isinstance(self.monitor['full_report_dict'], dict) and \
+                        'progressing' in self.monitor['full_report_dict'].keys():
+                    progress = True
+                    n_progress += 1
 
-        print(f"found {n_progress} PROGRESS entries in {len(job_files_list)} job_files ({work_dir}/job_monitor*.json)")
+        print(f"found {n_progress} PROGRESS entries in {len(job_file_entries)} job_files ({work_dir}/job_monitor*.json)")
 
         if progress:
             self.monitor['status'] = 'progress'
@@ -384,7 +460,8 @@ class OsaJob(Job):
         if job_failed:
             self.monitor['status'] = 'failed'
 
-        self.monitor['full_report_dict_list']=full_report_dict_list
+        if include_full_report_dict_list:
+            self.monitor['full_report_dict_list']=full_report_dict_list
         print('\033[32mfinal status', self.monitor['status'], '\033[0m')
         return self.monitor
 
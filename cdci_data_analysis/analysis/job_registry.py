@@ -0,0 +1,375 @@
+"""
+Persistent index of the scratch directories created by the dispatcher.
+
+Each scratch directory is recorded with its job_id, session_id, the user
+(``sub`` claim of the token) who submitted it, the latest job status and the
+time of the latest update. Inspection and clean-up can then select the
+directories of interest with an index lookup, instead of listing and reading
+every scratch directory.
+
+The index is a SQLite database stored in the working directory of the dispatcher,
+next to the scratch directories, and can be shared by several worker processes. It uses the rollback journal,
+which only relies on the file locks: when the working directory is on a network filesystem shared by several hosts,
+the filesystem has to support the POSIX locks (e.g. NFS with the lock manager), otherwise the dispatchers sharing
+the directory must run on a single host.
+
+The scratch directories created before the index are indexed by a full rebuild, done in a single transaction
+when the dispatcher starts, or with:
+
+    python -m cdci_data_analysis.analysis.job_registry [--wd WD]
+
+which records that the index is populated. Until then, the lookups list the working directory instead.
+"""
+
+import os
+import re
+import json
+import time
+import fcntl
+import sqlite3
+import argparse
+import threading
+
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('job_registry')
+
+default_registry_file_name = '.job_registry.sqlite'
+
+# the mtime stored in the index is the time of the last update by the dispatcher,
+# the scratch directory can still be modified shortly after (e.g. when the temporary directory is removed)
+mtime_tolerance_s = 3600
+
+scratch_dir_pattern = re.compile(
+    r"scratch_sid_(?P<session_id>[A-Z0-9]{16})_jid_(?P<job_id>[a-z0-9]{16})(?P<aliased_marker>_aliased|)$")
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    scratch_dir TEXT PRIMARY KEY,
+    job_id TEXT NOT NULL,
+    session_id TEXT,
+    aliased INTEGER NOT NULL DEFAULT 0,
+    sub TEXT,
+    status TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id);
+CREATE INDEX IF NOT EXISTS jobs_session_id ON jobs (session_id);
+CREATE INDEX IF NOT EXISTS jobs_sub ON jobs (sub);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_mtime ON jobs (mtime);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def parse_scratch_dir_name(scratch_dir):
+    return scratch_dir_pattern.match(os.path.basename(os.path.normpath(scratch_dir)))
+
+
+def get_token_sub(token):
+    if token in [None, "", "None"]:
+        return None
+    from . import tokenHelper
+    try:
+        decoded_token = tokenHelper.get_decoded_token(token, secret_key=None, validate_token=False)
+    except Exception as e:
+        logger.warning("unable to extract the sub from the token: %s", repr(e))
+        return None
+    return decoded_token.get('sub')
+
+
+class JobRegistry:
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = default_registry_file_name
+        self.db_path = os.path.abspath(db_path)
+        self._local = threading.local()
+        self._populated = False
+
+    def _connection(self):
+        # sqlite connections can not be shared across threads nor inherited by forked processes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            # the write-ahead log needs memory shared by the processes, not available on a network filesystem:
+            # the rollback journal only relies on the file locks (and converts the databases in WAL mode)
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.executescript(_schema)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    @staticmethod
+    def _key(scratch_dir):
+        return os.path.normpath(os.path.relpath(scratch_dir))
+
+    def update(self, scratch_dir, sub=None, status=None, mtime=None):
+        r = parse_scratch_dir_name(scratch_dir)
+        if r is None:
+            logger.debug("%s is not a scratch directory, not indexed", scratch_dir)
+            return
+
+        if mtime is None:
+            mtime = time.time()
+
+        # sub and status are only overwritten when provided
+        self._connection().execute(
+            "INSERT INTO jobs (scratch_dir, job_id, session_id, aliased, sub, status, mtime) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(scratch_dir) DO UPDATE SET "
+            "sub = COALESCE(excluded.sub, jobs.sub), "
+            "status = COALESCE(excluded.status, jobs.status), "
+            "mtime = MAX(excluded.mtime, jobs.mtime)",
+            (self._key(scratch_dir), r.group('job_id'), r.group('session_id'),
+             int(r.group('aliased_marker') != ''), sub, status, mtime))
+
+    def remove(self, scratch_dir):
+        self._connection().execute("DELETE FROM jobs WHERE scratch_dir = ?", (self._key(scratch_dir),))
+
+    def find(self, job_id=None, job_id_prefix=None, session_id=None, sub=None, status=None, min_mtime=None, max_mtime=None,
+             order_by='mtime', after=None, after_job_id=None, limit=None):
+        """
+        after and after_job_id select the entries following a given (job_id, scratch_dir) or job_id,
+        and are meant to be used with order_by='job_id'
+        """
+        conditions = []
+        values = []
+        if job_id is not None:
+            conditions.append("job_id = ?")
+            values.append(job_id)
+        if job_id_prefix is not None:
+            conditions.append("job_id GLOB ?")
+            values.append(re.sub(r'[\[\]*?]', '', job_id_prefix) + '*')
+        if session_id is not None:
+            conditions.append("session_id = ?")
+            values.append(session_id)
+        if sub is not None:
+            conditions.append("sub = ?")
+            values.append(sub)
+        if status is not None:
+            conditions.append("status = ?")
+            values.append(status)
+        if min_mtime is not None:
+            conditions.append("mtime >= ?")
+            values.append(min_mtime)
+        if max_mtime is not None:
+            conditions.append("mtime < ?")
+            values.append(max_mtime)
+        if after is not None:
+            conditions.append("(job_id, scratch_dir) > (?, ?)")
+            values.extend([after[0], self._key(after[1])])
+        if after_job_id is not None:
+            conditions.append("job_id > ?")
+            values.append(after_job_id)
+
+        query = "SELECT * FROM jobs"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        if order_by == 'mtime':
+            query += " ORDER BY mtime"
+        elif order_by == 'job_id':
+            query += " ORDER BY job_id, scratch_dir"
+        else:
+            raise ValueError(f"unsupported order_by {order_by}")
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(limit)
+
+        return [dict(row) for row in self._connection().execute(query, values)]
+
+    def iter_find(self, chunk_size=500, after=None, after_job_id=None, **filters):
+        """
+        iterates over the entries ordered by job_id, fetching them in chunks
+        """
+        while True:
+            entries = self.find(order_by='job_id', after=after, after_job_id=after_job_id, limit=chunk_size, **filters)
+            yield from entries
+            if len(entries) < chunk_size:
+                break
+            after = (entries[-1]['job_id'], entries[-1]['scratch_dir'])
+            after_job_id = None
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def is_populated(self) -> bool:
+        """
+        whether a full rebuild of the index has completed
+        """
+        if not self._populated:
+            row = self._connection().execute("SELECT value FROM meta WHERE key = 'populated'").fetchone()
+            self._populated = row is not None
+        return self._populated
+
+    def rebuild(self, wd='.'):
+        """
+        index all the scratch directories found in wd, reading the sub and the status from their content,
+        and records that the index is populated
+        """
+        # both the flat and the sharded layouts
+        from .scratch_layout import iter_scratch_dir_entries
+
+        rows = []
+        for entry in iter_scratch_dir_entries(wd):
+            if not entry.is_dir() or parse_scratch_dir_name(entry.name) is None:
+                continue
+            scratch_dir = entry.path
+            sub = None
+            status = None
+            try:
+                with open(os.path.join(scratch_dir, 'analysis_parameters.json')) as analysis_parameters_file:
+                    sub = get_token_sub(json.load(analysis_parameters_file).get('token'))
+            except (OSError, ValueError):
+                pass
+            try:
+                with open(os.path.join(scratch_dir, 'job_monitor.json')) as job_monitor_file:
+                    status = json.load(job_monitor_file).get('status')
+            except (OSError, ValueError):
+                pass
+            r = parse_scratch_dir_name(entry.name)
+            rows.append((self._key(scratch_dir), r.group('job_id'), r.group('session_id'),
+                         int(r.group('aliased_marker') != ''), sub, status, entry.stat().st_mtime))
+
+        # all at once, so that an interrupted rebuild leaves the index not populated;
+        # the entries updated by the dispatcher in the meantime are more recent, and kept
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany(
+                "INSERT INTO jobs (scratch_dir, job_id, session_id, aliased, sub, status, mtime) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(scratch_dir) DO NOTHING",
+                rows)
+            connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('populated', ?)", (str(time.time()),))
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        self._populated = True
+
+        logger.info("indexed %s scratch directories from %s", len(rows), wd)
+        return len(rows)
+
+    def ensure_populated(self, wd='.') -> bool:
+        """
+        rebuilds the index if it is not populated, unless another process is rebuilding it,
+        and returns whether it is populated
+        """
+        if self.is_populated():
+            return True
+
+        with open(self.db_path + '.rebuild.lock', 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info("the job registry %s is being rebuilt by another process", self.db_path)
+                return False
+            # possibly rebuilt in the meantime
+            if not self.is_populated():
+                self.rebuild(wd)
+        return True
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_job_registry(db_path=None) -> JobRegistry:
+    if db_path is None:
+        db_path = default_registry_file_name
+    db_path = os.path.abspath(db_path)
+    with _registries_lock:
+        if db_path not in _registries:
+            _registries[db_path] = JobRegistry(db_path)
+        return _registries[db_path]
+
+
+def update_job_registry(scratch_dir, sub=None, status=None, token=None):
+    # the index is an optimization, failing to update it should never fail a request
+    try:
+        if sub is None and token is not None:
+            sub = get_token_sub(token)
+        get_job_registry().update(scratch_dir, sub=sub, status=status)
+    except Exception as e:
+        logger.warning("unable to update the job registry for %s: %s", scratch_dir, repr(e))
+
+
+def remove_from_job_registry(scratch_dir):
+    try:
+        get_job_registry().remove(scratch_dir)
+    except Exception as e:
+        logger.warning("unable to remove %s from the job registry: %s", scratch_dir, repr(e))
+
+
+def is_job_registry_populated() -> bool:
+    try:
+        return get_job_registry().is_populated()
+    except Exception as e:
+        logger.warning("unable to read the job registry: %s", repr(e))
+        return False
+
+
+def populate_job_registry(wd='.'):
+    try:
+        get_job_registry().ensure_populated(wd)
+    except Exception as e:
+        logger.warning("unable to populate the job registry: %s", repr(e))
+
+
+def start_job_registry_population(wd='.'):
+    """
+    populates the job registry in background, not to delay the start of the dispatcher
+    """
+    if is_job_registry_populated():
+        return
+    threading.Thread(target=populate_job_registry, args=(wd,), name='job-registry-population', daemon=True).start()
+
+
+def iter_scan(wd='.', job_id_prefix=None, min_mtime=None, after=None, after_job_id=None):
+    """
+    iterates over the scratch directories of wd, as the entries of JobRegistry.iter_find without sub and status,
+    listing wd: the lookups are done this way until the index is populated
+    """
+    from .scratch_layout import iter_scratch_dir_entries
+
+    entries = []
+    for entry in iter_scratch_dir_entries(wd):
+        r = parse_scratch_dir_name(entry.name)
+        if r is None or not entry.is_dir():
+            continue
+        if job_id_prefix is not None and not r.group('job_id').startswith(job_id_prefix):
+            continue
+        scratch_dir = JobRegistry._key(entry.path)
+        if after is not None and (r.group('job_id'), scratch_dir) <= (after[0], JobRegistry._key(after[1])):
+            continue
+        if after_job_id is not None and r.group('job_id') <= after_job_id:
+            continue
+        mtime = entry.stat().st_mtime
+        if min_mtime is not None and mtime < min_mtime:
+            continue
+        entries.append(dict(scratch_dir=scratch_dir, job_id=r.group('job_id'), session_id=r.group('session_id'),
+                            aliased=int(r.group('aliased_marker') != ''), sub=None, status=None, mtime=mtime))
+
+    return iter(sorted(entries, key=lambda e: (e['job_id'], e['scratch_dir'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="indexes the scratch directories in the job registry")
+    parser.add_argument('--wd', type=str, default='.', help='the working directory of the dispatcher')
+    args = parser.parse_args(argv)
+
+    app_logging.setup()
+
+    # the job registry is the one of the working directory
+    os.chdir(args.wd)
+    n_indexed = get_job_registry().rebuild()
+    print(f"{n_indexed} scratch directories indexed")
+
+
+if __name__ == '__main__':
+    main()
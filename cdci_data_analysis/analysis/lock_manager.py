@@ -0,0 +1,240 @@
+"""
+Locks of the creation of the scratch directories of the jobs.
+
+A lock is an exclusive flock on a lock file .lock_<job_id>, created next to the scratch directory of the job
+(in its shard with the sharded layout), shared by the threads and the worker processes of the dispatcher.
+The acquisition blocks until the lock is released by its holder, or until a timeout, and the lock file is removed
+when the lock is released: the holder which finds the lock file of the lock it acquired removed, or replaced,
+by the previous holder acquires it again.
+
+The blocking flock is waited for in a thread, which is left waiting after a timeout, and taken over by the next
+acquisition of the same lock in the process. Beyond a maximum number of such waiting threads in the process,
+the acquisitions fail right away, rather than piling up threads and file descriptors behind a stuck holder.
+
+The contention is recorded in the request counters (lock waits, timeouts and their total wait time),
+and per job, for the last jobs, so that the aliasing storms can be seen in /request-counters.
+The same locks serialize the processing of the callbacks of a job (see call_back_journal).
+"""
+
+import os
+import time
+import fcntl
+import threading
+import contextlib
+import collections
+import typing
+
+from . import request_counters
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('lock_manager')
+
+
+class LockTimeout(Exception):
+    pass
+
+
+def get_lock_file_name(job_id) -> str:
+    return f'.lock_{job_id}'
+
+
+class _BlockingFlock(threading.Thread):
+    """
+    blocks on the flock of fd in a thread, so that the wait can be given up after a timeout, and taken over
+    by another acquisition: if given up, and not taken over, the flock is released as soon as acquired
+    """
+
+    def __init__(self, fd, on_done):
+        super().__init__(daemon=True)
+        self.fd = fd
+        self.acquired = threading.Event()
+        self._on_done = on_done
+        self._abandoned = False
+        self._done = False
+        self._state_lock = threading.Lock()
+
+    def run(self):
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except OSError as e:
+            logger.warning("unable to lock the file descriptor %s: %s", self.fd, repr(e))
+            with self._state_lock:
+                self._done = True
+                os.close(self.fd)
+        else:
+            with self._state_lock:
+                self._done = True
+                if self._abandoned:
+                    os.close(self.fd)
+                else:
+                    self.acquired.set()
+        self._on_done(self)
+
+    def wait(self, timeout) -> bool:
+        self.acquired.wait(timeout)
+        with self._state_lock:
+            if self.acquired.is_set():
+                return True
+            self._abandoned = True
+            return False
+
+    def take_over(self) -> bool:
+        """
+        takes over the wait given up by another acquisition, if still waiting
+        """
+        with self._state_lock:
+            if not self._abandoned or self._done:
+                return False
+            self._abandoned = False
+            return True
+
+
+class LockManager:
+
+    def __init__(self, timeout_s=10., n_max_jobs_contention=1024, name='scratch_dir_lock', n_max_waiters=64):
+        self.timeout_s = timeout_s
+        # the prefix of the request counters
+        self.name = name
+        self.n_max_jobs_contention = n_max_jobs_contention
+        self.n_max_waiters = n_max_waiters
+        self._jobs_contention = collections.OrderedDict()
+        self._jobs_contention_lock = threading.Lock()
+        self._waiters = {}
+        self._waiters_lock = threading.Lock()
+
+    def get_n_waiters(self) -> int:
+        """
+        returns the number of threads of the process waiting for a lock, including the ones given up
+        """
+        with self._waiters_lock:
+            return sum(len(lock_file_waiters) for lock_file_waiters in self._waiters.values())
+
+    def _take_over_waiter(self, lock_file) -> typing.Optional[_BlockingFlock]:
+        with self._waiters_lock:
+            for waiter in self._waiters.get(lock_file, []):
+                if waiter.take_over():
+                    return waiter
+        return None
+
+    def _start_waiter(self, lock_file, fd) -> _BlockingFlock:
+        with self._waiters_lock:
+            if sum(len(lock_file_waiters) for lock_file_waiters in self._waiters.values()) >= self.n_max_waiters:
+                os.close(fd)
+                raise LockTimeout(f"{self.n_max_waiters} threads already waiting for a lock, "
+                                  f"not waiting for {lock_file}")
+            waiter = _BlockingFlock(fd, on_done=lambda w: self._remove_waiter(lock_file, w))
+            self._waiters.setdefault(lock_file, []).append(waiter)
+        waiter.start()
+        return waiter
+
+    def _remove_waiter(self, lock_file, waiter):
+        with self._waiters_lock:
+            lock_file_waiters = self._waiters.get(lock_file, [])
+            if waiter in lock_file_waiters:
+                lock_file_waiters.remove(waiter)
+            if len(lock_file_waiters) == 0:
+                self._waiters.pop(lock_file, None)
+
+    def _acquire_fd(self, lock_file, deadline) -> int:
+        while True:
+            waiter = self._take_over_waiter(lock_file)
+            if waiter is None:
+                fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    waiter = self._start_waiter(lock_file, fd)
+                except Exception:
+                    os.close(fd)
+                    raise
+
+            if waiter is not None:
+                if not waiter.wait(max(deadline - time.time(), 0)):
+                    # the file descriptor is closed by the waiter, unless taken over
+                    raise LockTimeout(f"timeout while waiting for the lock {lock_file}")
+                fd = waiter.fd
+
+            # the lock file can have been removed, with the release of the lock, in the meantime
+            try:
+                if os.stat(lock_file).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def lock(self, job_id, lock_dir='.', timeout_s=None):
+        """
+        holds the lock of the job, and raises LockTimeout if not acquired within timeout_s
+        """
+        if timeout_s is None:
+            timeout_s = self.timeout_s
+
+        lock_file = os.path.join(lock_dir, get_lock_file_name(job_id))
+        t0 = time.time()
+        try:
+            fd = self._acquire_fd(lock_file, deadline=t0 + timeout_s)
+        except LockTimeout:
+            self._record_contention(job_id, time.time() - t0, timed_out=True)
+            raise
+
+        wait_s = time.time() - t0
+        self._record_contention(job_id, wait_s, timed_out=False)
+
+        try:
+            yield lock_file
+        finally:
+            try:
+                os.remove(lock_file)
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _record_contention(self, job_id, wait_s, timed_out):
+        request_counters.increment(f'{self.name}_acquired' if not timed_out else f'{self.name}_timeouts')
+        # waits of at least a millisecond are counted as contention
+        if wait_s < 1e-3 and not timed_out:
+            return
+
+        request_counters.increment(f'{self.name}_waits')
+        request_counters.increment(f'{self.name}_wait_ms', int(wait_s * 1000))
+
+        with self._jobs_contention_lock:
+            job_contention = self._jobs_contention.pop(job_id, None)
+            if job_contention is None:
+                job_contention = dict(n_waits=0, n_timeouts=0, wait_s=0., max_wait_s=0.)
+            job_contention['n_waits'] += 1
+            job_contention['n_timeouts'] += int(timed_out)
+            job_contention['wait_s'] += wait_s
+            job_contention['max_wait_s'] = max(job_contention['max_wait_s'], wait_s)
+            self._jobs_contention[job_id] = job_contention
+            while len(self._jobs_contention) > self.n_max_jobs_contention:
+                self._jobs_contention.popitem(last=False)
+
+        if timed_out:
+            logger.warning("timeout after waiting %.3f s for the %s of %s", wait_s, self.name, job_id)
+
+    def get_jobs_contention(self) -> typing.Dict[str, dict]:
+        """
+        returns the waits and timeouts of the locks of the last contended jobs
+        """
+        with self._jobs_contention_lock:
+            return {job_id: dict(job_contention) for job_id, job_contention in self._jobs_contention.items()}
+
+
+_lock_manager = None
+_lock_manager_lock = threading.Lock()
+
+
+def configure_lock_manager(disp_conf):
+    global _lock_manager
+    with _lock_manager_lock:
+        _lock_manager = LockManager(timeout_s=disp_conf.scratch_dir_lock_timeout_s)
+
+
+def get_lock_manager() -> LockManager:
+    global _lock_manager
+    with _lock_manager_lock:
+        if _lock_manager is None:
+            _lock_manager = LockManager()
+        return _lock_manager
@@ -2,21 +2,20 @@ import html
 import time as time_
 import os
 import requests
-import glob
 import json
 import re
 import typing
 
-from ..analysis import tokenHelper
+from ..analysis import tokenHelper, template_helper, notification_ledger
 from ..analysis.email_helper import humanize_age, humanize_future, wrap_python_code
 from ..analysis.exceptions import BadRequest, MissingRequestParameter
 from ..analysis.hash import make_hash
+from ..analysis.job_registry import update_job_registry
 from ..analysis.time_helper import validate_time
 from ..flask_app.sentry import sentry
 from ..app_logging import app_logging
 
 from datetime import datetime
-from jinja2 import Environment, FileSystemLoader
 from bs4 import BeautifulSoup
 from urllib import parse
 
@@ -42,6 +41,13 @@ def timestamp2isot(timestamp_or_string: typing.Union[str, float]):
     return timestamp_or_string
 
 
+template_helper.register_template_environment('matrix',
+                                               ['matrix_message.html', 'incident_report_matrix_message.html'],
+                                               filters=dict(timestamp2isot=timestamp2isot,
+                                                            humanize_age=humanize_age,
+                                                            humanize_future=humanize_future))
+
+
 def textify_matrix_message(html):
     html = re.sub('<a href=(.*?)>(.*?)</a>', r'\2: \1', html)
 
@@ -55,35 +61,18 @@ def textify_matrix_message(html):
 
 
 def get_first_submitted_matrix_message_time(scratch_dir):
-    first_submitted_matrix_message_time = None
-    submitted_matrix_message_pattern = os.path.join(
-        scratch_dir,
-        'matrix_message_history',
-        'matrix_message_submitted_*.json'
-    )
-    submitted_matrix_message_files = sorted(glob.glob(submitted_matrix_message_pattern), key=os.path.getmtime)
-    matrix_helper_logger.info(f"get_first_submitted_matrix_message_time, files: {submitted_matrix_message_files}")
-    if len(submitted_matrix_message_files) >= 1:
-        f_name, f_ext = os.path.splitext(os.path.basename(submitted_matrix_message_files[0]))
-        f_name_split = f_name.split('_')
-        if len(f_name_split) == 5:
-            try:
-                validate_time(f_name_split[4])
-                first_submitted_matrix_message_time = float(f_name_split[4])
-            except (ValueError, OverflowError, TypeError, OSError) as e:
-                matrix_helper_logger.warning(f'Error when extracting the time of the first message submitted via matrix.'
-                               f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
-                first_submitted_matrix_message_time = None
-                sentry.capture_message(f'Error when extracting the time of the first message submitted via matrix.'
-                               f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
-        else:
-            matrix_helper_logger.warning(f'Error when extracting the time of the first message submitted via matrix: '
-                           f'the name of the message file has been found not properly formatted, therefore, '
-                           f'the time of the first message submitted via matrix could not be extracted.')
+    first_submitted_matrix_message_time = notification_ledger.get_notification_summary(scratch_dir, 'matrix', 'submitted').first_submitted_time
+    matrix_helper_logger.info(f"get_first_submitted_matrix_message_time: {first_submitted_matrix_message_time}")
+    if first_submitted_matrix_message_time is not None:
+        try:
+            validate_time(first_submitted_matrix_message_time)
+            first_submitted_matrix_message_time = float(first_submitted_matrix_message_time)
+        except (ValueError, OverflowError, TypeError, OSError) as e:
+            matrix_helper_logger.warning(f'Error when extracting the time of the first message submitted via matrix.'
+                           f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
             first_submitted_matrix_message_time = None
-            sentry.capture_message(f'Error when extracting the time of the first message submitted via matrix: '
-                           f'the name of the message file has been found not properly formatted, therefore, '
-                           f'the time of the first message submitted via matrix could not be extracted.')
+            sentry.capture_message(f'Error when extracting the time of the first message submitted via matrix.'
+                           f'The value extracted {first_submitted_matrix_message_time} raised the following error:\n{e}')
 
     return first_submitted_matrix_message_time
 
@@ -100,11 +89,6 @@ def send_incident_report_message(
 
     sending_time = time_.time()
 
-    env = Environment(loader=FileSystemLoader('%s/../flask_app/templates/' % os.path.dirname(__file__)))
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
     matrix_server_url = config.matrix_server_url
 
     incident_report_receivers_room_ids = config.matrix_incident_report_receivers_room_ids
@@ -120,7 +104,7 @@ def send_incident_report_message(
         'content': incident_content
     }
 
-    template = env.get_template('incident_report_matrix_message.html')
+    template = template_helper.get_template('matrix', 'incident_report_matrix_message.html')
     message_body_html = template.render(**matrix_message_data)
     message_text = textify_matrix_message(message_body_html)
 
@@ -183,7 +167,8 @@ def send_job_message(
         time_request=None,
         request_url="",
         api_code="",
-        scratch_dir=None):
+        scratch_dir=None,
+        outbox=None):
     sending_time = time_.time()
 
     status_details_message = None
@@ -243,13 +228,7 @@ def send_job_message(
         }
     }
 
-    env = Environment(loader=FileSystemLoader(f'{os.path.dirname(__file__)}/../flask_app/templates/'))
-
-    env.filters['timestamp2isot'] = timestamp2isot
-    env.filters['humanize_age'] = humanize_age
-    env.filters['humanize_future'] = humanize_future
-
-    template = env.get_template('matrix_message.html')
+    template = template_helper.get_template('matrix', 'matrix_message.html')
     message_body_html = template.render(**matrix_message_data)
     message_text = textify_matrix_message(message_body_html)
     res_content = {
@@ -257,6 +236,23 @@ def send_job_message(
         'res_content_bcc_users_failed': []
     }
 
+    if outbox is not None:
+        # delivered in the background, which also stores it in the matrix message history once sent
+        if receiver_room_id is None or receiver_room_id == "":
+            logger.warning('a matrix message could not be sent to the token user as no personal room id was '
+                           'provided within the token')
+            receiver_room_id = None
+        res_content['outbox_record_id'] = outbox.enqueue_matrix_message(
+            message_text,
+            message_body_html,
+            receiver_room_id,
+            [room_id for room_id in bcc_receivers_room_ids if room_id is not None and room_id != ""],
+            status,
+            scratch_dir,
+            sending_time=sending_time,
+            first_submitted_time=time_request)
+        return res_content
+
     message_data = {
         'message_data_bcc_users': []
     }
@@ -322,6 +318,7 @@ def join_room(
         url_server=None,
         sender_access_token=None,
         room_id=None,
+        session=None,
 ):
     logger.info(f"Joining room wth id: {room_id}")
     url = os.path.join(url_server, f'_matrix/client/v3/rooms/{room_id}/join')
@@ -331,7 +328,7 @@ def join_room(
         'Content-type': 'application/json'
     }
 
-    res = requests.post(url, headers=headers)
+    res = (session or requests).post(url, headers=headers)
 
     msg_response_data = None
     if res.status_code in [403, 429]:
@@ -362,6 +359,7 @@ def send_message(
         room_id=None,
         message_text=None,
         message_body_html=None,
+        session=None,
 ):
     logger.info(f"Sending message to the room id: {room_id}")
     url = os.path.join(url_server, f'_matrix/client/r0/rooms/{room_id}/send/m.room.message')
@@ -378,7 +376,7 @@ def send_message(
         'msgtype': 'm.text'
     }
 
-    res = requests.post(url, json=message_data, headers=headers)
+    res = (session or requests).post(url, json=message_data, headers=headers)
 
     if res.status_code not in [200, 201, 204]:
         try:
@@ -459,30 +457,14 @@ def is_message_to_send_run_query(logger, status, time_original_request, scratch_
         log_additional_info_obj[
             'matrix_message_sending_job_submitted_interval'] = f'{matrix_message_sending_job_submitted_interval}, {info_parameter}'
 
-        matrix_message_history_dir = os.path.join(scratch_dir, 'matrix_message_history')
-        matrix_helper_logger.info("matrix_message_history_dir: %s", matrix_message_history_dir)
-
-        matrix_message_history_dirs_same_job_id = f"scratch_*_{job_id}*/matrix_message_history"
-        matrix_helper_logger.info("matrix_message_history_dirs_same_job_id: %s", matrix_message_history_dirs_same_job_id)
-
-        # find all
-        submitted_matrix_message_pattern = os.path.join(
-            matrix_message_history_dirs_same_job_id,
-            'matrix_message_submitted_*.json'
-        )
-        submitted_matrix_message_files = glob.glob(submitted_matrix_message_pattern)
+        submitted_matrix_messages_summary = notification_ledger.get_job_notification_summary(job_id, 'matrix', 'submitted',
+                                                                                             scratch_dir=scratch_dir)
+        submitted_matrix_message_files = submitted_matrix_messages_summary.file_names
         logger.info("submitted_matrix_message_files: %s as %s", len(submitted_matrix_message_files), submitted_matrix_message_files)
         log_additional_info_obj['submitted_matrix_message_files'] = submitted_matrix_message_files
 
-        if len(submitted_matrix_message_files) >= 1:
-            times = []
-            for f in submitted_matrix_message_files:
-                f_name, f_ext = os.path.splitext(os.path.basename(f))
-                if f_ext == '.json' and f_name:
-                    times.append(float(f_name.split('_')[3]))
-
-            time_last_matrix_message_submitted_sent = max(times)
-            time_from_last_submitted_matrix_message = time_check - float(time_last_matrix_message_submitted_sent)
+        if submitted_matrix_messages_summary.last_sending_time is not None:
+            time_from_last_submitted_matrix_message = time_check - submitted_matrix_messages_summary.last_sending_time
             interval_ok = time_from_last_submitted_matrix_message > matrix_message_sending_job_submitted_interval
 
         logger.info("interval_ok: %s", interval_ok)
@@ -566,7 +548,8 @@ def is_message_to_send_callback(logger, status, time_original_request, scratch_d
             logger.info("matrix_message_sending_timeout and duration_query > timeout_threshold_matrix_message %s",
                         matrix_message_sending_timeout and duration_query > timeout_threshold_matrix_message)
 
-            done_matrix_message_files = glob.glob(f'scratch_*_jid_{job_id}*/matrix_message_history/matrix_message_done_*')
+            done_matrix_message_files = notification_ledger.get_job_notification_summary(job_id, 'matrix', 'done',
+                                                                                         scratch_dir=scratch_dir).file_names
             log_additional_info_obj['done_matrix_message_files'] = done_matrix_message_files
             if len(done_matrix_message_files) >= 1:
                 logger.info("the message cannot be sent via matrix because the number of done messages sent is too high: %s", len(done_matrix_message_files))
@@ -675,6 +658,11 @@ def store_status_matrix_message_info(message, status, scratch_dir, logger, sendi
     with open(os.path.join(matrix_message_history_folder, matrix_message_file_name), 'w+') as outfile:
         outfile.write(json.dumps(message, indent=4))
 
+    notification_ledger.record_notification(scratch_dir, 'matrix', status, sending_time, first_submitted_time,
+                                            matrix_message_file_name)
+
+    update_job_registry(scratch_dir)
+
 
 def store_incident_report_matrix_message(message, scratch_dir, sending_time=None):
     matrix_message_history_folder_path = os.path.join(scratch_dir, 'matrix_message_history')
@@ -685,3 +673,5 @@ def store_incident_report_matrix_message(message, scratch_dir, sending_time=None
     # record the message just sent via matrix in a dedicated file
     with open(os.path.join(matrix_message_history_folder_path, 'indident_report_email_' + str(sending_time) + '.json'), 'w+') as outfile:
         outfile.write(json.dumps(message, indent=4))
+
+    update_job_registry(scratch_dir)
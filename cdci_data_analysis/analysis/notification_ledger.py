@@ -0,0 +1,206 @@
+"""
+Append-only ledger of the notifications (emails and matrix messages) sent for a scratch directory.
+
+Each notification stored in the email_history/matrix_message_history of the scratch directory
+is also recorded as one line of the ledger, from which the counters, the first submitted time
+and the last sending time of each status are read, instead of listing and parsing the history files.
+
+The ledger of a scratch directory created before it was introduced is built once from its history,
+written aside and linked in place, so that only one of the processes building it concurrently succeeds.
+"""
+
+import os
+import re
+import json
+import glob
+import uuid
+import typing
+
+from .scratch_layout import get_scratch_layout
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('notification_ledger')
+
+ledger_file_name = 'notification_ledger.jsonl'
+
+# where each channel stores its history, and the names of the history files
+history_folders = {
+    'email': 'email_history',
+    'matrix': 'matrix_message_history',
+}
+history_file_patterns = {
+    'email': re.compile(r"email_(?P<status>[a-z]+)_(?P<sending_time>[^_]+)_(?P<first_submitted_time>[^_]+)\.email$"),
+    'matrix': re.compile(r"matrix_message_(?P<status>[a-z]+)_(?P<sending_time>[^_]+)_(?P<first_submitted_time>[^_]+)\.json$"),
+}
+
+
+class NotificationStatusSummary(typing.NamedTuple):
+    count: int
+    first_submitted_time: typing.Optional[float]
+    last_sending_time: typing.Optional[float]
+    file_names: typing.List[str]
+
+
+def _ledger_path(scratch_dir):
+    return os.path.join(scratch_dir, ledger_file_name)
+
+
+def _append_entries(scratch_dir, entries):
+    # a single write of a few lines in append mode is not interleaved with the ones of other processes
+    with open(_ledger_path(scratch_dir), 'a') as f:
+        f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+
+
+def record_notification(scratch_dir, channel, status, sending_time, first_submitted_time, file_name):
+    """
+    records the notification just stored in the history file file_name
+    """
+    if not os.path.exists(_ledger_path(scratch_dir)):
+        # built from the history, this notification included, unless built concurrently by another process
+        entries = read_ledger_entries(scratch_dir)
+        if any(e['channel'] == channel and e['file_name'] == file_name for e in entries):
+            return
+    try:
+        _append_entries(scratch_dir, [dict(channel=channel,
+                                           status=status,
+                                           sending_time=sending_time,
+                                           first_submitted_time=first_submitted_time,
+                                           file_name=file_name)])
+    except OSError as e:
+        logger.warning("unable to record the notification %s in the ledger of %s: %s", file_name, scratch_dir, repr(e))
+
+
+def _entries_from_history(scratch_dir):
+    entries = []
+    for channel, history_folder in history_folders.items():
+        history_files = glob.glob(os.path.join(scratch_dir, history_folder, '*'))
+        for history_file in sorted(history_files, key=os.path.getmtime):
+            r = history_file_patterns[channel].match(os.path.basename(history_file))
+            if r is None:
+                continue
+            entries.append(dict(channel=channel,
+                                status=r.group('status'),
+                                sending_time=r.group('sending_time'),
+                                first_submitted_time=r.group('first_submitted_time'),
+                                file_name=os.path.basename(history_file)))
+    return entries
+
+
+def _build_ledger(scratch_dir, entries) -> bool:
+    """
+    creates the ledger with the entries, unless it exists already; returns False if it did
+    """
+    ledger_path = _ledger_path(scratch_dir)
+    tmp_ledger_path = f"{ledger_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_ledger_path, 'w') as f:
+            f.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        # unlike a rename, the link fails if the ledger was created meanwhile
+        os.link(tmp_ledger_path, ledger_path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        if os.path.exists(tmp_ledger_path):
+            os.remove(tmp_ledger_path)
+
+
+def read_ledger_entries(scratch_dir) -> typing.List[dict]:
+    try:
+        with open(_ledger_path(scratch_dir)) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        if not any(os.path.isdir(os.path.join(scratch_dir, history_folder)) for history_folder in history_folders.values()):
+            return []
+        entries = _entries_from_history(scratch_dir)
+        logger.info("building the notification ledger of %s from its %s history files", scratch_dir, len(entries))
+        try:
+            if not _build_ledger(scratch_dir, entries):
+                logger.info("the notification ledger of %s was built meanwhile", scratch_dir)
+                return read_ledger_entries(scratch_dir)
+        except OSError as e:
+            logger.warning("unable to write the notification ledger of %s: %s", scratch_dir, repr(e))
+        return entries
+
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            # possibly a line being written
+            continue
+    return entries
+
+
+def _as_time(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def summarize(entries, channel, status) -> NotificationStatusSummary:
+    entries = [e for e in entries if e['channel'] == channel and e['status'] == status]
+    sending_times = [t for t in (_as_time(e['sending_time']) for e in entries) if t is not None]
+    return NotificationStatusSummary(
+        count=len(entries),
+        # the first submitted time of the first notification, as it was stored
+        first_submitted_time=entries[0]['first_submitted_time'] if len(entries) > 0 else None,
+        last_sending_time=max(sending_times) if len(sending_times) > 0 else None,
+        file_names=[e['file_name'] for e in entries])
+
+
+def get_notification_summary(scratch_dir, channel, status) -> NotificationStatusSummary:
+    return summarize(read_ledger_entries(scratch_dir), channel, status)
+
+
+def get_job_scratch_dirs(job_id, scratch_dir=None) -> typing.List[str]:
+    """
+    returns the scratch directories of the job job_id (all its sessions), from the job registry
+    """
+    scratch_dirs = get_scratch_layout().find_job_scratch_dirs(job_id)
+
+    if scratch_dir is not None and \
+            os.path.normpath(os.path.relpath(scratch_dir)) not in [os.path.normpath(d) for d in scratch_dirs]:
+        scratch_dirs.append(scratch_dir)
+    return scratch_dirs
+
+
+def get_job_notification_summary(job_id, channel, status, scratch_dir=None) -> NotificationStatusSummary:
+    """
+    returns the summary of the notifications with the given status, sent for all the sessions of the job job_id,
+    with the paths of their history files.
+
+    The notifications queued in the outbox and not delivered yet are included, with the paths of their records,
+    so that no other one is queued while they wait to be delivered
+    """
+    # the outbox delivers the notifications through the helpers which record them here
+    from .notification_outbox import get_undelivered_notifications
+
+    count = 0
+    first_submitted_time = None
+    last_sending_times = []
+    file_names = []
+    job_scratch_dirs = get_job_scratch_dirs(job_id, scratch_dir)
+    for job_scratch_dir in job_scratch_dirs:
+        summary = get_notification_summary(job_scratch_dir, channel, status)
+        if summary.count == 0:
+            continue
+        count += summary.count
+        if first_submitted_time is None:
+            first_submitted_time = summary.first_submitted_time
+        if summary.last_sending_time is not None:
+            last_sending_times.append(summary.last_sending_time)
+        file_names += [os.path.join(job_scratch_dir, history_folders[channel], file_name)
+                       for file_name in summary.file_names]
+
+    for record_path, record in get_undelivered_notifications(channel, status, job_scratch_dirs):
+        count += 1
+        if first_submitted_time is None:
+            first_submitted_time = record['first_submitted_time']
+        last_sending_times.append(record['sending_time'])
+        file_names.append(record_path)
+    return NotificationStatusSummary(count=count,
+                                     first_submitted_time=first_submitted_time,
+                                     last_sending_time=max(last_sending_times) if len(last_sending_times) > 0 else None,
+                                     file_names=file_names)
@@ -0,0 +1,498 @@
+"""
+Durable outbox of the notifications of the jobs (emails and matrix messages).
+
+The notifications are queued as records in a directory of the working directory of the dispatcher,
+so that the requests do not wait for their delivery, and no notification is lost at a restart.
+A pool of background threads delivers them, through a reused SMTP connection and a pooled matrix session,
+retrying the failed ones in batches with an exponential backoff.
+Once delivered, each notification is stored in the email_history/matrix_message_history
+of the scratch directory of the job, as it is done when sending it synchronously.
+Until then, the notifications queued for a job are counted with the ones sent, when checking if another
+one has to be sent.
+"""
+
+import os
+import json
+import time
+import uuid
+import email
+import random
+import smtplib
+import threading
+import typing
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from ..analysis import email_helper, matrix_helper
+from ..flask_app.sentry import sentry
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('notification_outbox')
+
+default_outbox_dir_name = '.notification_outbox'
+default_max_workers = 2
+default_n_max_tries = 5
+default_retry_sleep_s = .5
+default_max_retry_sleep_s = 60
+default_retry_check_interval_s = 1
+# maximum number of records delivered by a worker in a row, with the same connection
+default_batch_size = 20
+# the smtp servers close the connections idle for a while
+smtp_connection_max_idle_s = 60
+# records claimed by a process which did not complete their delivery
+stale_claim_age_s = 3600
+stale_claim_check_interval_s = 60
+
+record_suffix = '.json'
+claimed_suffix = '.sending'
+
+
+class SMTPConnectionPool:
+    """
+    one SMTP connection per thread, reused for the following emails as long as the server keeps it open
+    """
+    def __init__(self, config, max_idle_s=smtp_connection_max_idle_s):
+        self.config = config
+        self.max_idle_s = max_idle_s
+        self._local = threading.local()
+
+    def get(self) -> smtplib.SMTP:
+        server = getattr(self._local, 'server', None)
+        if server is not None:
+            if time.time() - self._local.last_used > self.max_idle_s:
+                self.discard()
+            else:
+                try:
+                    server.noop()
+                except smtplib.SMTPException:
+                    self.discard()
+
+        if getattr(self._local, 'server', None) is None:
+            self._local.server = email_helper.open_smtp_connection(self.config.smtp_server,
+                                                                   self.config.smtp_port,
+                                                                   self.config.sender_email_address,
+                                                                   self.config.smtp_server_password,
+                                                                   logger)
+        self._local.last_used = time.time()
+        return self._local.server
+
+    def sendmail(self, sender_email_address, receivers_email_addresses, message_str):
+        try:
+            self.get().sendmail(sender_email_address, receivers_email_addresses, message_str)
+        except smtplib.SMTPServerDisconnected:
+            # the server might have closed the connection in the meanwhile
+            self.discard()
+            self.get().sendmail(sender_email_address, receivers_email_addresses, message_str)
+        self._local.last_used = time.time()
+
+    def discard(self):
+        server = getattr(self._local, 'server', None)
+        self._local.server = None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+
+class NotificationOutbox:
+    def __init__(self,
+                 config,
+                 outbox_dir=None,
+                 max_workers=default_max_workers,
+                 n_max_tries=default_n_max_tries,
+                 retry_sleep_s=default_retry_sleep_s,
+                 max_retry_sleep_s=default_max_retry_sleep_s,
+                 retry_check_interval_s=default_retry_check_interval_s,
+                 batch_size=default_batch_size):
+        if outbox_dir is None:
+            outbox_dir = default_outbox_dir_name
+        self.config = config
+        self.outbox_dir = os.path.abspath(outbox_dir)
+        self.n_max_tries = n_max_tries
+        self.retry_sleep_s = retry_sleep_s
+        self.max_retry_sleep_s = max_retry_sleep_s
+        self.retry_check_interval_s = retry_check_interval_s
+        self.batch_size = batch_size
+
+        os.makedirs(self.outbox_dir, exist_ok=True)
+
+        self.smtp_pool = SMTPConnectionPool(config)
+        self.matrix_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.matrix_session.mount('http://', adapter)
+        self.matrix_session.mount('https://', adapter)
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='notification_outbox')
+        self._n_in_progress = 0
+        self._in_progress_lock = threading.Condition()
+        self._closed = threading.Event()
+        self._wakeup = threading.Event()
+
+        self.release_stale_records()
+        self._last_stale_claim_check_time = time.time()
+
+        self._retry_thread = threading.Thread(target=self._retry_loop, name='notification_outbox_retry', daemon=True)
+        self._retry_thread.start()
+
+    def enqueue_email(self, message, receivers_email_addresses, status, scratch_dir,
+                      sending_time=None, first_submitted_time=None) -> str:
+        return self.enqueue(dict(kind='email',
+                                 message=message.as_string(),
+                                 subject=message['Subject'],
+                                 sender_email_address=message['From'],
+                                 receivers_email_addresses=receivers_email_addresses),
+                            status, scratch_dir, sending_time, first_submitted_time)
+
+    def enqueue_matrix_message(self, message_text, message_body_html, receiver_room_id, bcc_receivers_room_ids,
+                               status, scratch_dir, sending_time=None, first_submitted_time=None) -> str:
+        return self.enqueue(dict(kind='matrix',
+                                 message_text=message_text,
+                                 message_body_html=message_body_html,
+                                 receiver_room_id=receiver_room_id,
+                                 bcc_receivers_room_ids=bcc_receivers_room_ids,
+                                 message_data={'message_data_bcc_users': []},
+                                 failures={}),
+                            status, scratch_dir, sending_time, first_submitted_time)
+
+    def enqueue(self, record, status, scratch_dir, sending_time=None, first_submitted_time=None) -> str:
+        """
+        stores the record in the outbox, and submits it for the delivery; returns its id
+        """
+        if sending_time is None:
+            sending_time = time.time()
+        record_id = f"{record['kind']}_{sending_time}_{uuid.uuid4().hex}"
+        record.update(record_id=record_id,
+                      status=status,
+                      scratch_dir=os.path.abspath(scratch_dir),
+                      sending_time=sending_time,
+                      first_submitted_time=first_submitted_time,
+                      n_tries=0,
+                      next_try_time=0)
+        path = self.write_record(record)
+        logger.info("queued the %s notification %s for the status %s", record['kind'], record_id, status)
+        self._submit([path])
+        return record_id
+
+    def record_path(self, record_id):
+        return os.path.join(self.outbox_dir, record_id + record_suffix)
+
+    def write_record(self, record) -> str:
+        path = self.record_path(record['record_id'])
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+        return path
+
+    def pending_records(self) -> typing.List[str]:
+        try:
+            return sorted(os.path.join(self.outbox_dir, name) for name in os.listdir(self.outbox_dir)
+                          if name.endswith(record_suffix))
+        except FileNotFoundError:
+            return []
+
+    def undelivered_records(self, kind, status, scratch_dirs) -> typing.List[typing.Tuple[str, dict]]:
+        """
+        returns the paths and the records of the notifications of the given kind and status, queued for one of the
+        scratch_dirs and not delivered yet, either pending or being delivered (the path is the one of the pending record)
+        """
+        scratch_dirs = set(os.path.abspath(scratch_dir) for scratch_dir in scratch_dirs)
+        try:
+            names = os.listdir(self.outbox_dir)
+        except FileNotFoundError:
+            return []
+        records = {}
+        for name in sorted(names):
+            if not name.startswith(kind + '_'):
+                continue
+            if name.endswith(record_suffix):
+                record_path = os.path.join(self.outbox_dir, name)
+            elif name.endswith(record_suffix + claimed_suffix):
+                record_path = os.path.join(self.outbox_dir, name[:-len(claimed_suffix)])
+            else:
+                continue
+            # the record might be claimed, or released, meanwhile
+            for path in [record_path, record_path + claimed_suffix]:
+                try:
+                    with open(path) as f:
+                        record = json.load(f)
+                    break
+                except (FileNotFoundError, json.JSONDecodeError):
+                    continue
+            else:
+                continue
+            if record['status'] == status and record['scratch_dir'] in scratch_dirs:
+                records[record['record_id']] = (record_path, record)
+        return list(records.values())
+
+    def release_stale_records(self):
+        """
+        makes pending again the records claimed long ago, by a process which did not complete their delivery
+        """
+        try:
+            names = os.listdir(self.outbox_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if not name.endswith(claimed_suffix):
+                continue
+            path = os.path.join(self.outbox_dir, name)
+            try:
+                if time.time() - os.stat(path).st_mtime > stale_claim_age_s:
+                    os.replace(path, path[:-len(claimed_suffix)])
+            except FileNotFoundError:
+                continue
+
+    def get_retry_sleep_s(self, n_tries):
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_retry_sleep_s, self.retry_sleep_s * 2 ** n_tries))
+
+    def _submit(self, paths):
+        with self._in_progress_lock:
+            self._n_in_progress += 1
+        try:
+            self._executor.submit(self._deliver_batch, paths)
+        except RuntimeError:
+            # the outbox is closed, the records stay pending
+            self._task_done()
+
+    def _task_done(self):
+        with self._in_progress_lock:
+            self._n_in_progress -= 1
+            self._in_progress_lock.notify_all()
+
+    def _retry_loop(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self.retry_check_interval_s)
+            self._wakeup.clear()
+            if self._closed.is_set():
+                break
+            try:
+                # the records of a worker which stopped during their delivery
+                if time.time() - self._last_stale_claim_check_time > stale_claim_check_interval_s:
+                    self._last_stale_claim_check_time = time.time()
+                    self.release_stale_records()
+
+                due_paths = []
+                now = time.time()
+                for path in self.pending_records():
+                    try:
+                        with open(path) as f:
+                            record = json.load(f)
+                    except (FileNotFoundError, json.JSONDecodeError):
+                        continue
+                    if record.get('next_try_time', 0) <= now:
+                        due_paths.append(path)
+                for i in range(0, len(due_paths), self.batch_size):
+                    self._submit(due_paths[i:i + self.batch_size])
+            except Exception as e:
+                logger.warning("unable to check the pending notifications: %s", repr(e))
+
+    def _deliver_batch(self, paths):
+        try:
+            for path in paths:
+                try:
+                    self._deliver(path)
+                except Exception as e:
+                    logger.error("unexpected error while delivering the notification %s: %s", path, repr(e))
+                    sentry.capture_message(f'unexpected error while delivering the notification {path}: {repr(e)}')
+        finally:
+            self._task_done()
+
+    def _deliver(self, path):
+        claimed_path = path + claimed_suffix
+        try:
+            # the record might be delivered by another thread or process sharing the outbox
+            os.replace(path, claimed_path)
+        except FileNotFoundError:
+            return
+        os.utime(claimed_path)
+
+        with open(claimed_path) as f:
+            record = json.load(f)
+
+        if record['next_try_time'] > time.time():
+            # submitted twice, and already retried meanwhile
+            os.replace(claimed_path, path)
+            return
+
+        try:
+            if record['kind'] == 'email':
+                delivered = self._deliver_email(record)
+            else:
+                delivered = self._deliver_matrix_message(record)
+
+            record['n_tries'] += 1
+            if delivered:
+                self._complete(record)
+            elif record['n_tries'] >= self.n_max_tries:
+                self._fail(record)
+            else:
+                sleep_s = self.get_retry_sleep_s(record['n_tries'] - 1)
+                record['next_try_time'] = time.time() + sleep_s
+                logger.info("the notification %s will be retried in %.2f seconds, %s tries left",
+                            record['record_id'], sleep_s, self.n_max_tries - record['n_tries'])
+                self.write_record(record)
+        finally:
+            os.remove(claimed_path)
+
+    def _deliver_email(self, record) -> bool:
+        try:
+            self.smtp_pool.sendmail(record['sender_email_address'],
+                                    record['receivers_email_addresses'],
+                                    record['message'])
+        except Exception as e:
+            self.smtp_pool.discard()
+            logger.warning("there seems to be some problem in sending the email with title %s: %s",
+                           record['subject'], repr(e))
+            record['error'] = repr(e)
+            return False
+        logger.info("email successfully sent")
+        return True
+
+    def _deliver_matrix_message(self, record) -> bool:
+        message_data = record['message_data']
+        failures = record['failures']
+        rooms = []
+        if record['receiver_room_id'] is not None and 'message_data_token_user' not in message_data:
+            rooms.append(('token_user', record['receiver_room_id']))
+        delivered_bcc_rooms = record.setdefault('delivered_bcc_rooms', [])
+        rooms += [('bcc_user', room_id) for room_id in record['bcc_receivers_room_ids']
+                  if room_id not in delivered_bcc_rooms]
+
+        for receiver, room_id in rooms:
+            try:
+                matrix_helper.join_room(logger,
+                                        url_server=self.config.matrix_server_url,
+                                        sender_access_token=self.config.matrix_sender_access_token,
+                                        room_id=room_id,
+                                        session=self.matrix_session)
+                res_data = matrix_helper.send_message(logger,
+                                                      url_server=self.config.matrix_server_url,
+                                                      sender_access_token=self.config.matrix_sender_access_token,
+                                                      room_id=room_id,
+                                                      message_text=record['message_text'],
+                                                      message_body_html=record['message_body_html'],
+                                                      session=self.matrix_session)
+            except (matrix_helper.MatrixMessageNotSent, requests.exceptions.RequestException) as e:
+                failures[room_id] = getattr(e, 'message', repr(e))
+                logger.warning("Issue in sending a message in the room %s using matrix: %s", room_id, failures[room_id])
+                continue
+            failures.pop(room_id, None)
+            if receiver == 'token_user':
+                message_data['message_data_token_user'] = res_data['message_data']
+            else:
+                message_data['message_data_bcc_users'].append(res_data['message_data'])
+                delivered_bcc_rooms.append(room_id)
+
+        return len(failures) == 0
+
+    def _complete(self, record):
+        if record['kind'] == 'email':
+            email_helper.store_status_email_info(email.message_from_string(record['message']),
+                                                 record['status'],
+                                                 record['scratch_dir'],
+                                                 logger,
+                                                 sending_time=record['sending_time'],
+                                                 first_submitted_time=record['first_submitted_time'])
+        else:
+            matrix_helper.store_status_matrix_message_info(record['message_data'],
+                                                           record['status'],
+                                                           record['scratch_dir'],
+                                                           logger,
+                                                           sending_time=record['sending_time'],
+                                                           first_submitted_time=record['first_submitted_time'])
+        logger.info("delivered the %s notification %s after %s tries",
+                    record['kind'], record['record_id'], record['n_tries'])
+
+    def _fail(self, record):
+        logger.warning("an issue occurred when delivering the notification %s, "
+                       "multiple attempts have been executed, but those did not succeed", record['record_id'])
+        if record['kind'] == 'email':
+            message = email.message_from_string(record['message'])
+            email_body_html = record['message']
+            for part in message.walk():
+                if part.get_content_type() == 'text/html':
+                    email_body_html = part.get_payload(decode=True).decode()
+            email_helper.store_not_sent_email(email_body_html, record['scratch_dir'], sending_time=record['sending_time'])
+            sentry.capture_message(f"multiple attempts to send an email with title {record['subject']} "
+                                   f"have been detected, the following error has been generated:\n"
+                                   f"{record.get('error')}")
+        else:
+            # what could be delivered is recorded, with the failures
+            self._complete(record)
+            sentry.capture_message(f"multiple attempts to send the matrix message {record['record_id']} "
+                                   f"did not succeed: {record['failures']}")
+
+    def flush(self, timeout=None) -> bool:
+        """
+        waits until the outbox is empty, returns False if the timeout was reached before
+        """
+        t0 = time.time()
+        while True:
+            with self._in_progress_lock:
+                if self._n_in_progress == 0 and len(self.pending_records()) == 0:
+                    return True
+                remaining = None if timeout is None else timeout - (time.time() - t0)
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._in_progress_lock.wait(min(self.retry_check_interval_s,
+                                                remaining if remaining is not None else self.retry_check_interval_s))
+            self._wakeup.set()
+
+    def close(self):
+        self._closed.set()
+        self._wakeup.set()
+        self._executor.shutdown(wait=True)
+        self.smtp_pool.discard()
+        self.matrix_session.close()
+
+
+_notification_outbox = None
+_notification_outbox_pid = None
+_notification_outbox_config = None
+_notification_outbox_lock = threading.Lock()
+
+
+def configure_notification_outbox(disp_conf):
+    """
+    sets the dispatcher configuration used by the outbox, which is enabled by the notification_outbox option
+    """
+    global _notification_outbox, _notification_outbox_config
+    with _notification_outbox_lock:
+        if _notification_outbox is not None and _notification_outbox_pid == os.getpid():
+            _notification_outbox.close()
+        _notification_outbox = None
+        _notification_outbox_config = disp_conf
+
+
+def get_undelivered_notifications(kind, status, scratch_dirs) -> typing.List[typing.Tuple[str, dict]]:
+    """
+    returns the notifications queued in the outbox for the scratch_dirs and not delivered yet,
+    none if the notifications are sent synchronously
+    """
+    outbox = get_notification_outbox()
+    if outbox is None:
+        return []
+    return outbox.undelivered_records(kind, status, scratch_dirs)
+
+
+def get_notification_outbox() -> typing.Optional[NotificationOutbox]:
+    """
+    returns the outbox of the process, or None if the notifications are sent synchronously
+    """
+    global _notification_outbox, _notification_outbox_pid
+    with _notification_outbox_lock:
+        if _notification_outbox_config is None or not _notification_outbox_config.notification_outbox:
+            return None
+        # the threads and the connections can not be shared with the forked processes
+        if _notification_outbox is None or _notification_outbox_pid != os.getpid():
+            _notification_outbox = NotificationOutbox(_notification_outbox_config,
+                                                      max_workers=_notification_outbox_config.notification_outbox_max_workers,
+                                                      n_max_tries=_notification_outbox_config.notification_outbox_n_max_tries,
+                                                      retry_sleep_s=email_helper.email_sending_retry_sleep_s)
+            _notification_outbox_pid = os.getpid()
+        return _notification_outbox
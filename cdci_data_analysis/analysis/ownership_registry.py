@@ -0,0 +1,154 @@
+"""
+Persistent index of the ownerships of the files uploaded to the request files directory.
+
+Each uploaded file is stored under the md5 hash of its content, and is recorded with the emails and the roles
+of the users who uploaded it. Uploading the same content again only adds the missing owners, with an indexed
+insertion, instead of reading and rewriting a json ownership file per file.
+
+The index is a SQLite database stored in the request files directory, and can be shared by several worker processes.
+As the job registry, it uses the rollback journal, and a request files directory shared by several hosts has to be
+on a filesystem supporting the POSIX locks.
+The ownership files of the previous layout (<file_hash>_ownerships.json) are imported when the file is first
+looked up or given an owner, so that the owners recorded before are kept.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import typing
+
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('ownership_registry')
+
+default_registry_file_name = '.ownership_registry.sqlite'
+legacy_ownership_file_suffix = '_ownerships.json'
+
+_schema = """
+CREATE TABLE IF NOT EXISTS file_user_emails (
+    file_hash TEXT NOT NULL,
+    user_email TEXT NOT NULL,
+    PRIMARY KEY (file_hash, user_email)
+);
+CREATE TABLE IF NOT EXISTS file_user_roles (
+    file_hash TEXT NOT NULL,
+    user_role TEXT NOT NULL,
+    PRIMARY KEY (file_hash, user_role)
+);
+"""
+
+
+class OwnershipRegistry:
+
+    def __init__(self, request_files_dir):
+        self.request_files_dir = os.path.abspath(request_files_dir)
+        self.db_path = os.path.join(self.request_files_dir, default_registry_file_name)
+        self._local = threading.local()
+
+    def _db_inode(self):
+        try:
+            return os.stat(self.db_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _connection(self):
+        # sqlite connections can not be shared across threads nor inherited by forked processes,
+        # and the ones to a database removed with the content of the directory are not reused
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid() \
+                or getattr(self._local, 'inode', None) != self._db_inode():
+            if connection is not None and getattr(self._local, 'pid', None) == os.getpid():
+                connection.close()
+            os.makedirs(self.request_files_dir, exist_ok=True)
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            # the write-ahead log needs memory shared by the processes, not available on a network filesystem:
+            # the rollback journal only relies on the file locks (and converts the databases in WAL mode)
+            connection.execute("PRAGMA journal_mode=DELETE")
+            connection.executescript(_schema)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.inode = self._db_inode()
+        return connection
+
+    def add_ownerships(self, file_hash, user_email, user_roles=()):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if not self._has_ownerships(connection, file_hash):
+                self._insert_legacy_ownerships(connection, file_hash)
+            connection.execute("INSERT OR IGNORE INTO file_user_emails (file_hash, user_email) VALUES (?, ?)",
+                               (file_hash, user_email))
+            connection.executemany("INSERT OR IGNORE INTO file_user_roles (file_hash, user_role) VALUES (?, ?)",
+                                   [(file_hash, user_role) for user_role in user_roles])
+
+    @staticmethod
+    def _has_ownerships(connection, file_hash) -> bool:
+        return connection.execute("SELECT 1 FROM file_user_emails WHERE file_hash = ? LIMIT 1",
+                                  (file_hash,)).fetchone() is not None
+
+    def _insert_legacy_ownerships(self, connection, file_hash) -> bool:
+        # within the transaction of the caller
+        legacy_ownership_file_path = os.path.join(self.request_files_dir, file_hash + legacy_ownership_file_suffix)
+        try:
+            with open(legacy_ownership_file_path) as ownership_file:
+                ownerships = json.load(ownership_file)
+        except (OSError, ValueError):
+            return False
+
+        connection.executemany("INSERT OR IGNORE INTO file_user_emails (file_hash, user_email) VALUES (?, ?)",
+                               [(file_hash, user_email) for user_email in ownerships.get('user_emails', [])])
+        connection.executemany("INSERT OR IGNORE INTO file_user_roles (file_hash, user_role) VALUES (?, ?)",
+                               [(file_hash, user_role) for user_role in ownerships.get('user_roles', [])])
+        logger.info("imported the ownership file of %s", file_hash)
+        return True
+
+    def _import_legacy_ownership_file(self, file_hash) -> bool:
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            if self._has_ownerships(connection, file_hash):
+                # imported in the meantime
+                return True
+            return self._insert_legacy_ownerships(connection, file_hash)
+
+    def get_ownerships(self, file_hash) -> typing.Optional[dict]:
+        """
+        returns the user_emails and the user_roles of the owners of the file, or None if it has no recorded owner
+        """
+        connection = self._connection()
+
+        def select_user_emails():
+            return [row[0] for row in connection.execute(
+                "SELECT user_email FROM file_user_emails WHERE file_hash = ? ORDER BY user_email", (file_hash,))]
+
+        user_emails = select_user_emails()
+        if len(user_emails) == 0:
+            if not self._import_legacy_ownership_file(file_hash):
+                return None
+            user_emails = select_user_emails()
+            if len(user_emails) == 0:
+                return None
+
+        user_roles = [row[0] for row in connection.execute(
+            "SELECT user_role FROM file_user_roles WHERE file_hash = ? ORDER BY user_role", (file_hash,))]
+        return dict(user_emails=user_emails, user_roles=user_roles)
+
+    def remove(self, file_hash):
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute("DELETE FROM file_user_emails WHERE file_hash = ?", (file_hash,))
+            connection.execute("DELETE FROM file_user_roles WHERE file_hash = ?", (file_hash,))
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_ownership_registry(request_files_dir) -> OwnershipRegistry:
+    request_files_dir = os.path.abspath(request_files_dir)
+    with _registries_lock:
+        if request_files_dir not in _registries:
+            _registries[request_files_dir] = OwnershipRegistry(request_files_dir)
+        return _registries[request_files_dir]
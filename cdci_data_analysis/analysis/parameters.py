@@ -20,6 +20,7 @@ Module API
 
 __author__ = "Andrea Tramacere"
 
+import copy
 import decorator
 import logging
 import os
@@ -59,6 +60,33 @@ def subclasses_recursive(cls):
         indirect.extend(subclasses_recursive(subclass))
     return direct + indirect
 
+def clone_parameters(obj, memo):
+    """
+    copies the Parameter objects found in obj (possibly within lists, tuples, groups, ranges and tuples of parameters),
+    everything else is shared with the original.
+    The copies are shallow: the metadata of a parameter is shared, while setting its value, units or format
+    only affects the copy.
+    memo maps the id of the objects already copied to their copy, so that a parameter shared between several
+    queries is copied only once
+    """
+    if isinstance(obj, (Parameter, ParameterGroup, ParameterRange, ParameterTuple)):
+        if id(obj) not in memo:
+            new_obj = copy.copy(obj)
+            memo[id(obj)] = new_obj
+            if not isinstance(obj, Parameter):
+                for k, v in obj.__dict__.items():
+                    if isinstance(v, np.ndarray):
+                        new_obj.__dict__[k] = v.copy()
+                    else:
+                        new_obj.__dict__[k] = clone_parameters(v, memo)
+        return memo[id(obj)]
+    elif type(obj) is list:
+        return [clone_parameters(x, memo) for x in obj]
+    elif type(obj) is tuple:
+        return tuple(clone_parameters(x, memo) for x in obj)
+    return obj
+
+
 # TODO this class seems not to be in use anywhere, not even the plugins
 class ParameterGroup(object):
 
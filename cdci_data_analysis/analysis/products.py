@@ -35,6 +35,7 @@ from .parameters import *
 from .io_helper import FilePath
 from .io_helper import view_traceback, FitsFile
 from .job_manager import Job
+from .job_registry import update_job_registry
 from .json import CustomJSONEncoder
 from .exceptions import ProblemDecodingStoredQueryOut
 
@@ -80,6 +81,7 @@ class QueryOutput(object):
                 my_json_str = json.dumps(_dict, indent=4, sort_keys=True)
                 # TODO further test if formatting is really needed
                 outfile.write(u'%s' % my_json_str)
+            update_job_registry(work_dir, token=query_dict.get('token'))
         else:
             with open(file_path.path) as outfile:
                 dict_analysis_parameters = json.load(outfile)
@@ -17,6 +17,7 @@ __author__ = "Andrea Tramacere"
 # relative import eg: from .mod import f
 
 
+import copy
 import logging
 import time as _time
 import json
@@ -31,6 +32,7 @@ from .parameters import (Parameter,
                          ParameterGroup,
                          ParameterRange,
                          ParameterTuple,
+                         clone_parameters,
                          Name,
                          Angle,
                          Time,
@@ -86,6 +88,21 @@ class BaseQuery(object):
     def parameters(self):
         return self._parameters_list
 
+    def clone(self, memo=None):
+        """
+        returns a copy of the query with its own parameter objects, so that the values set
+        on the copy do not affect the original query (see clone_parameters)
+        """
+        if memo is None:
+            memo = {}
+        if id(self) not in memo:
+            new_query = copy.copy(self)
+            memo[id(self)] = new_query
+            for k, v in self.__dict__.items():
+                new_query.__dict__[k] = clone_parameters(v, memo)
+            new_query._build_par_dictionary()
+        return memo[id(self)]
+
     @property
     def par_names(self):
         return [p1.name for p1 in self._parameters_list ]
@@ -0,0 +1,35 @@
+"""
+Counters of the events of the requests handled by the process, e.g. the temporary directories created or avoided.
+
+The counters are kept in memory, separately by each worker process, and are exposed by the /request-counters endpoint.
+"""
+
+import os
+import threading
+import collections
+import typing
+
+_counters = collections.Counter()
+_counters_lock = threading.Lock()
+
+
+def increment(name, value=1):
+    with _counters_lock:
+        _counters[name] += value
+
+
+def get_counters() -> typing.Dict[str, int]:
+    with _counters_lock:
+        return dict(_counters)
+
+
+def get_process_counters() -> dict:
+    """
+    returns the counters with the pid of the process they belong to
+    """
+    return dict(pid=os.getpid(), counters=get_counters())
+
+
+def reset_counters():
+    with _counters_lock:
+        _counters.clear()
@@ -0,0 +1,98 @@
+"""
+Helpers for the clean-up of the working directory of the dispatcher:
+listing of the scratch directories and the lock files, and their (parallel) removal.
+"""
+
+import os
+import shutil
+import typing
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .job_registry import parse_scratch_dir_name, remove_from_job_registry
+from .scratch_layout import iter_shards_dir_entries
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('scratch_cleanup')
+
+
+class ScratchDirEntry(typing.NamedTuple):
+    path: str
+    job_id: str
+    mtime: float
+
+
+class WorkingDirScan(typing.NamedTuple):
+    scratch_dirs: typing.List[ScratchDirEntry]
+    lock_files: typing.List[str]
+
+
+def scan_working_dir(wd='.') -> WorkingDirScan:
+    """
+    lists, with a single pass over wd and over the shards of the sharded layout,
+    the scratch directories (with their mtime) and the lock files
+    """
+    scratch_dirs = []
+    lock_files = []
+
+    def add_scratch_dir(entry):
+        r = parse_scratch_dir_name(entry.name)
+        if r is None:
+            return
+        try:
+            scratch_dirs.append(ScratchDirEntry(path=os.path.normpath(entry.path),
+                                                job_id=r.group('job_id'),
+                                                mtime=entry.stat().st_mtime))
+        except FileNotFoundError:
+            # removed in the meantime
+            pass
+
+    def add_entry(entry):
+        if entry.name.startswith('.lock_'):
+            lock_files.append(entry.path)
+        elif entry.name.startswith('scratch_sid_'):
+            add_scratch_dir(entry)
+
+    with os.scandir(wd) as scan:
+        for entry in scan:
+            add_entry(entry)
+
+    for entry in iter_shards_dir_entries(wd, prefixes=('scratch_sid_', '.lock_')):
+        add_entry(entry)
+
+    return WorkingDirScan(scratch_dirs=scratch_dirs, lock_files=lock_files)
+
+
+def get_lock_file_job_id(lock_file):
+    return os.path.basename(lock_file).split('_')[-1]
+
+
+def get_dir_size(path) -> int:
+    size = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        for file_name in file_names:
+            try:
+                size += os.lstat(os.path.join(dir_path, file_name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def remove_scratch_dir(path) -> bool:
+    try:
+        shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning("unable to remove the scratch directory %s: %s", path, repr(e))
+        return False
+
+    remove_from_job_registry(path)
+    return True
+
+
+def remove_scratch_dirs(paths, executor: ThreadPoolExecutor) -> typing.List[str]:
+    """
+    removes the given directories through the executor, and returns those actually removed
+    """
+    return [path for path, removed in zip(paths, executor.map(remove_scratch_dir, paths)) if removed]
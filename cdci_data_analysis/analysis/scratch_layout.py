@@ -0,0 +1,246 @@
+"""
+Layout of the scratch directories in the working directory of the dispatcher.
+
+With the flat layout, the scratch directories are created directly in the working directory.
+With the sharded layout, they are created in a shard named after the first characters of their job_id,
+e.g. scratch_shards/3f/scratch_sid_<session_id>_jid_3f..., so that no directory grows with the number of jobs.
+
+The scratch directories of a job are looked up in the job registry, the persistent index of the scratch directories
+updated when they are created and removed, instead of listing the working directory. The job directory and the
+shard of the job are listed instead while the registry is not populated, and when the job is not found in it.
+The flat directories left by the previous layout are still found, and can be moved to their shard with
+the migration tool:
+
+    python -m cdci_data_analysis.analysis.scratch_layout [--wd WD] [--dry-run]
+"""
+
+import os
+import argparse
+import threading
+import typing
+
+from .job_registry import get_job_registry, parse_scratch_dir_name, remove_from_job_registry, update_job_registry
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('scratch_layout')
+
+scratch_dir_layouts = ['flat', 'sharded']
+shards_dir_name = 'scratch_shards'
+shard_prefix_length = 2
+
+
+def get_scratch_dir_name(session_id=None, job_id=None, aliased=False) -> str:
+    scratch_dir_name = 'scratch'
+    if session_id is not None:
+        scratch_dir_name += '_sid_' + session_id
+    if job_id is not None:
+        scratch_dir_name += '_jid_' + job_id
+    if aliased:
+        scratch_dir_name += '_aliased'
+    return scratch_dir_name
+
+
+def get_shard_dir(job_id, wd='.') -> str:
+    return os.path.join(wd, shards_dir_name, job_id[:shard_prefix_length])
+
+
+def iter_scratch_dir_entries(wd='.') -> typing.Iterator[os.DirEntry]:
+    """
+    iterates over the scratch directories of wd, in both layouts
+    """
+    with os.scandir(wd) as scan:
+        for entry in scan:
+            if entry.name.startswith('scratch_sid_'):
+                yield entry
+
+    yield from iter_shards_scratch_dir_entries(wd)
+
+
+def iter_shards_scratch_dir_entries(wd='.') -> typing.Iterator[os.DirEntry]:
+    """
+    iterates over the scratch directories in the shards of wd
+    """
+    return iter_shards_dir_entries(wd, prefixes=('scratch_sid_',))
+
+
+def iter_shards_dir_entries(wd='.', prefixes=('scratch_sid_', '.lock_')) -> typing.Iterator[os.DirEntry]:
+    """
+    iterates over the entries in the shards of wd whose name starts with one of the prefixes
+    """
+    shards_dir = os.path.join(wd, shards_dir_name)
+    if not os.path.isdir(shards_dir):
+        return
+    with os.scandir(shards_dir) as shards_scan:
+        shard_dirs = [shard_entry.path for shard_entry in shards_scan if shard_entry.is_dir()]
+    for shard_dir in sorted(shard_dirs):
+        try:
+            with os.scandir(shard_dir) as scan:
+                for entry in scan:
+                    if entry.name.startswith(prefixes):
+                        yield entry
+        except FileNotFoundError:
+            # removed in the meantime
+            pass
+
+
+class ScratchLayout:
+
+    def __init__(self, layout='flat', wd='.'):
+        if layout not in scratch_dir_layouts:
+            raise ValueError(f"unsupported scratch directory layout {layout}, expected one of {scratch_dir_layouts}")
+        self.layout = layout
+        self.wd = wd
+
+    def get_scratch_dir(self, session_id=None, job_id=None, aliased=False) -> str:
+        """
+        returns the path of the scratch directory to be created for the job
+        """
+        scratch_dir_name = get_scratch_dir_name(session_id, job_id, aliased=aliased)
+        if self.layout == 'sharded' and job_id is not None:
+            return os.path.normpath(os.path.join(get_shard_dir(job_id, self.wd), scratch_dir_name))
+        return os.path.normpath(os.path.join(self.wd, scratch_dir_name))
+
+    def get_lock_dir(self, job_id) -> str:
+        """
+        returns the directory of the lock file of the creation of the scratch directories of the job
+        """
+        if self.layout == 'sharded' and job_id is not None:
+            return os.path.normpath(get_shard_dir(job_id, self.wd))
+        return os.path.normpath(self.wd)
+
+    def scan_job_scratch_dirs(self, job_id, include_aliased=True) -> typing.List[str]:
+        """
+        lists the scratch directories of the job, in its shard and in wd, including those not in the job registry
+        """
+        suffixes = (f'_jid_{job_id}', f'_jid_{job_id}_aliased') if include_aliased else (f'_jid_{job_id}',)
+        scratch_dirs = []
+        for d in [self.wd, get_shard_dir(job_id, self.wd)]:
+            try:
+                with os.scandir(d) as scan:
+                    for entry in scan:
+                        if entry.name.startswith('scratch_') and entry.name.endswith(suffixes):
+                            scratch_dirs.append(os.path.normpath(entry.path))
+            except FileNotFoundError:
+                pass
+        return sorted(scratch_dirs)
+
+    def find_job_scratch_dirs(self, job_id, include_aliased=True) -> typing.List[str]:
+        """
+        returns the existing scratch directories of the job (all its sessions), found in the job registry
+        """
+        scratch_dirs = []
+        try:
+            registry = get_job_registry()
+            # the directories created before the registry are indexed when it is populated
+            job_entries = registry.find(job_id=job_id) if registry.is_populated() else []
+        except Exception as e:
+            logger.warning("unable to find the scratch directories of the job %s in the job registry: %s",
+                           job_id, repr(e))
+        else:
+            for entry in job_entries:
+                if os.path.isdir(entry['scratch_dir']):
+                    scratch_dirs.append(entry['scratch_dir'])
+                else:
+                    # removed without updating the registry
+                    remove_from_job_registry(entry['scratch_dir'])
+
+        if len(scratch_dirs) == 0:
+            # a miss is confirmed listing the two directories where the job can be
+            scratch_dirs = self.scan_job_scratch_dirs(job_id)
+            for scratch_dir in scratch_dirs:
+                update_job_registry(scratch_dir)
+
+        if not include_aliased:
+            scratch_dirs = [d for d in scratch_dirs if parse_scratch_dir_name(d).group('aliased_marker') == '']
+        return scratch_dirs
+
+    def find_scratch_dir(self, session_id, job_id, aliased=False) -> typing.Optional[str]:
+        """
+        returns the existing scratch directory of the job in the session, in either layout, or None
+        """
+        scratch_dir_name = get_scratch_dir_name(session_id, job_id, aliased=aliased)
+        for scratch_dir in self.find_job_scratch_dirs(job_id):
+            if os.path.basename(scratch_dir) == scratch_dir_name:
+                return scratch_dir
+
+        # other scratch directories of the job can be indexed, but not this one
+        for scratch_dir in [os.path.join(self.wd, scratch_dir_name),
+                            os.path.join(get_shard_dir(job_id, self.wd), scratch_dir_name)]:
+            if os.path.isdir(scratch_dir):
+                update_job_registry(scratch_dir)
+                return os.path.normpath(scratch_dir)
+        return None
+
+    def migrate(self, dry_run=False) -> int:
+        """
+        moves the scratch directories of wd, created with the flat layout, to their shard,
+        and returns the number of directories moved
+        """
+        registry = get_job_registry()
+        n_migrated = 0
+        with os.scandir(self.wd) as scan:
+            entries = [entry for entry in scan if entry.is_dir() and parse_scratch_dir_name(entry.name) is not None]
+
+        for entry in entries:
+            job_id = parse_scratch_dir_name(entry.name).group('job_id')
+            new_path = os.path.join(get_shard_dir(job_id, self.wd), entry.name)
+            if dry_run:
+                logger.info("%s would be moved to %s", entry.path, new_path)
+                n_migrated += 1
+                continue
+
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            if os.path.exists(new_path):
+                logger.warning("%s not moved, %s already exists", entry.path, new_path)
+                continue
+            old_entries = [e for e in registry.find(job_id=job_id)
+                           if os.path.normpath(e['scratch_dir']) == os.path.normpath(os.path.relpath(entry.path))]
+            os.rename(entry.path, new_path)
+
+            if len(old_entries) > 0:
+                registry.update(new_path, sub=old_entries[0]['sub'], status=old_entries[0]['status'],
+                                mtime=old_entries[0]['mtime'])
+            else:
+                registry.update(new_path, mtime=os.stat(new_path).st_mtime)
+            registry.remove(entry.path)
+            n_migrated += 1
+
+        logger.info("%s scratch directories %s to the sharded layout in %s",
+                    n_migrated, 'to be moved' if dry_run else 'moved', self.wd)
+        return n_migrated
+
+
+_scratch_layout = None
+_scratch_layout_lock = threading.Lock()
+
+
+def configure_scratch_layout(disp_conf):
+    global _scratch_layout
+    with _scratch_layout_lock:
+        _scratch_layout = ScratchLayout(layout=disp_conf.scratch_dir_layout)
+
+
+def get_scratch_layout() -> ScratchLayout:
+    global _scratch_layout
+    with _scratch_layout_lock:
+        if _scratch_layout is None:
+            _scratch_layout = ScratchLayout()
+        return _scratch_layout
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="moves the scratch directories of the flat layout to their shard")
+    parser.add_argument('--wd', type=str, default='.', help='the working directory of the dispatcher')
+    parser.add_argument('--dry-run', action='store_true', help='only lists the directories to be moved')
+    args = parser.parse_args(argv)
+
+    app_logging.setup()
+
+    # the job registry is the one of the working directory
+    os.chdir(args.wd)
+    n_migrated = ScratchLayout(layout='sharded').migrate(dry_run=args.dry_run)
+    print(f"{n_migrated} scratch directories {'to be moved' if args.dry_run else 'moved'}")
+
+
+if __name__ == '__main__':
+    main()
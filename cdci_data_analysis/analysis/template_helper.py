@@ -0,0 +1,83 @@
+"""
+Registry of the templates of the notifications, shared by email_helper and matrix_helper.
+
+Each kind of notification (email, matrix) registers its templates and the filters they use;
+they are compiled once per process, with their bytecode cached on the disk for the other processes,
+and are not checked again for changes: reload_templates has to be called after editing them.
+"""
+
+import os
+import threading
+import typing
+
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, Template
+
+from ..app_logging import app_logging
+
+logger = app_logging.getLogger('template_helper')
+
+templates_dir = os.path.join(os.path.dirname(__file__), '..', 'flask_app', 'templates')
+
+
+class TemplateEnvironmentEntry(typing.NamedTuple):
+    template_names: typing.List[str]
+    filters: typing.Dict[str, typing.Callable]
+
+
+_template_environment_entries = {}
+_template_environments = {}
+_bytecode_cache = None
+_template_environment_lock = threading.Lock()
+
+
+def register_template_environment(name, template_names, filters=None):
+    """
+    registers the templates of the notifications of the kind name, rendered with the given filters
+    """
+    with _template_environment_lock:
+        _template_environment_entries[name] = TemplateEnvironmentEntry(template_names=list(template_names),
+                                                                       filters=dict(filters or {}))
+        _template_environments.pop(name, None)
+
+
+def _build_template_environment(name) -> Environment:
+    global _bytecode_cache
+    if _bytecode_cache is None:
+        _bytecode_cache = FileSystemBytecodeCache()
+
+    entry = _template_environment_entries[name]
+    env = Environment(loader=FileSystemLoader(templates_dir),
+                      bytecode_cache=_bytecode_cache,
+                      auto_reload=False)
+    env.filters.update(entry.filters)
+    for template_name in entry.template_names:
+        env.get_template(template_name)
+    logger.info("compiled the %s templates %s", name, entry.template_names)
+    return env
+
+
+def get_template_environment(name) -> Environment:
+    with _template_environment_lock:
+        if name not in _template_environments:
+            _template_environments[name] = _build_template_environment(name)
+        return _template_environments[name]
+
+
+def get_template(name, template_name) -> Template:
+    return get_template_environment(name).get_template(template_name)
+
+
+def reload_templates(clear_bytecode_cache=True) -> typing.List[str]:
+    """
+    drops the compiled templates, so that the edited ones are used for the following notifications,
+    and returns the names of the recompiled templates
+    """
+    with _template_environment_lock:
+        if clear_bytecode_cache and _bytecode_cache is not None:
+            _bytecode_cache.clear()
+        _template_environments.clear()
+        for name in _template_environment_entries:
+            _template_environments[name] = _build_template_environment(name)
+        return [template_name
+                for entry in _template_environment_entries.values()
+                for template_name in entry.template_names]
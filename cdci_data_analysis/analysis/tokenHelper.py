@@ -1,11 +1,20 @@
 import jwt
 import os
+import json
+import time
+import copy
+import base64
+import binascii
+import hashlib
+import threading
+import collections
 import requests
 import oda_api.token
 
 from marshmallow import ValidationError
 from typing import Tuple, Optional, Union
 
+from cdci_data_analysis.analysis import request_counters
 from cdci_data_analysis.analysis.exceptions import BadRequest
 from cdci_data_analysis.flask_app.schemas import EmailOptionsTokenSchema
 from cdci_data_analysis.app_logging import app_logging
@@ -134,17 +143,86 @@ def get_token_user_fail_email(decoded_token):
     return decoded_token.get('msfail', True) # TODO: make server configurable
 
 
+verified_tokens_cache_size = 1024
+unverified_tokens_cache_size = 4096
+
+_verified_tokens = collections.OrderedDict()
+_unverified_tokens = collections.OrderedDict()
+_tokens_cache_lock = threading.Lock()
+
+
+def _get_token_digest(token, secret_key=None) -> bytes:
+    if isinstance(token, str):
+        token = token.encode()
+    token_digest = hashlib.sha256(token)
+    if secret_key is not None:
+        token_digest.update(b'\0' + (secret_key.encode() if isinstance(secret_key, str) else secret_key))
+    return token_digest.digest()
+
+
+def _get_cached_payload(cache, digest):
+    with _tokens_cache_lock:
+        payload = cache.get(digest)
+        if payload is not None:
+            cache.move_to_end(digest)
+    return payload
+
+
+def _cache_payload(cache, digest, payload, cache_size):
+    with _tokens_cache_lock:
+        cache[digest] = payload
+        while len(cache) > cache_size:
+            cache.popitem(last=False)
+
+
+def get_verified_token(token, secret_key):
+    """
+    decodes the token and verifies it: the payloads of the last verified tokens are kept, by digest of the token
+    and the secret key, and returned without verifying them again until they expire
+    """
+    digest = _get_token_digest(token, secret_key)
+    payload = _get_cached_payload(_verified_tokens, digest)
+    # as in jwt.decode, the token is expired from exp on
+    if payload is not None and ('exp' not in payload or time.time() < payload['exp']):
+        request_counters.increment('token_verification_cache_hits')
+    else:
+        # an expired token is decoded again, to raise the ExpiredSignatureError
+        payload = jwt.decode(token, secret_key, algorithms=[default_algorithm])
+        request_counters.increment('token_verifications')
+        _cache_payload(_verified_tokens, digest, payload, verified_tokens_cache_size)
+
+    # the callers can modify the payload they get
+    return copy.deepcopy(payload)
+
+
+def get_unverified_token_claims(token):
+    """
+    returns the claims of the token, without verifying its signature, nor its expiration: only for inspecting it
+    """
+    digest = _get_token_digest(token)
+    claims = _get_cached_payload(_unverified_tokens, digest)
+    if claims is None:
+        try:
+            if isinstance(token, bytes):
+                token = token.decode()
+            header_segment, payload_segment, signature_segment = token.split('.')
+            claims = json.loads(base64.urlsafe_b64decode(payload_segment + '=' * (-len(payload_segment) % 4)))
+        except (AttributeError, UnicodeDecodeError, ValueError, binascii.Error) as e:
+            raise jwt.exceptions.DecodeError(f"Invalid token: {e}")
+        if not isinstance(claims, dict):
+            raise jwt.exceptions.DecodeError("Invalid payload string: must be a json object")
+        _cache_payload(_unverified_tokens, digest, claims, unverified_tokens_cache_size)
+
+    return copy.deepcopy(claims)
+
+
 def get_decoded_token(token, secret_key, validate_token=True):
     # decode the encoded token
     if token is not None:
         if validate_token:
-            return jwt.decode(token, secret_key, algorithms=[default_algorithm])
+            return get_verified_token(token, secret_key)
         else:
-            return jwt.decode(token, "",
-                              algorithms=[default_algorithm],
-                              options=dict(
-                                verify_signature=False
-                            ))
+            return get_unverified_token_claims(token)
 
 
 def encode_token(payload, secret_key, algorithm=default_algorithm):
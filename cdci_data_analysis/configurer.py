@@ -223,6 +223,9 @@ class ConfigEnv(object):
                                      disp_dict.get('sentry_environment', 'production'),
                                      disp_dict['logstash_host'],
                                      disp_dict['logstash_port'],
+                                     disp_dict.get('logstash_queue_max_size', 10000),
+                                     disp_dict.get('logstash_batch_max_size', 100),
+                                     disp_dict.get('logstash_framing', 'json'),
                                      products_url,
                                      disp_dict['dispatcher_callback_url_base'],
                                      disp_dict['secret_key'],
@@ -230,6 +233,18 @@ class ConfigEnv(object):
                                      disp_dict.get('resubmit_timeout', 1800),
                                      disp_dict.get('soft_minimum_folder_age_days', 5),
                                      disp_dict.get('hard_minimum_folder_age_days', 30),
+                                     disp_dict.get('free_up_space_max_workers', 4),
+                                     disp_dict.get('instrument_prototype_pool', True),
+                                     disp_dict.get('download_streaming', False),
+                                     disp_dict.get('download_compression_level', 9),
+                                     disp_dict.get('download_cache_max_size_mb', 1024),
+                                     disp_dict.get('notification_outbox', False),
+                                     disp_dict.get('notification_outbox_max_workers', 2),
+                                     disp_dict.get('notification_outbox_n_max_tries', 5),
+                                     disp_dict.get('call_back_coalescing_interval_s', 0),
+                                     disp_dict.get('status_poll_fast_path', True),
+                                     disp_dict.get('scratch_dir_layout', 'flat'),
+                                     disp_dict.get('scratch_dir_lock_timeout_s', 10),
                                      disp_dict.get('cors_options', {}).get('cors_allowed_origins', None),
                                      disp_dict.get('cors_options', {}).get('cors_allowed_headers', None),
                                      disp_dict.get('cors_options', {}).get('cors_allowed_methods', None),
@@ -270,6 +285,11 @@ class ConfigEnv(object):
                                                                                       'http://cdsweb.u-strasbg.fr/cgi-bin/nph-sesame/-oxp/NSV?{}'),
                                      disp_dict.get('product_gallery_options', {}).get('entities_portal_url', 'http://cdsportal.u-strasbg.fr/?target={}'),
                                      disp_dict.get('product_gallery_options', {}).get('converttime_revnum_service_url', 'https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM'),
+                                     disp_dict.get('product_gallery_options', {}).get('product_gallery_connect_timeout_s', 10),
+                                     disp_dict.get('product_gallery_options', {}).get('product_gallery_read_timeout_s', 300),
+                                     disp_dict.get('product_gallery_options', {}).get('product_gallery_n_max_tries', 10),
+                                     disp_dict.get('product_gallery_options', {}).get('product_gallery_retry_sleep_s', .5),
+                                     disp_dict.get('product_gallery_options', {}).get('product_gallery_max_retry_sleep_s', 30),
                                      disp_dict.get('renku_options', {}).get('renku_gitlab_repository_url', None),
                                      disp_dict.get('renku_options', {}).get('renku_base_project_url', None),
                                      disp_dict.get('renku_options', {}).get('ssh_key_path', None),
@@ -282,6 +302,9 @@ class ConfigEnv(object):
                                      disp_dict.get('vo_options', {}).get('vo_psql_pg_user', "mmoda_pg_user"),
                                      disp_dict.get('vo_options', {}).get('vo_psql_pg_password', os.environ.get("POSTGRESQL_PASSWORD", None)),
                                      disp_dict.get('vo_options', {}).get('vo_psql_pg_db', "mmoda_pg_db"),
+                                     disp_dict.get('vo_options', {}).get('vo_psql_pg_pool_max_connections', 5),
+                                     disp_dict.get('vo_options', {}).get('vo_psql_pg_fetch_chunk_size', 1000),
+                                     disp_dict.get('vo_options', {}).get('vo_tables_cache_ttl_s', 300),
                                      )
 
         # not used?
@@ -318,6 +341,9 @@ class ConfigEnv(object):
                             sentry_environment,
                             logstash_host,
                             logstash_port,
+                            logstash_queue_max_size,
+                            logstash_batch_max_size,
+                            logstash_framing,
                             products_url,
                             dispatcher_callback_url_base,
                             secret_key,
@@ -325,6 +351,18 @@ class ConfigEnv(object):
                             resubmit_timeout,
                             soft_minimum_folder_age_days,
                             hard_minimum_folder_age_days,
+                            free_up_space_max_workers,
+                            instrument_prototype_pool,
+                            download_streaming,
+                            download_compression_level,
+                            download_cache_max_size_mb,
+                            notification_outbox,
+                            notification_outbox_max_workers,
+                            notification_outbox_n_max_tries,
+                            call_back_coalescing_interval_s,
+                            status_poll_fast_path,
+                            scratch_dir_layout,
+                            scratch_dir_lock_timeout_s,
                             cors_allowed_origins,
                             cors_allowed_headers,
                             cors_allowed_methods,
@@ -362,6 +400,11 @@ class ConfigEnv(object):
                             external_name_resolver_url,
                             entities_portal_url,
                             converttime_revnum_service_url,
+                            product_gallery_connect_timeout_s,
+                            product_gallery_read_timeout_s,
+                            product_gallery_n_max_tries,
+                            product_gallery_retry_sleep_s,
+                            product_gallery_max_retry_sleep_s,
                             renku_gitlab_repository_url,
                             renku_base_project_url,
                             renku_gitlab_ssh_key_path,
@@ -373,7 +416,10 @@ class ConfigEnv(object):
                             vo_psql_pg_port,
                             vo_psql_pg_user,
                             vo_psql_pg_password,
-                            vo_psql_pg_db
+                            vo_psql_pg_db,
+                            vo_psql_pg_pool_max_connections,
+                            vo_psql_pg_fetch_chunk_size,
+                            vo_tables_cache_ttl_s
                             ):
         # Generic to dispatcher
         #print(dispatcher_url, dispatcher_port)
@@ -383,6 +429,9 @@ class ConfigEnv(object):
         self.sentry_environment = sentry_environment
         self.logstash_host = logstash_host
         self.logstash_port = logstash_port
+        self.logstash_queue_max_size = logstash_queue_max_size
+        self.logstash_batch_max_size = logstash_batch_max_size
+        self.logstash_framing = logstash_framing
         self.products_url = products_url
         self.dispatcher_callback_url_base = dispatcher_callback_url_base
         self.secret_key = secret_key
@@ -390,6 +439,18 @@ class ConfigEnv(object):
         self.resubmit_timeout = resubmit_timeout
         self.soft_minimum_folder_age_days = soft_minimum_folder_age_days
         self.hard_minimum_folder_age_days = hard_minimum_folder_age_days
+        self.free_up_space_max_workers = free_up_space_max_workers
+        self.instrument_prototype_pool = instrument_prototype_pool
+        self.download_streaming = download_streaming
+        self.download_compression_level = download_compression_level
+        self.download_cache_max_size_mb = download_cache_max_size_mb
+        self.notification_outbox = notification_outbox
+        self.notification_outbox_max_workers = notification_outbox_max_workers
+        self.notification_outbox_n_max_tries = notification_outbox_n_max_tries
+        self.call_back_coalescing_interval_s = call_back_coalescing_interval_s
+        self.status_poll_fast_path = status_poll_fast_path
+        self.scratch_dir_layout = scratch_dir_layout
+        self.scratch_dir_lock_timeout_s = scratch_dir_lock_timeout_s
         self.cors_allowed_origins = cors_allowed_origins
         self.cors_allowed_headers = cors_allowed_headers
         self.cors_allowed_methods = cors_allowed_methods
@@ -427,6 +488,11 @@ class ConfigEnv(object):
         self.external_name_resolver_url = external_name_resolver_url
         self.entities_portal_url = entities_portal_url
         self.converttime_revnum_service_url = converttime_revnum_service_url
+        self.product_gallery_connect_timeout_s = product_gallery_connect_timeout_s
+        self.product_gallery_read_timeout_s = product_gallery_read_timeout_s
+        self.product_gallery_n_max_tries = product_gallery_n_max_tries
+        self.product_gallery_retry_sleep_s = product_gallery_retry_sleep_s
+        self.product_gallery_max_retry_sleep_s = product_gallery_max_retry_sleep_s
         self.renku_gitlab_repository_url = renku_gitlab_repository_url
         self.renku_gitlab_ssh_key_path = renku_gitlab_ssh_key_path
         self.renku_base_project_url = renku_base_project_url
@@ -439,6 +505,9 @@ class ConfigEnv(object):
         self.vo_psql_pg_user = vo_psql_pg_user
         self.vo_psql_pg_password = vo_psql_pg_password
         self.vo_psql_pg_db = vo_psql_pg_db
+        self.vo_psql_pg_pool_max_connections = vo_psql_pg_pool_max_connections
+        self.vo_psql_pg_fetch_chunk_size = vo_psql_pg_fetch_chunk_size
+        self.vo_tables_cache_ttl_s = vo_tables_cache_ttl_s
 
     def get_data_serve_conf(self, instr_name):
         if instr_name in self.data_server_conf_dict.keys():
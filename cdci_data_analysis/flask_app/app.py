@@ -20,7 +20,7 @@ import validators
 import re
 import logging
 
-from flask import jsonify, send_from_directory, redirect, Response, Flask, request, make_response, g, url_for
+from flask import jsonify, send_from_directory, redirect, Response, Flask, request, make_response, g, url_for, has_app_context
 
 # restx not really used
 from flask_restx import Api, Resource
@@ -28,8 +28,9 @@ from flask_restx import Api, Resource
 import time as _time
 from urllib.parse import urlencode, urlparse
 
-from cdci_data_analysis.analysis import drupal_helper, tokenHelper, email_helper, matrix_helper
-from .logstash import logstash_message
+from cdci_data_analysis.analysis import drupal_helper, tokenHelper, email_helper, matrix_helper, notification_outbox, template_helper, \
+    call_back_journal, request_counters, scratch_layout, lock_manager, job_registry
+from .logstash import logstash_message, get_logstash_shipper
 from .schemas import QueryOutJSON, dispatcher_strict_validate
 from marshmallow.exceptions import ValidationError
 
@@ -50,7 +51,6 @@ from oda_api.api import DispatcherAPI
 from oda_api.plot_tools_utils import Image
 
 from cdci_data_analysis.configurer import ConfigEnv
-from cdci_data_analysis.timer import block_timer
 
 logger = app_logging.getLogger('flask_app')
 
@@ -89,7 +89,26 @@ def reload_plugin(name):
     except ModuleNotFoundError as e:
         return f'Plugin {name} not found\n', 400
 
+
+@app.route('/reload-templates')
+def reload_templates():
+    template_names = template_helper.reload_templates()
+    return f'Templates {", ".join(template_names)} reloaded\n'
+
     
+@app.route('/reload-tap-tables')
+def reload_tap_tables():
+    ivoa_helper.invalidate_metadata_cache()
+    return 'TAP tables metadata reloaded\n'
+
+
+@app.route('/request-counters')
+def get_request_counters():
+    return jsonify(dict(**request_counters.get_process_counters(),
+                        scratch_dir_lock_contention=lock_manager.get_lock_manager().get_jobs_contention(),
+                        gallery_endpoints=drupal_helper.get_gallery_client().get_metrics()))
+
+
 @app.route("/api/meta-data")
 def run_api_meta_data():
     query = InstrumentQueryBackEnd(app, get_meta_data=True)
@@ -250,17 +269,7 @@ def common_exception_payload():
     payload['cdci_data_analysis_version_details'] = os.getenv('DISPATCHER_VERSION_DETAILS', 'unknown')
     payload['oda_api_version'] = oda_api.__version__
     
-    with block_timer(logger=logger, 
-                     message_template="Instrument factory iteration took {:.1f} seconds"): 
-        _l = []
-        for instrument_factory in importer.instrument_factory_iter:
-            if hasattr(instrument_factory, 'instr_name'):
-                iname = instrument_factory.instr_name
-            else:
-                iname = instrument_factory().name
-            _l.append(str(iname))
-
-    payload['installed_instruments'] = _l
+    payload['installed_instruments'] = [str(iname) for iname in importer.instrument_factory_iter.instrument_names]
 
     payload['debug_mode'] = os.environ.get(
         'DISPATCHER_DEBUG_MODE', 'no')  # change the default
@@ -343,7 +352,7 @@ def inspect_user_state():
     user_email = tokenHelper.get_token_user_email_address(decoded_token)
     state_data_obj = InstrumentQueryBackEnd.inspect_user_state(user_email)
 
-    return jsonify(dict(records=state_data_obj['records']))
+    return jsonify(state_data_obj)
 
 
 @app.route('/inspect-state', methods=['POST', 'GET'])
@@ -360,7 +369,7 @@ def inspect_state():
         return make_response(decoded_token, output_code)
 
     state_data_obj = InstrumentQueryBackEnd.inspect_state()
-    return jsonify(dict(records=state_data_obj['records']))
+    return jsonify(state_data_obj)
 
 
 @app.route('/instr-list')
@@ -397,8 +406,7 @@ def push_renku_branch():
         # TODO check job_id is provided with the request
         job_id = par_dic.pop('job_id')
         # Get the API code to push to the new renku branch
-        scratch_dir_pattern = f'scratch_sid_*_jid_{job_id}*'
-        list_scratch_folders = glob.glob(scratch_dir_pattern)
+        list_scratch_folders = scratch_layout.get_scratch_layout().find_job_scratch_dirs(job_id)
         if len(list_scratch_folders) >= 1:
             analysis_parameters_content_original = None
             for scratch_folder in list_scratch_folders:
@@ -469,14 +477,22 @@ class TAPQueryResult(Resource):
             vo_psql_pg_user = app_config.vo_psql_pg_user
             vo_psql_pg_password = app_config.vo_psql_pg_password
             vo_psql_pg_db = app_config.vo_psql_pg_db
-
-            result_request = ivoa_helper.run_metadata_query(vo_psql_pg_host=vo_psql_pg_host,
-                                                            vo_psql_pg_port=vo_psql_pg_port,
-                                                            vo_psql_pg_user=vo_psql_pg_user,
-                                                            vo_psql_pg_password=vo_psql_pg_password,
-                                                            vo_psql_pg_db=vo_psql_pg_db)
-
-            return output_xml(result_request, 200)
+            vo_psql_pg_pool_max_connections = app_config.vo_psql_pg_pool_max_connections
+            vo_tables_cache_ttl_s = app_config.vo_tables_cache_ttl_s
+
+            result_request = ivoa_helper.run_cached_metadata_query(vo_psql_pg_host=vo_psql_pg_host,
+                                                                   vo_psql_pg_port=vo_psql_pg_port,
+                                                                   vo_psql_pg_user=vo_psql_pg_user,
+                                                                   vo_psql_pg_password=vo_psql_pg_password,
+                                                                   vo_psql_pg_db=vo_psql_pg_db,
+                                                                   vo_psql_pg_pool_max_connections=vo_psql_pg_pool_max_connections,
+                                                                   metadata_cache_ttl_s=vo_tables_cache_ttl_s)
+
+            response = output_xml(result_request['tableset'], 200)
+            # the clients can revalidate the document with If-None-Match or If-Modified-Since
+            response.set_etag(result_request['etag'])
+            response.last_modified = result_request['last_modified']
+            return response.make_conditional(request)
 
         return make_response(f"The requested tap service is currently not available.", 501)
 
@@ -497,6 +513,8 @@ class TAPQueryResult(Resource):
                 vo_psql_pg_user = app_config.vo_psql_pg_user
                 vo_psql_pg_password = app_config.vo_psql_pg_password
                 vo_psql_pg_db = app_config.vo_psql_pg_db
+                vo_psql_pg_pool_max_connections = app_config.vo_psql_pg_pool_max_connections
+                vo_psql_pg_fetch_chunk_size = app_config.vo_psql_pg_fetch_chunk_size
                 product_gallery_url = app_config.product_gallery_url
                 # This is an example of the URL for a synchronous ADQL query on r magnitude:
                 # http://some.where/tap/sync?
@@ -520,7 +538,11 @@ class TAPQueryResult(Resource):
                                                                     vo_psql_pg_user=vo_psql_pg_user,
                                                                     vo_psql_pg_password=vo_psql_pg_password,
                                                                     vo_psql_pg_db=vo_psql_pg_db,
-                                                                    product_gallery_url=product_gallery_url)
+                                                                    vo_psql_pg_pool_max_connections=vo_psql_pg_pool_max_connections,
+                                                                    vo_psql_pg_fetch_chunk_size=vo_psql_pg_fetch_chunk_size,
+                                                                    product_gallery_url=product_gallery_url,
+                                                                    # the VOTable is sent while the result is fetched
+                                                                    stream=True)
                     else:
                         make_response(f"Language {tap_lang} currently not supported", 501)
 
@@ -567,6 +589,7 @@ def run_analysis():
     """
 
     request_summary = log_run_query_request()
+    query = None
 
     try:
         sanitized_request_values = sanitize_dict_before_log(request.values)
@@ -578,13 +601,18 @@ def run_analysis():
         query_id = hashlib.sha224(str(request.values).encode()).hexdigest()[:8]
 
         t0 = g.request_start_time
-        query = InstrumentQueryBackEnd(app, query_id=query_id)
-        r = query.run_query(disp_conf=app.config['conf'])
+        r = None
+        if InstrumentQueryBackEnd.is_status_poll_request(request, app.config['conf']):
+            query = InstrumentQueryBackEnd(app, query_id=query_id, status_poll=True)
+            r = query.run_status_poll()
+        if r is None:
+            query = InstrumentQueryBackEnd(app, query_id=query_id)
+            r = query.run_query(disp_conf=app.config['conf'])
         logger.info("run_analysis for %s took %g seconds", request.args.get(
             'client-name', 'unknown'), _time.time() - t0)
 
         logger.info("towards log_run_query_result")
-        log_run_query_result(request_summary, r[0])
+        log_run_query_result(request_summary, r[0], result_summary=getattr(query, 'response_summary', None))
 
         return r
 
@@ -774,19 +802,70 @@ def dataserver_call_back():
 
     logger.info('\033[33m raw request values: %s \033[0m', dict(sanitized_request_values))
 
-    query_id = hashlib.sha224(str(request.values).encode()).hexdigest()[:8]
+    t0 = _time.time()
+
+    # batched form, with the values of several callbacks
+    batch = request.get_json(silent=True) if request.is_json else None
+    if isinstance(batch, dict) and 'call_backs' in batch:
+        call_backs = batch['call_backs']
+        if not isinstance(call_backs, list) or not all(isinstance(c, dict) for c in call_backs):
+            raise RequestNotUnderstood("call_backs should be a list of the values of the callbacks")
+        n_queued = 0
+        for call_back_values in call_backs:
+            call_back_values = {k: str(v) for k, v in call_back_values.items() if v is not None}
+            n_queued += accept_call_back(call_back_values, accepted_time=t0) == 'queued'
+        logger.info(f'\033[32m===========================> batch of {len(call_backs)} callbacks ({n_queued} queued) '
+                    f'DONE in {_time.time() - t0}\033[0m')
+        return jsonify({'time_spent_s': _time.time() - t0, 'n_call_backs': len(call_backs), 'n_queued': n_queued})
+
+    if accept_call_back(request.values.to_dict()) == 'queued':
+        return jsonify({'time_spent_s': _time.time() - t0, 'call_back_status': 'queued'})
+
+    return jsonify({'time_spent_s': _time.time() - t0})
+
+
+def accept_call_back(call_back_values, accepted_time=None):
+    """
+    journals the callback when they are coalesced, otherwise processes it right away
+    """
+    coalescer = call_back_journal.get_call_back_coalescer()
+    if coalescer is None:
+        process_call_back(call_back_values, accepted_time=accepted_time)
+        return 'processed'
+
+    if coalescer.accept(call_back_values):
+        return 'queued'
+
+    key = coalescer.journal.get_key(call_back_values)
+    if key is None:
+        process_call_back(call_back_values, accepted_time=accepted_time)
+    else:
+        with coalescer.job_lock(key):
+            coalescer.discard(call_back_values)
+            process_call_back(call_back_values, accepted_time=accepted_time)
+    return 'processed'
+
+
+def process_call_back(call_back_values, accepted_time=None):
+    if accepted_time is not None or not has_app_context():
+        # not the callback of the current request, processed in its own application context
+        with app.app_context():
+            g.request_start_time = accepted_time if accepted_time is not None else _time.time()
+            return process_call_back(call_back_values)
+
+    query_id = hashlib.sha224(str(call_back_values).encode()).hexdigest()[:8]
 
     t0 = _time.time()
     # TODO get rid of the mock instrument
     query = InstrumentQueryBackEnd(
         app,
         instrument_name='mock',
+        par_dic=InstrumentQueryBackEnd.get_par_dic_from_args(call_back_values),
         data_server_call_back=True,
         query_id=query_id)
     logger.info(f'\033[32m===========================> [{query_id}] dataserver_call_back constructor done in {_time.time() - t0} s\033[0m')
     query.run_call_back()
     logger.info(f'\033[32m===========================> [{query_id}] dataserver_call_back DONE in {_time.time() - t0}\033[0m')
-    return jsonify({'time_spent_s': _time.time() - t0})
 
 
 ####################################### API #######################################
@@ -1514,6 +1593,12 @@ def conf_app(conf):
                                         set_by=f'command line {__file__}:{__name__}')
 
     app.config['conf'] = conf
+    drupal_helper.configure_gallery_client(conf)
+    notification_outbox.configure_notification_outbox(conf)
+    call_back_journal.configure_call_back_coalescer(conf, process_call_back)
+    scratch_layout.configure_scratch_layout(conf)
+    lock_manager.configure_lock_manager(conf)
+    job_registry.start_job_registry_population()
     return app
 
 def run_app(conf, debug=False, threaded=False):
@@ -1526,7 +1611,27 @@ def run_app(conf, debug=False, threaded=False):
             debug=debug, threaded=threaded)
 
 
+def is_run_query_logged() -> bool:
+    """
+    the summaries of the requests and of their results are built only to be sent to logstash, or logged in debug
+    """
+    return get_logstash_shipper(app.config['conf']) is not None or logger.isEnabledFor(logging.DEBUG)
+
+
+def extend_json_object(object_json: str, extra: dict) -> str:
+    # adds the items of extra to the serialized object, without serializing it again
+    if len(extra) == 0:
+        return object_json
+    extra_json = json.dumps(extra)
+    if object_json == '{}':
+        return extra_json
+    return object_json[:-1] + ', ' + extra_json[1:]
+
+
 def log_run_query_request():
+    if not is_run_query_logged():
+        return None
+
     request_summary = {}
 
     try:
@@ -1561,8 +1666,10 @@ def log_run_query_request():
             logger.warning("unable to extract client")
 
         request_summary_json = json.dumps(request_summary)
-        logger.info("request_summary: %s", request_summary_json)
+        logger.debug("request_summary: %s", request_summary_json)
         logstash_message(app, request_summary_json)
+        # serialized once, also for the summary of the result
+        request_summary['json'] = request_summary_json
     except Exception as e:
         logger.error("failed to logstash request in log_run_query_request: %s\n%s", repr(e), traceback.format_exception())
         raise
@@ -1570,22 +1677,27 @@ def log_run_query_request():
     return request_summary
     
 
-def log_run_query_result(request_summary, result):
-    logger.info("IN log_run_query_result")
-    try:
-        request_summary['dispatcher-state'] = 'returning'
+def log_run_query_result(request_summary, result, result_summary=None):
+    """
+    logs the result of the request, summarized by the backend from its output before the serialization,
+    without parsing the response
+    """
+    if request_summary is None:
+        return result
 
-        logger.info("returning data %s", result.data[:100])
+    logger.debug("IN log_run_query_result")
+    try:
+        result_items = {'dispatcher-state': 'returning'}
 
-        try:
-            result_json = json.loads(result.data)
-            logger.debug("query result keys: %s", result_json.keys())
-            request_summary['return_exit_status']=result_json['exit_status']
-            request_summary['return_job_status']=result_json['job_status']
-        except Exception:
-            logger.warning("not returning json")
+        if result_summary is not None:
+            if 'exit_status' in result_summary:
+                result_items['return_exit_status'] = result_summary['exit_status']
+            if 'job_status' in result_summary:
+                result_items['return_job_status'] = result_summary['job_status']
+        else:
+            logger.warning("no summary of the result")
 
-        request_summary_json = json.dumps(request_summary)
+        request_summary_json = extend_json_object(request_summary['json'], result_items)
         logger.debug("request_summary: %s", request_summary_json)
         logstash_message(app, request_summary_json)
     except Exception as e:
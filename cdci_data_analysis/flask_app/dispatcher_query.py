@@ -19,13 +19,13 @@ from collections import OrderedDict
 import glob
 import string
 import random
-import fcntl
 
-from flask import jsonify, send_from_directory, make_response
+from flask import jsonify, send_from_directory, send_file, make_response, Response, stream_with_context
 from flask import request, g
 import time as time_
 
 import tempfile
+import uuid
 import tarfile
 import gzip
 import socket
@@ -37,6 +37,8 @@ import logging
 import json
 import typing
 
+from concurrent.futures import ThreadPoolExecutor
+
 from ..plugins import importer
 from ..analysis.queries import SourceQuery
 from ..analysis import tokenHelper, email_helper, matrix_helper
@@ -44,6 +46,8 @@ from ..analysis.instrument import params_not_to_be_included
 from ..analysis.hash import make_hash
 from ..analysis.hash import default_kw_black_list
 from ..analysis.job_manager import job_factory
+from ..analysis import job_registry, scratch_cleanup, download_helper, download_cache, notification_outbox, request_counters, \
+    ownership_registry, scratch_layout, lock_manager
 from ..analysis.io_helper import FilePath, format_size
 from .mock_data_server import mock_query
 from ..analysis.products import QueryOutput
@@ -57,7 +61,6 @@ from .logstash import logstash_message
 
 from oda_api.data_products import NumpyDataProduct
 import oda_api
-from cdci_data_analysis.timer import block_timer
 
 logger = logging.getLogger(__name__)
 
@@ -80,6 +83,10 @@ class InvalidJobIDProvided(BadRequest):
     pass
 
 
+# the query statuses of the polls of a submitted job, answered from its job monitor
+status_poll_query_statuses = ['progress', 'unaccessible', 'unknown', 'submitted']
+
+
 class InstrumentQueryBackEnd:
 
     def __repr__(self):
@@ -120,7 +127,8 @@ class InstrumentQueryBackEnd:
                  download_files=False,
                  resolve_job_url=False,
                  query_id=None,
-                 update_token=False):
+                 update_token=False,
+                 status_poll=False):
         self.logger = logging.getLogger(f"{repr(self)} [{query_id}]")
         self.logger = logging.getLogger(repr(self))
 
@@ -137,7 +145,6 @@ class InstrumentQueryBackEnd:
         self.app = app
 
         temp_scratch_dir = None
-        temp_job_id = None
 
         self.set_sentry_sdk(getattr(self.app.config.get('conf'), 'sentry_url', None))
 
@@ -255,6 +262,14 @@ class InstrumentQueryBackEnd:
                 #self.set_scratch_dir(self.par_dic['session_id'], verbose=verbose)
                 #self.set_session_logger(self.scratch_dir, verbose=verbose, config=config)
                 # self.set_sentry_client()
+            elif status_poll:
+                self.logger.info("status poll request: existing scratch_dir, no instrument")
+                self.instrument = None
+                self.job_id = self.par_dic.get('job_id')
+                self.scratch_dir = self.find_job_scratch_dir(self.par_dic['session_id'], self.job_id)
+                if self.scratch_dir is not None:
+                    self.set_session_logger(self.scratch_dir, verbose=verbose, config=config)
+                self.config = config
             else:
                 logger.debug("NOT get_meta_data request: yes scratch_dir")
                 # TODO why here and not at the beginning ?
@@ -286,7 +301,6 @@ class InstrumentQueryBackEnd:
                     self.set_scratch_dir(self.par_dic['session_id'], job_id=self.job_id, verbose=verbose)
                     # temp_job_id = self.job_id
                     temp_scratch_dir = self.scratch_dir
-                    temp_job_id = self.job_id
                 if not data_server_call_back:
                     try:
                         self.set_temp_dir(self.par_dic['session_id'], verbose=verbose)
@@ -367,7 +381,7 @@ class InstrumentQueryBackEnd:
         finally:
             self.logger.info("==> clean-up temporary directory")
             self.log_query_progression("before clear_temp_dir")
-            self.clear_temp_dir(temp_scratch_dir=temp_scratch_dir, temp_job_id=temp_job_id)
+            self.clear_temp_dir(temp_scratch_dir=temp_scratch_dir)
             self.log_query_progression("after clear_temp_dir")
             
         logger.info("constructed %s:%s for data_server_call_back=%s", self.__class__, self, data_server_call_back)
@@ -395,76 +409,159 @@ class InstrumentQueryBackEnd:
         else:
             soft_minimum_folder_age_days = int(soft_minimum_folder_age_days)
 
-        list_scratch_dir = sorted(glob.glob("scratch_sid_*_jid_*"), key=os.path.getmtime)
-        list_scratch_dir_to_delete = []
+        # in dry-run mode, nothing is removed, and the space that would be freed is reported
+        dry_run = request.args.get('dry_run', False) == 'True'
+        # incremental mode: at most max_dirs folders are checked, for at most max_seconds,
+        # the returned next_cursor allows to continue the sweep with the following call
+        max_dirs = request.args.get('max_dirs', None, type=int)
+        max_seconds = request.args.get('max_seconds', None, type=float)
+        cursor = request.args.get('cursor', None, type=float)
+
+        max_workers = app_config.free_up_space_max_workers
 
+        scan = scratch_cleanup.scan_working_dir()
+        list_scratch_dir = sorted(scan.scratch_dirs, key=lambda d: d.mtime)
+
+        list_scratch_dir_to_check = []
         for scratch_dir in list_scratch_dir:
-            scratch_dir_age_days = (current_time_secs - os.path.getmtime(scratch_dir)) / (60 * 60 * 24)
+            if cursor is not None and scratch_dir.mtime <= cursor:
+                continue
+            scratch_dir_age_days = (current_time_secs - scratch_dir.mtime) / (60 * 60 * 24)
+            if scratch_dir_age_days < soft_minimum_folder_age_days and scratch_dir_age_days < hard_minimum_folder_age_days:
+                break
+            list_scratch_dir_to_check.append(scratch_dir)
+
+        def is_scratch_dir_to_delete(scratch_dir):
+            scratch_dir_age_days = (current_time_secs - scratch_dir.mtime) / (60 * 60 * 24)
             if scratch_dir_age_days >= hard_minimum_folder_age_days:
-                list_scratch_dir_to_delete.append(scratch_dir)
-            elif scratch_dir_age_days >= soft_minimum_folder_age_days:
-                analysis_parameters_path = os.path.join(scratch_dir, 'analysis_parameters.json')
+                return True
+
+            try:
+                analysis_parameters_path = os.path.join(scratch_dir.path, 'analysis_parameters.json')
                 with open(analysis_parameters_path) as analysis_parameters_file:
                     dict_analysis_parameters = json.load(analysis_parameters_file)
-                token = dict_analysis_parameters.get('token', None)
-                token_expired = False
-                if token is not None:
-                    try:
-                        tokenHelper.get_decoded_token(token, secret_key)
-                    except jwt.exceptions.ExpiredSignatureError:
-                        token_expired = True
 
-                job_monitor_path = os.path.join(scratch_dir, 'job_monitor.json')
+                job_monitor_path = os.path.join(scratch_dir.path, 'job_monitor.json')
                 with open(job_monitor_path, 'r') as jm_file:
                     monitor = json.load(jm_file)
-                    job_status = monitor['status']
-                    job_id = monitor['job_id']
-                if job_status == 'done' and (token is None or token_expired):
-                    list_scratch_dir_to_delete.append(scratch_dir)
-                else:
-                    incomplete_job_alert_message = f"The job {job_id} is yet to complete despite being older "\
-                                                   f"than {soft_minimum_folder_age_days} days. This has been detected "\
-                                                   f"while checking for deletion the folder {scratch_dir}."
+            except (OSError, ValueError) as e:
+                logger.warning("unable to check the folder %s for deletion: %s", scratch_dir.path, repr(e))
+                return False
 
-                    logger.info(incomplete_job_alert_message)
-                    sentry.capture_message(incomplete_job_alert_message)
-            else:
-                break
+            token = dict_analysis_parameters.get('token', None)
+            token_expired = False
+            if token is not None:
+                try:
+                    tokenHelper.get_decoded_token(token, secret_key)
+                except jwt.exceptions.ExpiredSignatureError:
+                    token_expired = True
+
+            job_status = monitor['status']
+            job_id = monitor['job_id']
+            if job_status == 'done' and (token is None or token_expired):
+                return True
+
+            incomplete_job_alert_message = f"The job {job_id} is yet to complete despite being older "\
+                                           f"than {soft_minimum_folder_age_days} days. This has been detected "\
+                                           f"while checking for deletion the folder {scratch_dir.path}."
+
+            logger.info(incomplete_job_alert_message)
+            sentry.capture_message(incomplete_job_alert_message)
+            return False
 
         pre_clean_space_stats = shutil.disk_usage(os.getcwd())
-        pre_clean_available_space =  format_size(pre_clean_space_stats.free, format_returned='M')
+        pre_clean_available_space = format_size(pre_clean_space_stats.free, format_returned='M')
 
         logger.info(f"Number of scratch folder before clean-up: {len(list_scratch_dir)}.\n"
                     f"The available amount of space is {pre_clean_available_space}")
 
-        for d in list_scratch_dir_to_delete:
-            shutil.rmtree(d)
+        list_scratch_dir_deleted = []
+        reclaimable_bytes = 0
+        next_cursor = None
+        n_checked = 0
+        chunk_size = 4 * max_workers
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while n_checked < len(list_scratch_dir_to_check):
+                if (max_dirs is not None and n_checked >= max_dirs) or \
+                        (max_seconds is not None and time.time() - current_time_secs >= max_seconds):
+                    next_cursor = list_scratch_dir_to_check[n_checked - 1].mtime
+                    break
+
+                if max_dirs is not None:
+                    chunk_size = min(chunk_size, max_dirs - n_checked)
+                chunk = list_scratch_dir_to_check[n_checked: n_checked + chunk_size]
+                n_checked += len(chunk)
+
+                chunk_to_delete = [scratch_dir.path for scratch_dir, to_delete in
+                                   zip(chunk, executor.map(is_scratch_dir_to_delete, chunk)) if to_delete]
+                if dry_run:
+                    reclaimable_bytes += sum(executor.map(scratch_cleanup.get_dir_size, chunk_to_delete))
+                    list_scratch_dir_deleted.extend(chunk_to_delete)
+                else:
+                    list_scratch_dir_deleted.extend(scratch_cleanup.remove_scratch_dirs(chunk_to_delete, executor))
 
-        list_lock_files = sorted(glob.glob(".lock_*"), key=os.path.getatime)
+        # the lock files are orphans if no scratch folder is left for their job_id
+        set_scratch_dir_deleted = set(list_scratch_dir_deleted)
+        remaining_job_ids = set(scratch_dir.job_id for scratch_dir in list_scratch_dir
+                                if scratch_dir.path not in set_scratch_dir_deleted)
         num_lock_files_removed = 0
-        for l in list_lock_files:
-            lock_file_job_id = l.split('_')[-1]
-            list_job_id_scratch_dir = glob.glob(f"scratch_sid_*_jid_{lock_file_job_id}*")
-            if len(list_job_id_scratch_dir) == 0:
-                os.remove(l)
+        for l in scan.lock_files:
+            if scratch_cleanup.get_lock_file_job_id(l) not in remaining_job_ids:
+                if not dry_run:
+                    try:
+                        os.remove(l)
+                    except FileNotFoundError:
+                        continue
                 num_lock_files_removed += 1
 
+        # the cached download archives of the removed jobs, or not used for a while, and the leftover download directories
+        soft_minimum_folder_age_time = current_time_secs - soft_minimum_folder_age_days * 24 * 60 * 60
+        list_download_archives_removed = []
+        app_download_cache = InstrumentQueryBackEnd.get_download_cache(app_config)
+        if app_download_cache is not None:
+            deleted_job_ids = set(scratch_dir.job_id for scratch_dir in list_scratch_dir
+                                  if scratch_dir.path in set_scratch_dir_deleted) - remaining_job_ids
+            list_download_archives_removed = app_download_cache.remove_entries(job_ids=deleted_job_ids,
+                                                                              older_than=soft_minimum_folder_age_time,
+                                                                              dry_run=dry_run)
+            if not dry_run:
+                list_download_archives_removed += app_download_cache.evict()
+        list_download_dirs_removed = download_cache.remove_download_dirs(older_than=soft_minimum_folder_age_time,
+                                                                         dry_run=dry_run)
+        logger.info(f"Removed {len(list_download_archives_removed)} cached download archives "
+                    f"and {len(list_download_dirs_removed)} download directories.")
+
+        if dry_run:
+            reclaimable_bytes += sum(entry.size for entry in list_download_archives_removed)
+            reclaimable_bytes += sum(map(scratch_cleanup.get_dir_size, list_download_dirs_removed))
+            result_scratch_dir_deletion = f"Would remove {len(list_scratch_dir_deleted)} scratch directories, " \
+                                          f"and {num_lock_files_removed} lock files, " \
+                                          f"freeing {format_size(reclaimable_bytes, format_returned='M')}."
+            logger.info(result_scratch_dir_deletion)
+            return jsonify(dict(output_status=result_scratch_dir_deletion,
+                                reclaimable_bytes=reclaimable_bytes,
+                                download_archives_removed=len(list_download_archives_removed),
+                                download_dirs_removed=len(list_download_dirs_removed),
+                                next_cursor=next_cursor))
+
         post_clean_space_space = shutil.disk_usage(os.getcwd())
         post_clean_available_space = format_size(post_clean_space_space.free, format_returned='M')
 
-        list_scratch_dir = sorted(glob.glob("scratch_sid_*_jid_*"))
-        list_lock_files = sorted(glob.glob(".lock_*"))
-        logger.info(f"Number of scratch folder after clean-up: {len(list_scratch_dir)}, "
-                    f"number of lock files after clean-up: {len(list_lock_files)}.\n"
-                    f"Removed {len(list_scratch_dir_to_delete)} scratch directories "
+        logger.info(f"Number of scratch folder after clean-up: {len(list_scratch_dir) - len(list_scratch_dir_deleted)}, "
+                    f"number of lock files after clean-up: {len(scan.lock_files) - num_lock_files_removed}.\n"
+                    f"Removed {len(list_scratch_dir_deleted)} scratch directories "
                     f"and {num_lock_files_removed} lock files.\n"
                     f"Now the available amount of space is {post_clean_available_space}")
 
-        result_scratch_dir_deletion = f"Removed {len(list_scratch_dir_to_delete)} scratch directories, " \
+        result_scratch_dir_deletion = f"Removed {len(list_scratch_dir_deleted)} scratch directories, " \
                                       f"and {num_lock_files_removed} lock files."
         logger.info(result_scratch_dir_deletion)
 
-        return jsonify(dict(output_status=result_scratch_dir_deletion))
+        return jsonify(dict(output_status=result_scratch_dir_deletion,
+                            download_archives_removed=len(list_download_archives_removed),
+                            download_dirs_removed=len(list_download_dirs_removed),
+                            next_cursor=next_cursor))
 
     @staticmethod
     def get_user_specific_instrument_list(app):
@@ -484,24 +581,7 @@ class InstrumentQueryBackEnd:
                 roles = tokenHelper.get_token_roles(decoded_token)
                 email = tokenHelper.get_token_user_email_address(decoded_token)
 
-        with block_timer(logger=logger, 
-                         message_template="Instrument factory iteration took {:.1f} seconds"):
-            out_instrument_list = []
-            for instrument_factory in importer.instrument_factory_iter:
-                if hasattr(instrument_factory, 'instrument_query'):
-                    instrument_query = instrument_factory.instrument_query
-                    if hasattr(instrument_factory, 'instr_name'):
-                        instr_name = instrument_factory.instr_name
-                    else:
-                        instr_name = instrument_factory().name
-                else:
-                    instrument = instrument_factory()
-                    instrument_query = instrument.instrumet_query
-                    instr_name = instrument.name
-                    
-
-                if instrument_query.check_instrument_access(roles, email):
-                    out_instrument_list.append(instr_name)
+        out_instrument_list = importer.instrument_factory_iter.get_accessible_instrument_names(roles, email)
 
         return jsonify(out_instrument_list)
 
@@ -517,64 +597,128 @@ class InstrumentQueryBackEnd:
         include_status_query_output = request.args.get('include_status_query_output', False) == 'True'
         exclude_analysis_parameters = request.args.get('exclude_analysis_parameters', False) == 'True'
         group_by_job = request.args.get('group_by_job', False) == 'True'
-        records_content = []
+        # pagination: at most limit records (jobs, if grouped) are returned,
+        # and the next page is requested passing the returned next_cursor
+        limit = request.args.get('limit', None, type=int)
+        cursor = request.args.get('cursor', None)
+        # projection: comma-separated list of the fields of the records (or of the scratch_dir_content, if grouped)
+        fields = request.args.get('fields', None)
+        if fields is not None:
+            fields = set(f.strip() for f in fields.split(',') if f.strip() != '')
+
+        if limit is not None and limit <= 0:
+            raise BadRequest("limit must be a positive integer")
+
+        after = None
+        after_job_id = None
+        if cursor is not None:
+            if group_by_job:
+                if re.fullmatch(r"[a-z0-9]{16}", cursor) is None:
+                    raise BadRequest(f"invalid cursor {cursor}")
+                after_job_id = cursor
+            else:
+                r_cursor = job_registry.parse_scratch_dir_name(cursor)
+                if r_cursor is None:
+                    raise BadRequest(f"invalid cursor {cursor}")
+                after = (r_cursor.group('job_id'), cursor)
 
-        for scratch_dir in glob.glob("scratch_sid_*_jid_*"):
-            r = re.match(
-                r"scratch_sid_(?P<session_id>[A-Z0-9]{16})_jid_(?P<job_id>[a-z0-9]{16})(?P<aliased_marker>_aliased|)",
-                scratch_dir)
-            if r is not None:
-                if job_id is not None:
-                    if r.group('job_id')[:8] != job_id:
-                        continue
-                scratch_dir_job_id = r.group('job_id')
-                if os.path.exists(scratch_dir):
-                    if (time_.time() - os.stat(scratch_dir).st_mtime) < recent_days * 24 * 3600:
-                        if group_by_job:
-                            result_job_status = InstrumentQueryBackEnd.read_job_status_scratch_dir(scratch_dir,
-                                                                                                   include_session_log=include_session_log,
-                                                                                                   include_status_query_output=include_status_query_output,
-                                                                                                   exclude_analysis_parameters=exclude_analysis_parameters,
-                                                                                                   user_email=user_email
-                                                                                                   )
-                            if result_job_status is not None:
-                                job_status_search_result = [(index, job_status_obj)
-                                                            for index, job_status_obj in enumerate(records_content) if
-                                                            job_status_obj.get('job_id') == scratch_dir_job_id]
-                                if len(job_status_search_result) > 0:
-                                    records_content[job_status_search_result[0][0]]['job_status_data'].append(dict(**result_job_status))
-                                else:
-                                    records_content.append(dict(
-                                        job_id=scratch_dir_job_id,
-                                        job_status_data=[dict(**result_job_status)]
-                                    )
-                                    )
-                        else:
-                            result_content, request_completed, token_expired = InstrumentQueryBackEnd.read_content_scratch_dir(scratch_dir,
-                                                                                                                               include_session_log=include_session_log,
-                                                                                                                               include_status_query_output=include_status_query_output,
-                                                                                                                               exclude_analysis_parameters=exclude_analysis_parameters,
-                                                                                                                               user_email=user_email)
-
-                            if result_content is not None:
-                                record = dict(
-                                    mtime=os.stat(scratch_dir).st_mtime,
-                                    ctime=os.stat(scratch_dir).st_ctime,
-                                    session_id=r.group('session_id'),
-                                    job_id=scratch_dir_job_id,
-                                    request_completed=request_completed,
-                                    aliased_marker=r.group('aliased_marker'),
-                                    **result_content
-                                )
-                                if token_expired is not None:
-                                    record['token_expired'] = token_expired
-                                records_content.append(record)
+        records_content = []
+        records_by_job_id = {}
+        next_cursor = None
+        last_cursor = None
+
+        # the index narrows down the candidate scratch directories, their actual state is then read from disk
+        min_mtime = time_.time() - recent_days * 24 * 3600 - job_registry.mtime_tolerance_s
+        if job_registry.is_job_registry_populated():
+            indexed_scratch_dirs = job_registry.get_job_registry().iter_find(
+                job_id_prefix=job_id,
+                sub=user_email,
+                min_mtime=min_mtime,
+                after=after,
+                after_job_id=after_job_id)
+        else:
+            # not all the scratch directories are indexed yet
+            indexed_scratch_dirs = job_registry.iter_scan(
+                job_id_prefix=job_id,
+                min_mtime=min_mtime,
+                after=after,
+                after_job_id=after_job_id)
+
+        for indexed_scratch_dir in indexed_scratch_dirs:
+            scratch_dir = indexed_scratch_dir['scratch_dir']
+            r = job_registry.parse_scratch_dir_name(scratch_dir)
+            if r is None:
+                continue
+            if job_id is not None:
+                if r.group('job_id')[:8] != job_id:
+                    continue
+            scratch_dir_job_id = r.group('job_id')
+
+            if limit is not None:
+                if group_by_job:
+                    page_full = len(records_by_job_id) >= limit and scratch_dir_job_id not in records_by_job_id
                 else:
-                    logger.warning(f"scratch_dir {scratch_dir} not existing, cannot be inspected")
+                    page_full = len(records_content) >= limit
+                if page_full:
+                    next_cursor = last_cursor
+                    break
+
+            if not os.path.exists(scratch_dir):
+                logger.warning(f"scratch_dir {scratch_dir} not existing, cannot be inspected")
+                job_registry.remove_from_job_registry(scratch_dir)
+                continue
+
+            scratch_dir_stat = os.stat(scratch_dir)
+            if (time_.time() - scratch_dir_stat.st_mtime) >= recent_days * 24 * 3600:
+                continue
+
+            if group_by_job:
+                result_job_status = InstrumentQueryBackEnd.read_job_status_scratch_dir(scratch_dir,
+                                                                                       include_session_log=include_session_log,
+                                                                                       include_status_query_output=include_status_query_output,
+                                                                                       exclude_analysis_parameters=exclude_analysis_parameters,
+                                                                                       user_email=user_email,
+                                                                                       fields=fields)
+                if result_job_status is not None:
+                    if scratch_dir_job_id not in records_by_job_id:
+                        records_by_job_id[scratch_dir_job_id] = dict(job_id=scratch_dir_job_id, job_status_data=[])
+                    records_by_job_id[scratch_dir_job_id]['job_status_data'].append(result_job_status)
+                    last_cursor = scratch_dir_job_id
+            else:
+                result_content, request_completed, token_expired = InstrumentQueryBackEnd.read_content_scratch_dir(scratch_dir,
+                                                                                                                   include_session_log=include_session_log,
+                                                                                                                   include_status_query_output=include_status_query_output,
+                                                                                                                   exclude_analysis_parameters=exclude_analysis_parameters,
+                                                                                                                   user_email=user_email,
+                                                                                                                   fields=fields)
+
+                if result_content is not None:
+                    record = dict(
+                        mtime=scratch_dir_stat.st_mtime,
+                        ctime=scratch_dir_stat.st_ctime,
+                        session_id=r.group('session_id'),
+                        job_id=scratch_dir_job_id,
+                        request_completed=request_completed,
+                        aliased_marker=r.group('aliased_marker'),
+                        **result_content
+                    )
+                    if token_expired is not None:
+                        record['token_expired'] = token_expired
+                    if fields is not None:
+                        record = {k: v for k, v in record.items() if k in fields or k == 'job_id'}
+                    records_content.append(record)
+                    last_cursor = scratch_dir
+
+        if group_by_job:
+            records_content = list(records_by_job_id.values())
 
         logger.info("found %s records", len(records_content))
 
-        return dict(records=records_content)
+        state_data_obj = dict(records=records_content)
+        if limit is not None:
+            state_data_obj['next_cursor'] = next_cursor
+
+        return state_data_obj
 
     @staticmethod
     def read_analysis_parameters_scratch_dir(scratch_dir, decode_token=False):
@@ -594,13 +738,14 @@ class InstrumentQueryBackEnd:
         return analysis_parameters_obj, reading_output_message
 
     @staticmethod
-    def read_job_status_scratch_dir(scratch_dir, include_session_log=False, include_status_query_output=False, exclude_analysis_parameters=True, user_email=None):
+    def read_job_status_scratch_dir(scratch_dir, include_session_log=False, include_status_query_output=False, exclude_analysis_parameters=True, user_email=None, fields=None):
         result_job_status = None
         result_content, request_completed, token_expired = InstrumentQueryBackEnd.read_content_scratch_dir(scratch_dir,
                                                                                                            include_session_log=include_session_log,
                                                                                                            include_status_query_output=include_status_query_output,
                                                                                                            exclude_analysis_parameters=exclude_analysis_parameters,
-                                                                                                           user_email=user_email)
+                                                                                                           user_email=user_email,
+                                                                                                           fields=fields)
         if result_content is not None:
             result_job_status = dict(
                 request_completed = request_completed,
@@ -614,7 +759,13 @@ class InstrumentQueryBackEnd:
         return result_job_status
 
     @staticmethod
-    def read_content_scratch_dir(scratch_dir, include_session_log=False, include_status_query_output=False, exclude_analysis_parameters=True, user_email=None):
+    def read_content_scratch_dir(scratch_dir, include_session_log=False, include_status_query_output=False, exclude_analysis_parameters=True, user_email=None, fields=None):
+        """
+        if fields is provided, only the corresponding content is read
+        """
+        def is_projected(field):
+            return fields is None or field in fields
+
         result_content = {}
         file_list = []
         request_completed = False
@@ -629,7 +780,7 @@ class InstrumentQueryBackEnd:
             if 'token' in analysis_parameters:
                 token_expired = analysis_parameters['token']['exp'] < time_.time()
 
-        if not exclude_analysis_parameters:
+        if not exclude_analysis_parameters and is_projected('analysis_parameters'):
             result_content['analysis_parameters'] = analysis_parameters
 
         if user_email is not None:
@@ -640,45 +791,49 @@ class InstrumentQueryBackEnd:
             if token.get('sub') != user_email:
                 return None, None, None
 
-        for f in glob.glob(os.path.join(scratch_dir, "*")):
-            file_list.append(f)
-        result_content['file_list'] = file_list
+        if is_projected('file_list'):
+            for f in glob.glob(os.path.join(scratch_dir, "*")):
+                file_list.append(f)
+            result_content['file_list'] = file_list
 
-        if include_session_log:
+        if include_session_log and is_projected('session_log'):
             result_content['session_log'] = ''
             session_log_fn = os.path.join(scratch_dir, 'session.log')
             if os.path.exists(session_log_fn):
                 with open(session_log_fn) as session_log_fn_f:
                     result_content['session_log'] = session_log_fn_f.read()
 
-        result_content['email_history'] = []
-        for email in glob.glob(os.path.join(scratch_dir, 'email_history/*')):
-            ctime = os.stat(email).st_ctime,
-            result_content['email_history'].append(dict(
-                ctime=ctime,
-                ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(os.stat(email).st_ctime)),
-                fn=email,
-            ))
-
-        result_content['matrix_message_history'] = []
-        for msg in glob.glob(os.path.join(scratch_dir, 'matrix_message_history/*')):
-            ctime = os.stat(msg).st_ctime,
-            result_content['matrix_message_history'].append(dict(
-                ctime=ctime,
-                ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(os.stat(msg).st_ctime)),
-                fn=msg,
-            ))
-
-        result_content['fits_files'] = []
-        for fits_fn in glob.glob(os.path.join(scratch_dir, '*fits*')):
-            ctime = os.stat(fits_fn).st_ctime
-            result_content['fits_files'].append(dict(
-                ctime=ctime,
-                ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(ctime)),
-                fn=fits_fn,
-            ))
-
-        if include_status_query_output:
+        if is_projected('email_history'):
+            result_content['email_history'] = []
+            for email in glob.glob(os.path.join(scratch_dir, 'email_history/*')):
+                ctime = os.stat(email).st_ctime,
+                result_content['email_history'].append(dict(
+                    ctime=ctime,
+                    ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(os.stat(email).st_ctime)),
+                    fn=email,
+                ))
+
+        if is_projected('matrix_message_history'):
+            result_content['matrix_message_history'] = []
+            for msg in glob.glob(os.path.join(scratch_dir, 'matrix_message_history/*')):
+                ctime = os.stat(msg).st_ctime,
+                result_content['matrix_message_history'].append(dict(
+                    ctime=ctime,
+                    ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(os.stat(msg).st_ctime)),
+                    fn=msg,
+                ))
+
+        if is_projected('fits_files'):
+            result_content['fits_files'] = []
+            for fits_fn in glob.glob(os.path.join(scratch_dir, '*fits*')):
+                ctime = os.stat(fits_fn).st_ctime
+                result_content['fits_files'].append(dict(
+                    ctime=ctime,
+                    ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(ctime)),
+                    fn=fits_fn,
+                ))
+
+        if include_status_query_output and is_projected('status_query_output'):
             result_content['status_query_output'] = ''
             query_output_fn = os.path.join(scratch_dir, 'query_output.json')
             try:
@@ -691,7 +846,8 @@ class InstrumentQueryBackEnd:
                 logger.warning('unable to read: %s', query_output_fn)
                 result_content['status_query_output'] = f'problem reading {query_output_fn}: {repr(e)}'
 
-        result_content['job_monitor'] = []
+        # the job monitor is always read, since it determines request_completed
+        job_monitor = []
         for fn in glob.glob(os.path.join(scratch_dir, 'job_monitor*')):
             with open(fn) as job_status_file:
                 job_monitor_content = json.load(job_status_file)
@@ -699,13 +855,16 @@ class InstrumentQueryBackEnd:
             job_monitor_status = job_monitor_content['status']
             request_completed = (request_completed or job_monitor_status == 'done')
 
-            result_content['job_monitor'].append(dict(
+            job_monitor.append(dict(
                 ctime=job_monitor_ctime,
                 ctime_isot=time_.strftime("%Y-%m-%dT%H:%M:%S", time_.gmtime(job_monitor_ctime)),
                 fn=fn,
                 job_monitor_content=job_monitor_content
             ))
 
+        if is_projected('job_monitor'):
+            result_content['job_monitor'] = job_monitor
+
         return result_content, request_completed, token_expired
 
     @staticmethod
@@ -722,10 +881,22 @@ class InstrumentQueryBackEnd:
             if k not in kw_black_list and v is not None
         })
 
+    def get_request_decoded_token(self, token):
+        """
+        returns the decoded token, each token being decoded once during the request
+        """
+        if not hasattr(self, '_request_decoded_tokens'):
+            self._request_decoded_tokens = {}
+        decoded_token = self._request_decoded_tokens.get(token)
+        if decoded_token is None:
+            secret_key = self.app.config.get('conf').secret_key
+            decoded_token = tokenHelper.get_decoded_token(token, secret_key)
+            self._request_decoded_tokens[token] = decoded_token
+        return decoded_token
+
     def user_specific_par_dic(self, par_dic):
         if par_dic.get('token') is not None:
-            secret_key = self.app.config.get('conf').secret_key
-            decoded_token = tokenHelper.get_decoded_token(par_dic['token'], secret_key)
+            decoded_token = self.get_request_decoded_token(par_dic['token'])
             return {
                 **par_dic,
                 "sub": tokenHelper.get_token_user_email_address(decoded_token)
@@ -904,27 +1075,35 @@ class InstrumentQueryBackEnd:
         else:
             raise NotImplementedError
 
-        self.par_dic = {}
-        for k, v in args.to_dict().items():
+        self.par_dic = self.get_par_dic_from_args(args.to_dict())
+        
+        if verbose:
+            print('par_dic', self.par_dic)
+
+        self.args = args
+
+    @staticmethod
+    def get_par_dic_from_args(args: dict) -> dict:
+        """
+        decodes the values of the request arguments: the json-encoded dictionaries and lists, and the nulls
+        """
+        par_dic = {}
+        for k, v in args.items():
             if k in ['catalog_selected_objects', 'selected_catalog']:
-                self.par_dic[k] = v
+                par_dic[k] = v
                 continue
             if v == '\x00':
-                self.par_dic[k] = None
+                par_dic[k] = None
                 continue
             try:
                 decoded = json.loads(v)
                 if isinstance(decoded, (dict, list)):
-                    self.par_dic[k] = decoded
+                    par_dic[k] = decoded
                 else:
-                    self.par_dic[k] = v
+                    par_dic[k] = v
             except json.JSONDecodeError:
-                self.par_dic[k] = v
-        
-        if verbose:
-            print('par_dic', self.par_dic)
-
-        self.args = args
+                par_dic[k] = v
+        return par_dic
 
     def get_request_files_dir(self):
         request_files_dir = FilePath(file_dir='request_files')
@@ -932,45 +1111,35 @@ class InstrumentQueryBackEnd:
         return request_files_dir.path
 
     def set_scratch_dir(self, session_id, job_id=None, verbose=False):
-        lock_file = f".lock_{self.job_id}"
-        scratch_dir_retry_attempts = 6
-        scratch_dir_retry_delay = 0.2
-        scratch_dir_created = True
-
         if verbose:
             print('SETSCRATCH  ---->', session_id, type(session_id), job_id, type(job_id))
 
-        wd = 'scratch'
+        layout = scratch_layout.get_scratch_layout()
+        wd = layout.get_scratch_dir(session_id, job_id)
 
-        if session_id is not None:
-            wd += '_sid_' + session_id
-
-        if job_id is not None:
-            wd += '_jid_'+job_id
-
-        for attempt in range(scratch_dir_retry_attempts):
-            try:
-                with open(lock_file, 'w') as lock:
-                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    alias_workdir = self.get_existing_job_ID_path(wd=FilePath(file_dir=wd).path)
-                    if alias_workdir is not None:
-                        wd = wd + '_aliased'
-
-                    wd_path_obj = FilePath(file_dir=wd)
-                    wd_path_obj.mkdir()
-                    self.scratch_dir = wd_path_obj.path
-                    scratch_dir_created = True
-                    break
-            except (OSError, IOError) as io_e:
-                scratch_dir_created = False
-                self.logger.warning(f'Failed to acquire lock for the scratch directory "{wd}" creation, attempt number {attempt + 1} ({scratch_dir_retry_attempts - (attempt + 1)} left), sleeping {scratch_dir_retry_delay} seconds until retry.\nError: {str(io_e)}')
-                time.sleep(scratch_dir_retry_delay)
-                scratch_dir_retry_delay *= 2
-
-        if not scratch_dir_created:
-            dir_list = glob.glob(f"*_jid_{job_id}*")
-            sentry.capture_message(f"Failed to acquire lock for \"{wd}\" directory creation after multiple attempts.\njob_id: {self.job_id}\ndir_list: {dir_list}")
-            raise InternalError(f"Failed to acquire lock for directory \"{wd}\" creation after {scratch_dir_retry_attempts} attempts.", status_code=500)
+        scratch_dir_lock_manager = lock_manager.get_lock_manager()
+        # the lock file is next to the scratch directory of the job, and is removed when the lock is released
+        lock_dir = layout.get_lock_dir(self.job_id)
+        os.makedirs(lock_dir, exist_ok=True)
+        try:
+            with scratch_dir_lock_manager.lock(self.job_id, lock_dir=lock_dir):
+                if job_id is not None:
+                    # the directory can have been created with another layout
+                    wd = layout.find_scratch_dir(session_id, job_id) or wd
+                alias_workdir = self.get_existing_job_ID_path(wd=FilePath(file_dir=wd).path)
+                if alias_workdir is not None:
+                    wd = layout.find_scratch_dir(session_id, job_id, aliased=True) or wd + '_aliased'
+
+                os.makedirs(os.path.dirname(wd) or '.', exist_ok=True)
+                wd_path_obj = FilePath(file_dir=wd)
+                wd_path_obj.mkdir()
+                self.scratch_dir = wd_path_obj.path
+                job_registry.update_job_registry(self.scratch_dir)
+        except lock_manager.LockTimeout as e:
+            self.logger.warning(f'Failed to acquire lock for the scratch directory "{wd}" creation: {e}')
+            dir_list = layout.find_job_scratch_dirs(job_id) if job_id is not None else []
+            sentry.capture_message(f"Failed to acquire lock for \"{wd}\" directory creation within {scratch_dir_lock_manager.timeout_s} seconds.\njob_id: {self.job_id}\ndir_list: {dir_list}")
+            raise InternalError(f"Failed to acquire lock for directory \"{wd}\" creation within {scratch_dir_lock_manager.timeout_s} seconds.", status_code=500)
 
     def set_temp_dir(self, session_id, job_id=None, verbose=False):
         if verbose:
@@ -987,23 +1156,27 @@ class InstrumentQueryBackEnd:
         temp_parent_dir = '.'
         if hasattr(self, 'scratch_dir'):
             temp_parent_dir = self.scratch_dir
-        td = tempfile.mkdtemp(suffix=suffix, dir=temp_parent_dir)
-        self.temp_dir = td
+        # the directory is created only when a file is uploaded to it (see io_helper.upload_file)
+        self.temp_dir = os.path.join(temp_parent_dir, f'tmp{uuid.uuid4().hex[:8]}{suffix}')
 
     def move_temp_content(self):
         if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir) \
                 and os.path.exists(self.scratch_dir):
             for f in os.listdir(self.temp_dir):
                 file_full_path = os.path.join(self.temp_dir, f)
-                shutil.copy(file_full_path, self.scratch_dir)
-
-    def clear_temp_dir(self, temp_scratch_dir=None, temp_job_id=None):
-        if hasattr(self, 'temp_dir') and os.path.exists(self.temp_dir):
-            shutil.rmtree(self.temp_dir)
+                # the temporary directory is within a scratch_dir, on the same file system
+                os.replace(file_full_path, os.path.join(self.scratch_dir, f))
+
+    def clear_temp_dir(self, temp_scratch_dir=None):
+        if hasattr(self, 'temp_dir'):
+            if os.path.exists(self.temp_dir):
+                shutil.rmtree(self.temp_dir)
+                request_counters.increment('temp_dir_created')
+            else:
+                request_counters.increment('temp_dir_avoided')
         if temp_scratch_dir is not None and temp_scratch_dir != self.scratch_dir and os.path.exists(temp_scratch_dir):
             shutil.rmtree(temp_scratch_dir)
-        if temp_job_id is not None and os.path.exists(f".lock_{temp_job_id}"):
-            os.remove(f".lock_{temp_job_id}")
+            job_registry.remove_from_job_registry(temp_scratch_dir)
 
 
     @staticmethod
@@ -1025,22 +1198,20 @@ class InstrumentQueryBackEnd:
         user_email = None
         if self.decoded_token is not None:
             user_email = tokenHelper.get_token_user_email_address(self.decoded_token)
-        ownership_file_path = os.path.join(self.request_files_dir, f'{file_name}_ownerships.json')
-        with open(ownership_file_path) as ownership_file:
-            ownerships = json.load(ownership_file)
+        ownerships = ownership_registry.get_ownership_registry(self.request_files_dir).get_ownerships(file_name)
+        if ownerships is None:
+            raise RequestNotAuthorized('User cannot access the file')
         if 'public' not in ownerships['user_emails'] and \
                 ((user_email is not None and user_email not in ownerships['user_emails']) or user_email is None):
             raise RequestNotAuthorized('User cannot access the file')
 
     
-    def prepare_download(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+    def validated_download_file_list(self, file_list, from_request_files_dir=False):
         if from_request_files_dir:
             origin_dir = self.request_files_dir
         else:
             origin_dir = self.scratch_dir
 
-        file_name = file_name.replace(' ', '_')
-
         if hasattr(file_list, '__iter__'):
             print('file_list is iterable')
         else:
@@ -1051,13 +1222,24 @@ class InstrumentQueryBackEnd:
             if from_request_files_dir:
                 self.verify_access_to_file(f)
 
+        return file_list
+
+    def prepare_download(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+        file_name = file_name.replace(' ', '_')
+        file_list = self.validated_download_file_list(file_list, from_request_files_dir=from_request_files_dir)
+
+        return self.build_download(file_list, file_name, return_archive=return_archive)
+
+    def build_download(self, file_list, file_name, return_archive=True):
+        compression_level = self.app.config['conf'].download_compression_level
+
         file_dir = tempfile.mkdtemp(prefix='download_', dir='./')
         file_path = self.validated_download_file_path(file_dir, file_name, should_exist=False)
 
         if len(file_list) > 1:
             out_dir = file_name.replace('.tar', '')
             out_dir = out_dir.replace('.gz', '')
-            tar = tarfile.open("%s" % (file_path), "w:gz")
+            tar = tarfile.open("%s" % (file_path), "w:gz", compresslevel=compression_level)
             for name in file_list:
                 if name is not None:
                     tar.add(name, arcname='%s/%s' %
@@ -1065,10 +1247,9 @@ class InstrumentQueryBackEnd:
             tar.close()
         else:
             if return_archive:
-                with open(file_list[0], "rb") as f_in:
-                    in_data = f_in.read()
-                with gzip.open(file_path, 'wb') as f:
-                    f.write(in_data)
+                with open(file_list[0], "rb") as f_in, \
+                        gzip.open(file_path, 'wb', compresslevel=compression_level) as f:
+                    shutil.copyfileobj(f_in, f, download_helper.download_chunk_size)
             else:
                 file_to_download = file_list[0].split('/')[-1]
                 if file_name == file_to_download:
@@ -1080,6 +1261,87 @@ class InstrumentQueryBackEnd:
 
         return file_dir, file_name
 
+    @staticmethod
+    def get_download_cache(app_config) -> typing.Optional[download_cache.DownloadCache]:
+        if not app_config.download_cache_max_size_mb:
+            return None
+        return download_cache.DownloadCache(max_size=app_config.download_cache_max_size_mb * 1024 * 1024)
+
+    def get_download_cache_key(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+        if from_request_files_dir:
+            job_id = 'request-files'
+        else:
+            job_id = self.job_id
+
+        if len(file_list) > 1:
+            archive_mode = ['tar.gz', file_name, self.app.config['conf'].download_compression_level]
+        elif return_archive:
+            archive_mode = ['gz', file_name, self.app.config['conf'].download_compression_level]
+        else:
+            archive_mode = ['file', file_name]
+
+        return download_cache.make_download_cache_key(job_id, file_list, archive_mode)
+
+    def prepare_cached_download(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+        """
+        like prepare_download, but the archive is looked up in the download cache before being built,
+        and then added to it.
+        Returns the path of the file to send, and its ETag
+        """
+        file_name = file_name.replace(' ', '_')
+        file_list = self.validated_download_file_list(file_list, from_request_files_dir=from_request_files_dir)
+        key = self.get_download_cache_key(file_list, file_name,
+                                          return_archive=return_archive,
+                                          from_request_files_dir=from_request_files_dir)
+
+        if len(file_list) == 1 and not return_archive:
+            return file_list[0], key
+
+        cache = self.get_download_cache(self.app.config['conf'])
+        file_path = cache.get(key)
+        if file_path is None:
+            file_dir, file_name = self.build_download(file_list, file_name, return_archive=return_archive)
+            file_path = cache.put(key, os.path.join(file_dir, file_name))
+            shutil.rmtree(file_dir, ignore_errors=True)
+            self.logger.info("archive %s of %s added to the download cache", key, file_list)
+
+        return file_path, key
+
+    def stream_download(self, file_list, file_name, return_archive=True, from_request_files_dir=False):
+        """
+        like prepare_download, but the archive is generated while being sent, without writing it on the disk,
+        an uncompressed single file is sent directly (supporting Range requests)
+        """
+        file_name = file_name.replace(' ', '_')
+        file_list = self.validated_download_file_list(file_list, from_request_files_dir=from_request_files_dir)
+        compression_level = self.app.config['conf'].download_compression_level
+
+        # the generated archives have the same content, but not necessarily the same bytes
+        etag = self.get_download_cache_key(file_list, file_name,
+                                           return_archive=return_archive,
+                                           from_request_files_dir=from_request_files_dir)
+        if len(file_list) > 1 or return_archive:
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag, weak=True)
+                return response
+
+        if len(file_list) > 1:
+            out_dir = file_name.replace('.tar', '')
+            out_dir = out_dir.replace('.gz', '')
+            chunks = download_helper.iter_tar_gz(file_list, out_dir, compression_level=compression_level)
+            mimetype = 'application/gzip'
+        elif return_archive:
+            chunks = download_helper.iter_gzip_file(file_list[0], compression_level=compression_level)
+            mimetype = 'application/x-gzip-compressed'
+        else:
+            return send_file(file_list[0], download_name=file_name, as_attachment=True, conditional=True, etag=etag)
+
+        response = Response(stream_with_context(chunks), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={file_name}'
+        response.set_etag(etag, weak=True)
+        return response
+
     def resolve_job_url(self):
         expected_pars = set(['job_id', 'session_id', 'token'])
         unexpected_pars = list(sorted(set(self.par_dic) - expected_pars))
@@ -1197,6 +1459,28 @@ class InstrumentQueryBackEnd:
             # otherwise, for one file, the mimetype of the uncompressed file is determined, and gz only affects Content-Encoding
             # but Content-Encoding header isn't set if as_attachment=True
 
+            if self.app.config['conf'].download_streaming:
+                return self.stream_download(file_list, file_name,
+                                            return_archive=return_archive,
+                                            from_request_files_dir=from_request_files_dir)
+
+            if self.get_download_cache(self.app.config['conf']) is not None:
+                n_max_tries = 2
+                for n_try in range(n_max_tries):
+                    # the list is validated in place
+                    file_path, etag = self.prepare_cached_download(
+                        list(file_list), file_name,
+                        return_archive=return_archive,
+                        from_request_files_dir=from_request_files_dir)
+                    try:
+                        return send_file(file_path, download_name=file_name.replace(' ', '_'), as_attachment=True,
+                                         mimetype=mimetype, conditional=True, etag=etag)
+                    except FileNotFoundError:
+                        # the archive can be evicted by another process before being opened, it is then built again
+                        if n_try == n_max_tries - 1:
+                            raise
+                        self.logger.info("the archive %s was removed from the download cache before being sent", etag)
+
             tmp_dir, target_file = self.prepare_download(
                 file_list, file_name,
                 return_archive=return_archive,
@@ -1261,17 +1545,7 @@ class InstrumentQueryBackEnd:
         return jsonify(self.par_dic)
 
     def get_instr_list(self, name=None):
-        with block_timer(logger=logger, 
-                         message_template="Instrument factory iteration took {:.1f} seconds"):
-            _l = []
-            for instrument_factory in importer.instrument_factory_iter:
-                if hasattr(instrument_factory, 'instr_name'):
-                    iname = instrument_factory.instr_name
-                else:
-                    iname = instrument_factory().name
-                _l.append(iname)
-
-        return jsonify(_l)
+        return jsonify(importer.instrument_factory_iter.instrument_names)
 
     @property
     def dispatcher_callback_url_base(self):
@@ -1423,7 +1697,8 @@ class InstrumentQueryBackEnd:
                 time_request=time_request,
                 request_url=products_url,
                 api_code=email_api_code,
-                scratch_dir=self.scratch_dir)
+                scratch_dir=self.scratch_dir,
+                outbox=notification_outbox.get_notification_outbox())
 
             matrix_message_status_details = {
                 "res_content": res_content
@@ -1434,6 +1709,8 @@ class InstrumentQueryBackEnd:
             matrix_message_status = 'matrix message sent'
             if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
                 matrix_message_status = 'sending message via matrix failed'
+            elif 'outbox_record_id' in res_content:
+                matrix_message_status = 'matrix message queued'
 
             job.write_dataserver_status(status_dictionary_value=status,
                                         full_dict=self.par_dic,
@@ -1451,6 +1728,7 @@ class InstrumentQueryBackEnd:
                 if time_request_first_submitted is not None:
                     time_request = time_request_first_submitted
 
+                outbox = notification_outbox.get_notification_outbox()
                 email_helper.send_job_email(
                     config=self.config,
                     logger=self.logger,
@@ -1468,11 +1746,12 @@ class InstrumentQueryBackEnd:
                     # dispatch-data is how frontend is referring to the dispatcher, it's fixed in frontend-astrooda code
                     api_code=email_api_code,
                     scratch_dir=self.scratch_dir,
+                    outbox=outbox,
                     )
 
                 job.write_dataserver_status(status_dictionary_value=status,
                                             full_dict=self.par_dic,
-                                            email_status='email sent',
+                                            email_status='email sent' if outbox is None else 'email queued',
                                             email_status_details=status_details)
             else:
                 job.write_dataserver_status(status_dictionary_value=status, full_dict=self.par_dic)
@@ -1506,12 +1785,26 @@ class InstrumentQueryBackEnd:
         else:
             logger.info("get_request_par_dic unable to find %s", fn)
 
+    def find_job_scratch_dir(self, session_id, job_id) -> typing.Optional[str]:
+        """
+        returns the scratch_dir of the job in the session, found in the job registry,
+        or None if it is not found, or if the job is aliased
+        """
+        # as in get_existing_job_ID_path, the aliased scratch directories are not considered
+        scratch_dirs = scratch_layout.get_scratch_layout().find_job_scratch_dirs(job_id, include_aliased=False)
+        if len(scratch_dirs) != 1 or \
+                os.path.basename(scratch_dirs[0]) != scratch_layout.get_scratch_dir_name(session_id, job_id):
+            return None
+        return scratch_dirs[0]
+
     def find_job_id_parameters(self, job_id):
         """
         returns parameters from current job and any session
         """
 
-        scratch_dir_parameters = glob.glob(f'scratch*_jid_{job_id}*/analysis_parameters.json')
+        scratch_dir_parameters = [os.path.join(scratch_dir, 'analysis_parameters.json')
+                                  for scratch_dir in scratch_layout.get_scratch_layout().find_job_scratch_dirs(job_id)]
+        scratch_dir_parameters = [fn for fn in scratch_dir_parameters if os.path.exists(fn)]
         if len(scratch_dir_parameters) == 0:
             return None
         else:
@@ -1602,6 +1895,9 @@ class InstrumentQueryBackEnd:
 
         out_dict['time_request'] = self.time_request
 
+        # for the log of the request, without parsing the serialized response
+        self.response_summary = {k: out_dict[k] for k in ['exit_status', 'job_status'] if k in out_dict}
+
         if off_line:
             return out_dict
         else:
@@ -1623,6 +1919,7 @@ class InstrumentQueryBackEnd:
                                      debug_message=str(getattr(e, 'message', repr(e))))
 
                 out_dict['exit_status'] = query_out.status_dictionary
+                self.response_summary['exit_status'] = out_dict['exit_status']
 
                 return jsonify(out_dict), status_code
 
@@ -1650,32 +1947,16 @@ class InstrumentQueryBackEnd:
         if instrument_name == 'mock':
             new_instrument = 'mock'
         else:
-            with block_timer(logger=logger, 
-                             message_template="Instrument factory iteration took {:.1f} seconds"):
-                for instrument_factory in importer.instrument_factory_iter:
-                    _instrument = None
-                    if hasattr(instrument_factory, 'instr_name'):
-                        instr_name = instrument_factory.instr_name
-                    else:
-                        _instrument = instrument_factory()
-                        instr_name = _instrument.name
-                    
-                    if instr_name == instrument_name:
-                        if _instrument is None and hasattr(instrument_factory, 'instrument_query'):
-                            instr_query = instrument_factory.instrument_query
-                        else:
-                            if _instrument is None:
-                                _instrument = instrument_factory()
-                            instr_query = _instrument.instrumet_query
-                                
-                        if instr_query.check_instrument_access(roles, email):
-                            if _instrument is None:
-                                _instrument = instrument_factory()
-                            new_instrument = _instrument  # multiple assignment? TODO
-                        else:
-                            no_access = True
-
-                    known_instruments.append(instr_name)
+            instrument_factory_entry = importer.instrument_factory_iter.get_entry(instrument_name)
+            if instrument_factory_entry is not None:
+                if instrument_factory_entry.instrument_query.check_instrument_access(roles, email):
+                    use_prototype = getattr(self.app.config.get('conf'), 'instrument_prototype_pool', True)
+                    new_instrument = importer.instrument_factory_iter.get_instrument(instrument_name,
+                                                                                     use_prototype=use_prototype)
+                else:
+                    no_access = True
+            else:
+                known_instruments = importer.instrument_factory_iter.instrument_names
         if new_instrument is None:
             if no_access:
                 raise RequestNotAuthorized(f"Unfortunately, your priviledges are not sufficient "
@@ -1726,14 +2007,12 @@ class InstrumentQueryBackEnd:
         return config, self.config_data_server
 
     def get_existing_job_ID_path(self, wd):
-        with os.scandir() as scan:
-            dir_list = [
-                item.name for item in scan 
-                if item.name.endswith(f'_jid_{self.job_id}')
-            ]
+        # listing the directories, also those not in the job registry: with the sharded layout,
+        # once migrated, only the shard of the job and the few entries left in the working directory
+        dir_list = scratch_layout.get_scratch_layout().scan_job_scratch_dirs(self.job_id, include_aliased=False)
 
         if len(dir_list) == 1:
-            if dir_list[0] != wd:
+            if os.path.normpath(dir_list[0]) != os.path.normpath(wd):
                 alias_dir = dir_list[0]
             else:
                 alias_dir = None
@@ -1797,8 +2076,7 @@ class InstrumentQueryBackEnd:
         """
         # decode the token
         # self.decoded_token = self.get_decoded_token()
-        secret_key = self.app.config.get('conf').secret_key
-        self.decoded_token = tokenHelper.get_decoded_token(self.token, secret_key)
+        self.decoded_token = self.get_request_decoded_token(self.token)
         self.logger.info("==> token %s", self.decoded_token)
         return True
 
@@ -2045,7 +2323,8 @@ class InstrumentQueryBackEnd:
             time_request=time_request,
             request_url=products_url,
             api_code=email_api_code,
-            scratch_dir=self.scratch_dir)
+            scratch_dir=self.scratch_dir,
+            outbox=notification_outbox.get_notification_outbox())
 
 
     def run_query(self, off_line=False, disp_conf=None):
@@ -2254,7 +2533,8 @@ class InstrumentQueryBackEnd:
                             try:
                                 self.send_query_new_status_email(product_type, query_new_status)
                                 # store an additional information about the sent email
-                                query_out.set_status_field('email_status', 'email sent')
+                                query_out.set_status_field('email_status',
+                                                           'email sent' if notification_outbox.get_notification_outbox() is None else 'email queued')
                             except email_helper.EMailNotSent as e:
                                 query_out.set_status_field('email_status', 'sending email failed')
                                 logging.warning(f'email sending failed: {e}')
@@ -2365,7 +2645,8 @@ class InstrumentQueryBackEnd:
                             time_request=time_request,
                             request_url=products_url,
                             api_code=email_api_code,
-                            scratch_dir=self.scratch_dir)
+                            scratch_dir=self.scratch_dir,
+                            outbox=notification_outbox.get_notification_outbox())
 
                         matrix_message_status_details =  json.dumps({
                             "res_content": res_content
@@ -2374,6 +2655,8 @@ class InstrumentQueryBackEnd:
                         matrix_message_status = 'matrix message sent'
                         if 'res_content_token_user_failure' in res_content or len(res_content['res_content_bcc_users_failed']) >= 1:
                             matrix_message_status = 'sending message via matrix failed'
+                        elif 'outbox_record_id' in res_content:
+                            matrix_message_status = 'matrix message queued'
 
                         query_out.set_status_field('matrix_message_status', matrix_message_status)
                         query_out.set_status_field('matrix_message_status_details', matrix_message_status_details)
@@ -2392,6 +2675,7 @@ class InstrumentQueryBackEnd:
                             if time_request_first_submitted is not None:
                                 time_request = time_request_first_submitted
 
+                            outbox = notification_outbox.get_notification_outbox()
                             email_helper.send_job_email(
                                 config=self.app.config['conf'],
                                 logger=self.logger,
@@ -2405,10 +2689,11 @@ class InstrumentQueryBackEnd:
                                 time_request=time_request,
                                 request_url=products_url,
                                 api_code=email_api_code,
-                                scratch_dir=self.scratch_dir)
+                                scratch_dir=self.scratch_dir,
+                                outbox=outbox)
 
                             # store an additional information about the sent email
-                            query_out.set_status_field('email_status', 'email sent')
+                            query_out.set_status_field('email_status', 'email sent' if outbox is None else 'email queued')
                         except email_helper.EMailNotSent as e:
                             query_out.set_status_field('email_status', 'sending email failed')
                             logging.warning(f'email sending failed: {e}')
@@ -2496,6 +2781,88 @@ class InstrumentQueryBackEnd:
                                               api=api)
         return resp
 
+    @staticmethod
+    def is_status_poll_request(request, disp_conf) -> bool:
+        """
+        tells if the request only polls the status of a submitted job, so that it can be answered by run_status_poll
+        """
+        if not getattr(disp_conf, 'status_poll_fast_path', False):
+            return False
+        if os.environ.get("DISPATCHER_ASYNC_ENABLED", "no") == "yes":
+            return False
+        return request.values.get('query_status') in status_poll_query_statuses \
+            and request.values.get('job_id', '') != '' \
+            and request.values.get('session_id', 'new') not in ['', 'new'] \
+            and len(request.files) == 0
+
+    def run_status_poll(self):
+        """
+        responds to a poll of the status of a submitted job as run_query does, from its job monitor,
+        without building the instrument nor the scratch_dir.
+
+        Returns None if the request has to be handled by run_query: the job is not found in the job registry,
+        it is aliased, or the job_id can not be validated
+        """
+        if self.scratch_dir is None:
+            return None
+
+        if 'query_type' not in self.par_dic or 'product_type' not in self.par_dic:
+            return None
+
+        # as in validate_job_id, from the parameters recorded for the job
+        request_par_dic, _ = self.read_analysis_parameters_scratch_dir(self.scratch_dir)
+        if request_par_dic is None or request_par_dic.get('instrument') != self.instrument_name:
+            return None
+        request_par_dic['token'] = self.token
+        if self.calculate_job_id(request_par_dic) != self.job_id:
+            return None
+
+        query_status = self.par_dic['query_status']
+        self.api = 'api' in self.par_dic
+
+        self.logger.info(
+            '\033[31;42m==============================> status poll <==============================\033[0m')
+
+        job = job_factory(self.instrument_name,
+                          self.scratch_dir,
+                          self.dispatcher_host,
+                          self.dispatcher_port,
+                          self.dispatcher_callback_url_base,
+                          self.par_dic['session_id'],
+                          self.job_id,
+                          self.par_dic,
+                          token=self.token,
+                          time_request=self.time_request)
+
+        query_out = QueryOutput()
+
+        job_monitor = job.updated_dataserver_monitor()
+
+        self.logger.info('-----------------> job monitor from data server: %s', job_monitor['status'])
+
+        if job_monitor['status'] == 'done':
+            job.set_ready()
+
+        query_out.set_done(job_status=job_monitor['status'])
+
+        if job_monitor['status'] in ['unaccessible', 'unknown']:
+            query_new_status = query_status
+        else:
+            query_new_status = job.get_status()
+
+        self.logger.info('-----------------> query status update for progress: %s', query_new_status)
+
+        if query_status != query_new_status and not self.return_progress:
+            job.write_dataserver_status()
+
+        self.store_response(query_out, job_monitor)
+
+        return self.build_dispatcher_response(query_new_status=query_new_status,
+                                              query_out=query_out,
+                                              job_monitor=job_monitor,
+                                              off_line=False,
+                                              api=self.api)
+
     def async_dispatcher_query(self, query_status: str) -> tuple:
         self.logger.info("async dispatcher enabled, for %s", query_status)
 
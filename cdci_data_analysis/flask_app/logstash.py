@@ -1,35 +1,217 @@
+"""
+Shipping of the events of the dispatcher to logstash.
+
+The events are only enqueued by the request handlers, in a bounded in-memory queue: when it is full, the oldest
+events are dropped. A background thread sends them, framed as configured by logstash_framing:
+
+- json (default): one json document per connection, as sent by pylogstash before, for a logstash tcp input
+  with codec => json; each event still needs its own connection, only opened outside of the requests;
+- json_lines (opt-in): batches of newline-delimited json documents over a persistent connection, reconnecting
+  when it is broken, for a logstash tcp input with codec => json_lines.
+
+The events sent, dropped and failed are counted in the request counters.
+"""
+
+import os
 import time
 import json
+import socket
 import logging
-import pylogstash
+import threading
+import collections
+import collections.abc
+
+from ..analysis import request_counters
 
 logger = logging.getLogger(__name__)
 
-def logstash_message(app, message_dict: dict):
-    t0 = time.time()
+default_queue_max_size = 10000
+default_batch_max_size = 100
+logstash_framings = ['json', 'json_lines']
+default_framing = 'json'
+connect_timeout_s = 5
+reconnect_delay_s = 1
 
-    logger.warning("logstash_message at %s s", t0)
-    conf = app.config['conf']
 
-    logger.warning("logstash_message before encoding %s in %s s", t0, time.time() - t0)
-    message_json = json.dumps(message_dict)
-    logger.warning("logstash_message after encoding %s size %s in %s s", t0, len(message_json), time.time() - t0)    
-    
-    if conf.logstash_host not in [None, "None"] and conf.logstash_port not in [None, "None"]:
-        url = f"{conf.logstash_host}:{conf.logstash_port}"
+def flatten(d, parent_key='', sep='.'):
+    # as pylogstash does with the dictionaries
+    items = []
+    for k, v in d.items():
+        new_key = str(parent_key) + sep + str(k) if parent_key else k
+        if isinstance(v, collections.abc.MutableMapping):
+            items.extend(flatten(v, new_key, sep=sep).items())
+        elif isinstance(v, collections.abc.Iterable) and not isinstance(v, str):
+            items.extend(flatten(dict(enumerate(v)), new_key, sep=sep).items())
+        else:
+            items.append((new_key, v))
+    return dict(items)
+
+
+def encode_event(message, framing=default_framing) -> bytes:
+    if isinstance(message, str):
+        message_json = message
+    elif isinstance(message, dict):
+        message_json = json.dumps(flatten(message))
+    else:
+        raise RuntimeError(f"unknown type of message: {type(message)}")
+    if framing == 'json_lines':
+        return message_json.encode() + b'\n'
+    return message_json.encode()
+
+
+class LogstashShipper:
+
+    def __init__(self, host, port, queue_max_size=default_queue_max_size, batch_max_size=default_batch_max_size,
+                 framing=default_framing):
+        if framing not in logstash_framings:
+            raise ValueError(f"unsupported logstash framing {framing}, expected one of {logstash_framings}")
+        self.host = host
+        self.port = int(port)
+        self.queue_max_size = queue_max_size
+        self.batch_max_size = batch_max_size
+        self.framing = framing
+        self.pid = os.getpid()
+
+        self._queue = collections.deque()
+        self._queue_condition = threading.Condition()
+        self._socket = None
+        self._worker = None
+        self._stopped = False
+
+    def enqueue(self, message):
+        """
+        queues the message, a dict or a json string, not to be modified afterwards
+        """
+        with self._queue_condition:
+            if len(self._queue) >= self.queue_max_size:
+                self._queue.popleft()
+                request_counters.increment('logstash_events_dropped')
+            self._queue.append(message)
+            self._queue_condition.notify()
+
+    def start(self):
+        with self._queue_condition:
+            if self._worker is None:
+                self._stopped = False
+                self._worker = threading.Thread(target=self._run, name='logstash-shipper', daemon=True)
+                self._worker.start()
+
+    def stop(self, timeout=None):
+        """
+        stops the worker, once the queued events are sent
+        """
+        with self._queue_condition:
+            self._stopped = True
+            self._queue_condition.notify()
+            worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
 
-        LS = pylogstash.LogStasher(url)
+    def _next_batch(self) -> list:
+        with self._queue_condition:
+            while len(self._queue) == 0 and not self._stopped:
+                self._queue_condition.wait()
+            batch = []
+            while len(self._queue) > 0 and len(batch) < self.batch_max_size:
+                batch.append(self._queue.popleft())
+            return batch
 
-        logger.warning("logstash_message constructed at %s in %s s", t0, time.time() - t0)
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if len(batch) == 0:
+                # stopped, and nothing left to send
+                break
+            self._send_batch(batch)
 
-        LS.log(
-            message_dict
-        )
+        self._close_socket()
+        with self._queue_condition:
+            self._worker = None
 
-        logger.warning("logstash_message sent at %s in %s s", t0, time.time() - t0)
+    def _send_batch(self, batch):
+        events = []
+        for message in batch:
+            try:
+                events.append(encode_event(message, framing=self.framing))
+            except Exception as e:
+                logger.warning("unable to encode the event for logstash: %s", repr(e))
+                request_counters.increment('logstash_events_failed')
+
+        if self.framing == 'json_lines':
+            sent = self._send(b''.join(events), len(events))
+        else:
+            # without delimiter, the end of the connection is the end of the event
+            for i_event, event in enumerate(events):
+                sent = self._send(event, 1)
+                self._close_socket()
+                if not sent:
+                    request_counters.increment('logstash_events_failed', len(events) - i_event - 1)
+                    break
+            else:
+                sent = True
+
+        if not sent:
+            # not to spin while logstash is not reachable
+            time.sleep(reconnect_delay_s)
+
+    def _send(self, data, n_events) -> bool:
+        # the connection can have been closed by logstash since the previous batch: retrying once
+        for attempt in range(2):
+            try:
+                if self._socket is None:
+                    self._socket = socket.create_connection((self.host, self.port), timeout=connect_timeout_s)
+                self._socket.sendall(data)
+                request_counters.increment('logstash_events_sent', n_events)
+                return True
+            except OSError as e:
+                logger.warning("unable to send %s events to logstash at %s:%s: %s",
+                               n_events, self.host, self.port, repr(e))
+                self._close_socket()
+
+        request_counters.increment('logstash_events_failed', n_events)
+        return False
+
+    def _close_socket(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except OSError:
+                pass
+            self._socket = None
+
+
+_logstash_shipper = None
+_logstash_shipper_lock = threading.Lock()
+
+
+def get_logstash_shipper(conf):
+    """
+    returns the shipper of the process, to the logstash of the configuration, or None if there is none
+    """
+    global _logstash_shipper
+    if conf.logstash_host in [None, "None"] or conf.logstash_port in [None, "None"]:
+        return None
+
+    with _logstash_shipper_lock:
+        # the worker thread of the parent is not running in a forked process
+        if _logstash_shipper is None or _logstash_shipper.pid != os.getpid() or \
+                (_logstash_shipper.host, _logstash_shipper.port, _logstash_shipper.framing) != \
+                (conf.logstash_host, int(conf.logstash_port), conf.logstash_framing):
+            _logstash_shipper = LogstashShipper(conf.logstash_host,
+                                                conf.logstash_port,
+                                                queue_max_size=conf.logstash_queue_max_size,
+                                                batch_max_size=conf.logstash_batch_max_size,
+                                                framing=conf.logstash_framing)
+            _logstash_shipper.start()
+        return _logstash_shipper
+
+
+def logstash_message(app, message_dict: dict):
+    conf = app.config['conf']
+
+    logstash_shipper = get_logstash_shipper(conf)
+    if logstash_shipper is not None:
+        logstash_shipper.enqueue(message_dict)
 
     logger.debug(f"\033[35m stashing to {conf.logstash_host}:{conf.logstash_port}\033[0m")
     logger.debug("\033[35m%s\033[0m", message_dict)
-
-    logger.warning("logstash_message done at %s in %s s", t0, time.time() - t0)
-    
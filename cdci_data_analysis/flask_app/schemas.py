@@ -92,10 +92,12 @@ class JobStatusSchema(Schema):
 
 class StateJobsInspectionScheme(Schema):
     records = fields.List(fields.Nested(JobStatusSchema), required=False)
+    next_cursor = fields.Str(description="cursor of the next page of records, if a limit was set", required=False, allow_none=True)
 
 
 class StateScratchDirsInspectionScheme(Schema):
     records = fields.List(fields.Dict, required=False)
+    next_cursor = fields.Str(description="cursor of the next page of records, if a limit was set", required=False, allow_none=True)
 
 
 class TokenPayloadSchema(EmailOptionsTokenSchema, UserOptionsTokenSchema, TokenBasePayloadSchema):
@@ -75,3 +75,6 @@ def my_instr_factory():
                       product_queries_list=[empty_query, empty_log_submit_query, numerical_query],
                       query_dictionary=query_dictionary,
                       data_server_query_class=DataServerQuery)
+
+
+my_instr_factory.instrument_prototype_pool = True
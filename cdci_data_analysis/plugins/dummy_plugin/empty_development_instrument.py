@@ -88,3 +88,6 @@ def my_instr_factory():
                       instrumet_query=instr_query,
                       product_queries_list=[empty_query, numerical_query, failing_query, parametrical_query, echo_param_query],
                       query_dictionary=query_dictionary)
+
+
+my_instr_factory.instrument_prototype_pool = True
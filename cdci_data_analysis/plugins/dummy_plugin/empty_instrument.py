@@ -142,3 +142,7 @@ def my_instr_factory():
                                             structured_echo_query,
                                             optional_echo_query],
                       query_dictionary=query_dictionary)
+
+
+# the instrument keeps the state of the request only in its queries and parameters
+my_instr_factory.instrument_prototype_pool = True
@@ -68,4 +68,7 @@ def my_instr_factory():
                       instrumet_query=instr_query,
                       product_queries_list=[empty_query, numerical_query],
                       query_dictionary=query_dictionary,
-                      data_server_query_class=DataServerQuerySemiAsync)
\ No newline at end of file
+                      data_server_query_class=DataServerQuerySemiAsync)
+
+
+my_instr_factory.instrument_prototype_pool = True
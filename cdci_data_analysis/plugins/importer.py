@@ -72,6 +72,14 @@ def build_instrument_factory_iter():
             except Exception as e:
                 logger.error('failed to import %s: %s', plugin_name,e )
                 traceback.print_exc()
+
+    try:
+        instr_factory_iter.build_index()
+    except Exception as e:
+        # the index will be built at the first lookup
+        logger.error('failed to build the instrument factory index: %s', e)
+        traceback.print_exc()
+
     return instr_factory_iter
 
 instrument_factory_iter = build_instrument_factory_iter()
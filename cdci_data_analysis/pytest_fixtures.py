@@ -8,6 +8,7 @@ import cdci_data_analysis.flask_app.app
 from cdci_data_analysis.analysis.exceptions import BadRequest
 from cdci_data_analysis.flask_app.dispatcher_query import InstrumentQueryBackEnd
 from cdci_data_analysis.analysis.hash import make_hash, make_hash_file
+from cdci_data_analysis.analysis.job_registry import remove_from_job_registry
 from cdci_data_analysis.configurer import ConfigEnv
 from cdci_data_analysis.analysis.email_helper import textify_email
 
@@ -501,11 +502,26 @@ dispatcher:
     sentry_environment: "production"
     logstash_host: 
     logstash_port: 
+    logstash_queue_max_size: 10000
+    logstash_batch_max_size: 100
+    logstash_framing: json
     secret_key: 'secretkey_test'
     token_max_refresh_interval: 604800
     resubmit_timeout: 1800
     soft_minimum_folder_age_days: 5
     hard_minimum_folder_age_days: 30
+    free_up_space_max_workers: 4
+    instrument_prototype_pool: True
+    download_streaming: False
+    download_compression_level: 9
+    download_cache_max_size_mb: 1024
+    notification_outbox: False
+    notification_outbox_max_workers: 2
+    notification_outbox_n_max_tries: 5
+    call_back_coalescing_interval_s: 0
+    status_poll_fast_path: True
+    scratch_dir_layout: flat
+    scratch_dir_lock_timeout_s: 5
     bind_options:
         bind_host: 0.0.0.0
         bind_port: 8011
@@ -612,7 +628,12 @@ def dispatcher_test_conf_with_gallery_fn(dispatcher_test_conf_fn):
                 '\n        local_name_resolver_url: "https://resolver-prod.obsuks1.unige.ch/api/v1.1/byname/{}"'
                 '\n        external_name_resolver_url: "http://cdsweb.u-strasbg.fr/cgi-bin/nph-sesame/-oxp/NSV?{}"'
                 '\n        entities_portal_url: "http://cdsportal.u-strasbg.fr/?target={}"'
-                '\n        converttime_revnum_service_url: "https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM"')
+                '\n        converttime_revnum_service_url: "https://www.astro.unige.ch/mmoda/dispatch-data/gw/timesystem/api/v1.0/converttime/UTC/{}/REVNUM"'
+                '\n        product_gallery_connect_timeout_s: 10'
+                '\n        product_gallery_read_timeout_s: 300'
+                '\n        product_gallery_n_max_tries: 10'
+                '\n        product_gallery_retry_sleep_s: 0.5'
+                '\n        product_gallery_max_retry_sleep_s: 30')
 
     yield fn
 
@@ -650,7 +671,10 @@ def dispatcher_test_conf_with_vo_options_fn(dispatcher_test_conf_fn):
                 '\n         vo_psql_pg_port: "5435"'
                 '\n         vo_psql_pg_user: "postgres"'
                 '\n         vo_psql_pg_password: "postgres"'
-                '\n         vo_psql_pg_db: "mmoda_pg_db"')
+                '\n         vo_psql_pg_db: "mmoda_pg_db"'
+                '\n         vo_psql_pg_pool_max_connections: 5'
+                '\n         vo_psql_pg_fetch_chunk_size: 2'
+                '\n         vo_tables_cache_ttl_s: 300')
 
     yield fn
 
@@ -688,6 +712,46 @@ def dispatcher_test_conf_with_cors_options_path_fn(dispatcher_test_conf_fn):
     yield fn
 
 
+@pytest.fixture
+def dispatcher_test_conf_with_download_streaming_fn(dispatcher_test_conf_fn):
+    fn = "test-dispatcher-conf-with-download-streaming.yaml"
+
+    with open(fn, "w") as f:
+        with open(dispatcher_test_conf_fn) as f_default:
+            data = f_default.read()
+        data = re.sub(r'(\s+download_streaming:).*\n', r'\1 True\n', data)
+        data = re.sub(r'(\s+download_compression_level:).*\n', r'\1 1\n', data)
+        f.write(data)
+
+    yield fn
+
+
+@pytest.fixture
+def dispatcher_test_conf_with_call_back_coalescing_fn(dispatcher_test_conf_fn):
+    fn = "test-dispatcher-conf-with-call-back-coalescing.yaml"
+
+    with open(fn, "w") as f:
+        with open(dispatcher_test_conf_fn) as f_default:
+            data = f_default.read()
+        data = re.sub(r'(\s+call_back_coalescing_interval_s:).*\n', r'\1 1\n', data)
+        f.write(data)
+
+    yield fn
+
+
+@pytest.fixture
+def dispatcher_test_conf_with_sharded_scratch_fn(dispatcher_test_conf_fn):
+    fn = "test-dispatcher-conf-with-sharded-scratch.yaml"
+
+    with open(fn, "w") as f:
+        with open(dispatcher_test_conf_fn) as f_default:
+            data = f_default.read()
+        data = re.sub(r'(\s+scratch_dir_layout:).*\n', r'\1 sharded\n', data)
+        f.write(data)
+
+    yield fn
+
+
 @pytest.fixture
 def dispatcher_test_conf_with_matrix_options_fn(dispatcher_test_conf_fn):
     fn = "test-dispatcher-conf-with-matrix-options.yaml"
@@ -1279,6 +1343,45 @@ def dispatcher_live_fixture_with_cors_path(pytestconfig, dispatcher_test_conf_wi
     os.kill(pid, signal.SIGINT)
 
 
+@pytest.fixture
+def dispatcher_live_fixture_with_download_streaming(pytestconfig, dispatcher_test_conf_with_download_streaming_fn, dispatcher_debug):
+    dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_with_download_streaming_fn)
+
+    service = dispatcher_state['url']
+    pid = dispatcher_state['pid']
+
+    yield service
+
+    kill_child_processes(pid, signal.SIGINT)
+    os.kill(pid, signal.SIGINT)
+
+
+@pytest.fixture
+def dispatcher_live_fixture_with_call_back_coalescing(pytestconfig, dispatcher_test_conf_with_call_back_coalescing_fn, dispatcher_debug):
+    dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_with_call_back_coalescing_fn)
+
+    service = dispatcher_state['url']
+    pid = dispatcher_state['pid']
+
+    yield service
+
+    kill_child_processes(pid, signal.SIGINT)
+    os.kill(pid, signal.SIGINT)
+
+
+@pytest.fixture
+def dispatcher_live_fixture_with_sharded_scratch(pytestconfig, dispatcher_test_conf_with_sharded_scratch_fn, dispatcher_debug):
+    dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_with_sharded_scratch_fn)
+
+    service = dispatcher_state['url']
+    pid = dispatcher_state['pid']
+
+    yield service
+
+    kill_child_processes(pid, signal.SIGINT)
+    os.kill(pid, signal.SIGINT)
+
+
 @pytest.fixture
 def dispatcher_live_fixture_with_matrix_options(pytestconfig, dispatcher_test_conf_with_matrix_options_fn, dispatcher_debug):
     dispatcher_state = start_dispatcher(pytestconfig.rootdir, dispatcher_test_conf_with_matrix_options_fn)
@@ -1693,11 +1796,13 @@ class DispatcherJobState:
     @staticmethod
     def remove_scratch_folders(job_id=None):
         if job_id is None:
-            dir_list = glob.glob('scratch_*')
+            dir_list = glob.glob('scratch_shards/*/scratch_*') + glob.glob('scratch_*')
         else:
-            dir_list = glob.glob(f'scratch_*_jid_{job_id}*')
+            dir_list = glob.glob(f'scratch_shards/{job_id[:2]}/scratch_*_jid_{job_id}*') + \
+                       glob.glob(f'scratch_*_jid_{job_id}*')
         for d in dir_list:
             shutil.rmtree(d)
+            remove_from_job_registry(d)
 
     @staticmethod
     def remove_lock_files(job_id=None):
@@ -1716,10 +1821,13 @@ class DispatcherJobState:
             dir_list = glob.glob(f'download_{id}')
         for d in dir_list:
             shutil.rmtree(d)
+        if id is None and os.path.isdir('.download_cache'):
+            shutil.rmtree('.download_cache')
 
     @staticmethod
     def empty_request_files_folders():
-        dir_list = glob.glob('request_files/*')
+        # including the ownership registry
+        dir_list = glob.glob('request_files/*') + glob.glob('request_files/.*')
         for d in dir_list:
             os.remove(d)
 
@@ -1836,7 +1944,8 @@ class DispatcherJobState:
     
     @property
     def scratch_dir(self):
-        return glob.glob(f'scratch_sid_{self.session_id}_jid_{self.job_id}*')[0]
+        return (glob.glob(f'scratch_sid_{self.session_id}_jid_{self.job_id}*') +
+                glob.glob(f'scratch_shards/{self.job_id[:2]}/scratch_sid_{self.session_id}_jid_{self.job_id}*'))[0]
 
     @property
     def job_monitor_json_fn(self):
@@ -13,6 +13,9 @@ from cdci_data_analysis.pytest_fixtures import (
             dispatcher_live_fixture_with_tap,
             dispatcher_live_fixture_with_cors,
             dispatcher_live_fixture_with_cors_path,
+            dispatcher_live_fixture_with_download_streaming,
+            dispatcher_live_fixture_with_call_back_coalescing,
+            dispatcher_live_fixture_with_sharded_scratch,
             dispatcher_live_fixture_with_gallery_no_resolver,
             dispatcher_live_fixture_with_gallery_invalid_local_resolver,
             dispatcher_long_living_fixture,
@@ -33,6 +36,9 @@ from cdci_data_analysis.pytest_fixtures import (
             dispatcher_test_conf_with_vo_options_fn,
             dispatcher_test_conf_with_cors_options_fn,
             dispatcher_test_conf_with_cors_options_path_fn,
+            dispatcher_test_conf_with_download_streaming_fn,
+            dispatcher_test_conf_with_call_back_coalescing_fn,
+            dispatcher_test_conf_with_sharded_scratch_fn,
             dispatcher_test_conf_with_gallery_no_resolver_fn,
             dispatcher_live_fixture_with_external_products_url,
             dispatcher_live_fixture_with_default_route_products_url,
@@ -72,9 +78,19 @@ def pytest_addoption(parser):
     parser.addoption(
         "--runslow", action="store_true", default=False, help="run slow tests"
     )
+    parser.addoption(
+        "--runbenchmark", action="store_true", default=False, help="run the benchmark tests, comparing timings"
+    )
 
 
 def pytest_collection_modifyitems(config, items):
+    if not config.getoption("--runbenchmark"):
+        # the timings are not reliable on a loaded machine
+        skip_benchmark = pytest.mark.skip(reason="need --runbenchmark option to run")
+        for item in items:
+            if "benchmark" in item.keywords:
+                item.add_marker(skip_benchmark)
+
     if config.getoption("--runslow"):
         # --runslow given in cli: do not skip slow tests
         return
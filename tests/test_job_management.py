@@ -14,6 +14,8 @@ from urllib.parse import parse_qs, urlencode
 import glob
 
 from cdci_data_analysis.analysis.catalog import BasicCatalog
+from cdci_data_analysis.analysis.job_registry import JobRegistry, get_job_registry
+from cdci_data_analysis.analysis.download_cache import DownloadCache, make_download_cache_key
 from cdci_data_analysis.pytest_fixtures import DispatcherJobState, make_hash, ask
 from cdci_data_analysis.plugins.dummy_plugin.data_server_dispatcher import DataServerQuery
 from cdci_data_analysis.flask_app.schemas import StateJobsInspectionScheme
@@ -1081,6 +1083,15 @@ def test_email_submitted_faulty_time_request(dispatcher_live_fixture, dispatcher
     faulty_email_file_name = "_".join(email_file_split)
 
     os.rename(list_email_files[0], os.path.join(os.path.dirname(list_email_files[0]),faulty_email_file_name + email_file_split_ext))
+    # the sent emails are read from the notification ledger of the scratch directory
+    ledger_fn = os.path.join(os.path.dirname(dispatcher_job_state.email_history_folder), 'notification_ledger.jsonl')
+    with open(ledger_fn) as ledger_file:
+        ledger_entries = [json.loads(line) for line in ledger_file]
+    assert len(ledger_entries) == 1
+    ledger_entries[0]['first_submitted_time'] = faulty_first_submitted_email_time
+    ledger_entries[0]['file_name'] = faulty_email_file_name + email_file_split_ext
+    with open(ledger_fn, 'w') as ledger_file:
+        ledger_file.write(json.dumps(ledger_entries[0]) + '\n')
 
     # let the interval time pass, so that a new email si sent
     time.sleep(5)
@@ -2475,6 +2486,313 @@ scwl_dict = {"scw_list": "115000860010.001,115000870010.001,115000980010.001,115
     assert len(my_globals['scwl_dict']['scw_list']) > max_length
 
 
+@pytest.mark.not_safe_parallel
+def test_notification_outbox(dispatcher_test_conf_fn, dispatcher_local_mail_server, tmpdir):
+    from cdci_data_analysis.configurer import ConfigEnv
+    from cdci_data_analysis.analysis.email_helper import build_email_message
+    from cdci_data_analysis.analysis.notification_outbox import NotificationOutbox
+
+    config = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+    scratch_dir = os.path.join(tmpdir, 'scratch_sid_01234567890_jid_0123456789')
+    os.makedirs(scratch_dir)
+
+    outbox = NotificationOutbox(config,
+                                outbox_dir=os.path.join(tmpdir, 'outbox'),
+                                n_max_tries=2,
+                                retry_sleep_s=0.01,
+                                retry_check_interval_s=0.05)
+    try:
+        for status in ['submitted', 'done']:
+            message, receivers_email_addresses = build_email_message(config.sender_email_address,
+                                                                     None,
+                                                                     None,
+                                                                     'mtm@mtmco.net',
+                                                                     config.contact_email_address,
+                                                                     f'job {status}',
+                                                                     f'the job is {status}',
+                                                                     f'<html><body>the job is {status}</body></html>')
+            outbox.enqueue_email(message, receivers_email_addresses, status, scratch_dir, first_submitted_time=time.time())
+
+        assert outbox.flush(timeout=30)
+    finally:
+        outbox.close()
+
+    dispatcher_local_mail_server.assert_email_number(2)
+    assert len(glob.glob(os.path.join(scratch_dir, 'email_history', 'email_submitted_*.email'))) == 1
+    assert len(glob.glob(os.path.join(scratch_dir, 'email_history', 'email_done_*.email'))) == 1
+    assert outbox.pending_records() == []
+
+    # the notifications which can not be delivered are retried, and stored as not sent in the end
+    config.smtp_port = 1
+    outbox = NotificationOutbox(config,
+                                outbox_dir=os.path.join(tmpdir, 'outbox'),
+                                n_max_tries=2,
+                                retry_sleep_s=0.01,
+                                retry_check_interval_s=0.05)
+    try:
+        outbox.enqueue_email(message, receivers_email_addresses, 'failed', scratch_dir)
+        assert outbox.flush(timeout=30)
+    finally:
+        outbox.close()
+
+    dispatcher_local_mail_server.assert_email_number(2)
+    assert len(glob.glob(os.path.join(scratch_dir, 'email_history', 'not_sent_email_*.email'))) == 1
+    assert outbox.pending_records() == []
+
+
+@pytest.mark.not_safe_parallel
+def test_notification_outbox_undelivered(dispatcher_test_conf_fn, dispatcher_local_mail_server, tmpdir, monkeypatch):
+    from cdci_data_analysis.configurer import ConfigEnv
+    from cdci_data_analysis.analysis import notification_outbox, notification_ledger
+    from cdci_data_analysis.analysis.email_helper import build_email_message
+
+    config = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+    job_id = '0123456789abcdef'
+    scratch_dir = os.path.join(tmpdir, f'scratch_sid_01234567890_jid_{job_id}')
+    os.makedirs(scratch_dir)
+    message, receivers_email_addresses = build_email_message(config.sender_email_address, None, None,
+                                                             'mtm@mtmco.net', config.contact_email_address,
+                                                             'job done', 'the job is done',
+                                                             '<html><body>the job is done</body></html>')
+
+    # the smtp server is not reachable, and the notification waits to be retried
+    config.smtp_port = 1
+    outbox = notification_outbox.NotificationOutbox(config,
+                                                    outbox_dir=os.path.join(tmpdir, 'outbox'),
+                                                    n_max_tries=10,
+                                                    retry_sleep_s=3600,
+                                                    max_retry_sleep_s=3600,
+                                                    retry_check_interval_s=0.05)
+    monkeypatch.setattr(notification_outbox, 'get_notification_outbox', lambda: outbox)
+    try:
+        sending_time = time.time()
+        record_id = outbox.enqueue_email(message, receivers_email_addresses, 'done', scratch_dir,
+                                         sending_time=sending_time, first_submitted_time=sending_time - 10)
+        assert len(outbox.undelivered_records('email', 'done', [scratch_dir])) == 1
+        assert outbox.undelivered_records('email', 'submitted', [scratch_dir]) == []
+        assert outbox.undelivered_records('matrix', 'done', [scratch_dir]) == []
+
+        # counted as sent, not to queue another one
+        summary = notification_ledger.get_job_notification_summary(job_id, 'email', 'done', scratch_dir=scratch_dir)
+        assert summary.count == 1
+        assert summary.last_sending_time == sending_time
+        assert summary.file_names == [outbox.record_path(record_id)]
+        assert glob.glob(os.path.join(scratch_dir, 'email_history', 'email_done_*.email')) == []
+    finally:
+        outbox.close()
+
+    # a record claimed by a worker which stopped is released by the running outbox, and delivered
+    claimed_record_path = outbox.record_path(record_id) + '.sending'
+    with open(outbox.record_path(record_id)) as f:
+        record = json.load(f)
+    os.remove(outbox.record_path(record_id))
+
+    monkeypatch.setattr(notification_outbox, 'stale_claim_check_interval_s', 0)
+    config = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+    outbox = notification_outbox.NotificationOutbox(config,
+                                                    outbox_dir=os.path.join(tmpdir, 'outbox'),
+                                                    retry_check_interval_s=0.05)
+    try:
+        record['next_try_time'] = 0
+        with open(claimed_record_path, 'w') as f:
+            json.dump(record, f)
+        os.utime(claimed_record_path, (0, 0))
+
+        t0 = time.time()
+        while len(glob.glob(os.path.join(scratch_dir, 'email_history', 'email_done_*.email'))) == 0 \
+                and time.time() - t0 < 30:
+            time.sleep(0.1)
+        assert outbox.flush(timeout=30)
+    finally:
+        outbox.close()
+
+    dispatcher_local_mail_server.assert_email_number(1)
+    assert len(glob.glob(os.path.join(scratch_dir, 'email_history', 'email_done_*.email'))) == 1
+    assert notification_ledger.get_job_notification_summary(job_id, 'email', 'done', scratch_dir=scratch_dir).count == 1
+
+
+def test_notification_ledger(tmpdir, monkeypatch):
+    from cdci_data_analysis.analysis import notification_ledger
+    from cdci_data_analysis.analysis.email_helper import store_status_email_info, get_first_submitted_email_time, \
+        build_email_message
+
+    monkeypatch.chdir(tmpdir)
+    job_id = '0123456789abcdef'
+    scratch_dir = f'scratch_sid_01234567890ABCDE_jid_{job_id}'
+    other_session_scratch_dir = f'scratch_sid_FEDCBA0987654321_jid_{job_id}'
+
+    # history written before the ledger was introduced
+    os.makedirs(os.path.join(scratch_dir, 'email_history'))
+    for fn in ['email_submitted_1700000010.0_1700000000.0.email',
+               'email_submitted_1700000100.0_1700000000.0.email',
+               'email_history_log_submitted_1700000100.0_abcdef.log',
+               'not_sent_email_1700000200.0.email']:
+        with open(os.path.join(scratch_dir, 'email_history', fn), 'w') as f:
+            f.write('')
+
+    summary = notification_ledger.get_notification_summary(scratch_dir, 'email', 'submitted')
+    assert summary.count == 2
+    assert float(summary.first_submitted_time) == 1700000000.0
+    assert summary.last_sending_time == 1700000100.0
+    assert os.path.exists(os.path.join(scratch_dir, 'notification_ledger.jsonl'))
+    assert get_first_submitted_email_time(scratch_dir) == 1700000000.0
+
+    message, _ = build_email_message('team@odahub.io', None, None, 'mtm@mtmco.net', 'contact@odahub.io',
+                                     'subject', 'text', '<html></html>')
+    os.makedirs(other_session_scratch_dir)
+    store_status_email_info(message, 'submitted', other_session_scratch_dir, logger,
+                            sending_time=1700000300.0, first_submitted_time=1700000000.0)
+    store_status_email_info(message, 'done', scratch_dir, logger,
+                            sending_time=1700000400.0, first_submitted_time=1700000000.0)
+
+    assert notification_ledger.get_notification_summary(scratch_dir, 'email', 'done').count == 1
+    assert notification_ledger.get_notification_summary(scratch_dir, 'matrix', 'done').count == 0
+
+    job_summary = notification_ledger.get_job_notification_summary(job_id, 'email', 'submitted', scratch_dir=scratch_dir)
+    assert job_summary.count == 3
+    assert job_summary.last_sending_time == 1700000300.0
+    assert sorted(job_summary.file_names) == sorted(
+        glob.glob(f'scratch_*_jid_{job_id}*/email_history/email_submitted_*.email'))
+
+
+def test_notification_ledger_concurrent_build(tmpdir, monkeypatch):
+    import threading
+    from cdci_data_analysis.analysis import notification_ledger
+
+    scratch_dir = str(tmpdir)
+    file_names = ['email_submitted_1700000010.0_1700000000.0.email', 'email_done_1700000100.0_1700000000.0.email']
+    os.makedirs(os.path.join(scratch_dir, 'email_history'))
+    for fn in file_names:
+        with open(os.path.join(scratch_dir, 'email_history', fn), 'w') as f:
+            f.write('')
+
+    def read_ledger_file_names():
+        with open(os.path.join(scratch_dir, 'notification_ledger.jsonl')) as f:
+            return sorted(json.loads(line)['file_name'] for line in f)
+
+    # two notifications recorded at the same time, both building the ledger from the history
+    barrier = threading.Barrier(2)
+    entries_from_history = notification_ledger._entries_from_history
+
+    def synchronized_entries_from_history(scratch_dir):
+        entries = entries_from_history(scratch_dir)
+        barrier.wait(timeout=10)
+        return entries
+
+    monkeypatch.setattr(notification_ledger, '_entries_from_history', synchronized_entries_from_history)
+    threads = [threading.Thread(target=notification_ledger.record_notification,
+                                args=(scratch_dir, 'email', r['status'], r['sending_time'], r['first_submitted_time'], fn))
+               for fn, r in ((fn, notification_ledger.history_file_patterns['email'].match(fn)) for fn in file_names)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert read_ledger_file_names() == sorted(file_names)
+    assert notification_ledger.get_notification_summary(scratch_dir, 'email', 'done').count == 1
+
+    # the ledger built by another process, before the history file of the notification was written
+    monkeypatch.setattr(notification_ledger, '_entries_from_history', entries_from_history)
+    os.remove(os.path.join(scratch_dir, 'notification_ledger.jsonl'))
+    new_file_name = 'email_failed_1700000200.0_1700000000.0.email'
+    with open(os.path.join(scratch_dir, 'email_history', new_file_name), 'w') as f:
+        f.write('')
+    build_ledger = notification_ledger._build_ledger
+
+    def concurrent_build_ledger(scratch_dir, entries):
+        build_ledger(scratch_dir, [e for e in entries if e['file_name'] != new_file_name])
+        return build_ledger(scratch_dir, entries)
+
+    monkeypatch.setattr(notification_ledger, '_build_ledger', concurrent_build_ledger)
+    notification_ledger.record_notification(scratch_dir, 'email', 'failed', '1700000200.0', '1700000000.0', new_file_name)
+    assert read_ledger_file_names() == sorted(file_names + [new_file_name])
+
+
+def get_job_notification_data(status='done'):
+    time_request = time.time() - 3600
+    return {
+        'oda_site': {
+            'site_name': 'University of Geneva',
+            'frontend_url': 'http://www.astro.unige.ch/mmoda',
+            'contact': 'contact@odahub.io',
+            'manual_reference': 'possibly-non-site-specific-link',
+        },
+        'request': {
+            'job_id': make_hash(dict(status=status, time_request=time_request)),
+            'status': status,
+            'status_details_title': status,
+            'status_details_message': None,
+            'instrument': 'empty-async',
+            'product_type': 'dummy',
+            'time_request': time_request,
+            'request_url': 'http://www.astro.unige.ch/mmoda/dispatch-data/run_analysis?instrument=empty-async',
+            'api_code_no_token': 'from oda_api.api import DispatcherAPI',
+            'api_code': 'from oda_api.api import DispatcherAPI',
+            'api_code_too_long': False,
+            'decoded_token': default_token_payload,
+            'permanent_url': True,
+        }
+    }
+
+
+def test_notification_templates_reload(dispatcher_live_fixture):
+    from cdci_data_analysis.analysis import template_helper, email_helper, matrix_helper
+
+    email_template = template_helper.get_template('email', 'email.html')
+    assert template_helper.get_template('email', 'email.html') is email_template
+    assert template_helper.get_template_environment('email').filters['timestamp2isot'] is email_helper.timestamp2isot
+    assert template_helper.get_template_environment('matrix').filters['timestamp2isot'] is matrix_helper.timestamp2isot
+
+    notification_data = get_job_notification_data()
+    assert notification_data['request']['job_id'][:8] in email_template.render(**notification_data)
+
+    c = requests.get(dispatcher_live_fixture + "/reload-templates")
+    assert c.status_code == 200
+    assert 'email.html' in c.text and 'matrix_message.html' in c.text
+
+    template_names = template_helper.reload_templates()
+    assert sorted(template_names) == sorted(['email.html', 'incident_report_email.html',
+                                             'matrix_message.html', 'incident_report_matrix_message.html'])
+    assert template_helper.get_template('email', 'email.html') is not email_template
+    assert notification_data['request']['job_id'][:8] in template_helper.get_template('email', 'email.html').render(**notification_data)
+
+
+@pytest.mark.benchmark
+def test_notification_rendering_benchmark():
+    from jinja2 import Environment, FileSystemLoader
+    from cdci_data_analysis.analysis import template_helper, email_helper, matrix_helper
+
+    n_notifications = 1000
+    notifications_data = [get_job_notification_data(status) for status in ['submitted', 'done', 'failed']]
+
+    t0 = time.perf_counter()
+    for i in range(n_notifications):
+        notification_data = notifications_data[i % len(notifications_data)]
+        email_helper.textify_email(template_helper.get_template('email', 'email.html').render(**notification_data))
+        template_helper.get_template('matrix', 'matrix_message.html').render(**notification_data)
+    cached_time = time.perf_counter() - t0
+
+    # as done before the registry, with a new environment for each notification
+    n_uncached_notifications = 100
+    t0 = time.perf_counter()
+    for i in range(n_uncached_notifications):
+        notification_data = notifications_data[i % len(notifications_data)]
+        for template_name, filters_module in [('email.html', email_helper), ('matrix_message.html', matrix_helper)]:
+            env = Environment(loader=FileSystemLoader(template_helper.templates_dir))
+            env.filters['timestamp2isot'] = filters_module.timestamp2isot
+            env.filters['humanize_age'] = email_helper.humanize_age
+            env.filters['humanize_future'] = email_helper.humanize_future
+            rendered = env.get_template(template_name).render(**notification_data)
+            if template_name == 'email.html':
+                email_helper.textify_email(rendered)
+    uncached_time = (time.perf_counter() - t0) * n_notifications / n_uncached_notifications
+
+    logger.info("rendering %s job notifications: %.2f s with the template registry, "
+                "%.2f s (extrapolated) compiling the templates each time",
+                n_notifications, cached_time, uncached_time)
+    # about ten times faster when measured
+    assert cached_time < uncached_time
+
+
 @pytest.mark.parametrize('sb_value', [25, 25., 25.64547871216879451687311211245117852145229614585985498212321])
 def test_spectral_parameter(dispatcher_live_fixture, sb_value):
 
@@ -2677,12 +2995,137 @@ def test_free_up_space(dispatcher_live_fixture, number_folders_to_delete, soft_m
 
     assert 'output_status' in jdata
 
-    number_lock_files_deleted = 0 if number_folders_to_delete < number_analysis_to_run else 1
+    # the lock files are removed when the locks are released
     assert jdata['output_status'] ==  (f"Removed {number_folders_to_delete} scratch directories, "
-                                       f"and {number_lock_files_deleted} lock files.")
+                                       "and 0 lock files.")
 
     assert len(glob.glob("scratch_sid_*_jid_*")) == number_analysis_to_run - number_folders_to_delete
 
+
+def test_free_up_space_dry_run_incremental(dispatcher_live_fixture):
+    DispatcherJobState.remove_scratch_folders()
+    DispatcherJobState.remove_lock_files()
+
+    server = dispatcher_live_fixture
+
+    token_payload = {
+        **default_token_payload,
+        "roles": ['space manager'],
+    }
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+
+    number_analysis_to_run = 4
+    for i in range(number_analysis_to_run):
+        jdata = ask(server,
+                    {
+                        'query_status': 'new',
+                        'product_type': 'dummy',
+                        'query_type': "Dummy",
+                        'instrument': 'empty',
+                        'token': encoded_token,
+                    },
+                    expected_query_status=["done"],
+                    max_time_s=150
+                    )
+
+    # a lock file left, e.g. by an interrupted request, is removed with the last scratch directory of its job
+    open(f".lock_{jdata['job_monitor']['job_id']}", 'w').close()
+
+    # all the folders are older than the hard minimum age
+    current_time = time.time()
+    for i, scratch_dir in enumerate(sorted(glob.glob("scratch_sid_*_jid_*"), key=os.path.getmtime)):
+        os.utime(scratch_dir, (current_time, current_time - 60 * 60 * 24 * 40 + i))
+
+    c = requests.get(os.path.join(server, "free-up-space"), params={'token': encoded_token, 'dry_run': True})
+    jdata = c.json()
+    assert jdata['output_status'].startswith(f"Would remove {number_analysis_to_run} scratch directories, "
+                                             f"and 1 lock files, freeing ")
+    assert jdata['reclaimable_bytes'] > 0
+    assert jdata['next_cursor'] is None
+    assert len(glob.glob("scratch_sid_*_jid_*")) == number_analysis_to_run
+
+    c = requests.get(os.path.join(server, "free-up-space"), params={'token': encoded_token, 'max_dirs': 3})
+    jdata = c.json()
+    assert jdata['output_status'] == "Removed 3 scratch directories, and 0 lock files."
+    assert jdata['next_cursor'] is not None
+    assert len(glob.glob("scratch_sid_*_jid_*")) == 1
+
+    c = requests.get(os.path.join(server, "free-up-space"), params={'token': encoded_token,
+                                                                    'max_dirs': 3,
+                                                                    'cursor': jdata['next_cursor']})
+    jdata = c.json()
+    assert jdata['output_status'] == "Removed 1 scratch directories, and 1 lock files."
+    assert jdata['next_cursor'] is None
+    assert len(glob.glob("scratch_sid_*_jid_*")) == 0
+
+
+def test_free_up_space_download_cache(dispatcher_live_fixture):
+    DispatcherJobState.remove_scratch_folders()
+    DispatcherJobState.remove_lock_files()
+    DispatcherJobState.remove_download_folders()
+
+    server = dispatcher_live_fixture
+
+    token_payload = {
+        **default_token_payload,
+        "roles": ['space manager'],
+    }
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+
+    jdata = ask(server,
+                {
+                    'query_status': 'new',
+                    'product_type': 'dummy',
+                    'query_type': "Dummy",
+                    'instrument': 'empty',
+                    'token': encoded_token,
+                },
+                expected_query_status=["done"],
+                max_time_s=150
+                )
+    job_id = jdata['job_monitor']['job_id']
+
+    current_time = time.time()
+    scratch_dir = glob.glob(f"scratch_sid_*_jid_{job_id}")[0]
+    os.utime(scratch_dir, (current_time, current_time - 60 * 60 * 24 * 40))
+
+    cache = DownloadCache()
+    archive_keys = {}
+    for archive_job_id in [job_id, 'f' * 16]:
+        archive_path = f'archive_{archive_job_id}'
+        with open(archive_path, 'wb') as fout:
+            fout.write(os.urandom(20))
+        archive_keys[archive_job_id] = make_download_cache_key(archive_job_id,
+                                                               [os.path.join(scratch_dir, 'analysis_parameters.json')],
+                                                               ['gz', 'output_test', 9])
+        cache.put(archive_keys[archive_job_id], archive_path)
+
+    old_download_dir = 'download_old_test'
+    os.makedirs(old_download_dir)
+    os.utime(old_download_dir, (current_time, current_time - 60 * 60 * 24 * 40))
+    recent_download_dir = 'download_recent_test'
+    os.makedirs(recent_download_dir)
+
+    c = requests.get(os.path.join(server, "free-up-space"), params={'token': encoded_token, 'dry_run': True})
+    jdata = c.json()
+    assert jdata['download_archives_removed'] == 1
+    assert jdata['download_dirs_removed'] == 1
+    assert cache.get(archive_keys[job_id]) is not None
+
+    c = requests.get(os.path.join(server, "free-up-space"), params={'token': encoded_token})
+    jdata = c.json()
+    assert jdata['output_status'] == "Removed 1 scratch directories, and 0 lock files."
+    assert jdata['download_archives_removed'] == 1
+    assert jdata['download_dirs_removed'] == 1
+
+    # the archives of the removed job are removed with its scratch directory
+    assert cache.get(archive_keys[job_id]) is None
+    assert cache.get(archive_keys['f' * 16]) is not None
+    assert not os.path.exists(old_download_dir)
+    assert os.path.exists(recent_download_dir)
+
+    DispatcherJobState.remove_download_folders()
+
 @pytest.mark.parametrize("request_cred", ['public', 'private', 'invalid_token'])
 @pytest.mark.parametrize("roles", ["general, job manager", "administrator", ""])
 @pytest.mark.parametrize("include_session_log", [True, False, None])
@@ -3110,6 +3553,67 @@ def test_inspect_jobs(dispatcher_live_fixture, request_cred, roles, pass_job_id,
             )
             assert not jdata['records'][0]['job_status_data'][0]['token_expired']
 
+@pytest.mark.parametrize("group_by_job", [True, False])
+def test_inspect_jobs_pagination(dispatcher_live_fixture, group_by_job):
+    DispatcherJobState.remove_scratch_folders()
+    server = dispatcher_live_fixture
+
+    token_payload = {**default_token_payload, "roles": "job manager"}
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+
+    job_ids = set()
+    for product_type, expected_query_status in [('dummy', 'done'), ('failing', 'failed')]:
+        jdata = ask(server,
+                    {
+                        'query_status': 'new',
+                        'product_type': product_type,
+                        'query_type': "Dummy",
+                        'instrument': 'empty',
+                        'token': encoded_token,
+                    },
+                    expected_query_status=expected_query_status,
+                    max_time_s=150,
+                    )
+        job_ids.add(jdata['job_monitor']['job_id'])
+
+    inspect_params = dict(
+        token=encoded_token,
+        group_by_job=group_by_job,
+        limit=1,
+        fields='job_monitor,mtime'
+    )
+
+    inspected_job_ids = set()
+    for page in range(2):
+        c = requests.get(server + "/inspect-state",
+                         params=inspect_params)
+        assert c.status_code == 200
+        jdata = c.json()
+        if group_by_job:
+            assert StateJobsInspectionScheme().validate(jdata) == {}
+        assert len(jdata['records']) == 1
+
+        record = jdata['records'][0]
+        inspected_job_ids.add(record['job_id'])
+        if group_by_job:
+            assert len(record['job_status_data']) == 1
+            assert set(record['job_status_data'][0]['scratch_dir_content'].keys()) == {'job_monitor'}
+        else:
+            assert set(record.keys()) == {'job_id', 'job_monitor', 'mtime'}
+
+        if page == 0:
+            assert jdata['next_cursor'] is not None
+            inspect_params['cursor'] = jdata['next_cursor']
+        else:
+            assert jdata['next_cursor'] is None
+
+    assert inspected_job_ids == job_ids
+
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, group_by_job=group_by_job, cursor='not-a-cursor'))
+    assert c.status_code == 400
+
+
 def test_inspect_jobs_with_callbacks(gunicorn_dispatcher_long_living_fixture):
     server = gunicorn_dispatcher_long_living_fixture
     token_payload = {**default_token_payload, "roles": 'job manager'}
@@ -3384,6 +3888,145 @@ def test_inspect_status_expired_token(dispatcher_live_fixture):
     assert jdata_inspection['records'][0]['token_expired']
 
 
+def test_job_registry_indexing(dispatcher_live_fixture):
+    server = dispatcher_live_fixture
+    DispatcherJobState.remove_scratch_folders()
+
+    token_payload = {**default_token_payload}
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+
+    jdata = ask(server,
+                {
+                    'query_status': 'new',
+                    'product_type': 'dummy',
+                    'query_type': "Dummy",
+                    'instrument': 'empty',
+                    'token': encoded_token,
+                },
+                expected_query_status=["done"],
+                max_time_s=150,
+                )
+
+    job_id = jdata['products']['job_id']
+    session_id = jdata['session_id']
+
+    registry = get_job_registry()
+    indexed_scratch_dirs = registry.find(job_id=job_id)
+    assert len(indexed_scratch_dirs) == 1
+    assert indexed_scratch_dirs[0]['scratch_dir'] == f'scratch_sid_{session_id}_jid_{job_id}'
+    assert indexed_scratch_dirs[0]['session_id'] == session_id
+    assert indexed_scratch_dirs[0]['sub'] == token_payload['sub']
+    assert indexed_scratch_dirs[0]['status'] == 'done'
+    assert indexed_scratch_dirs[0]['aliased'] == 0
+
+    assert registry.find(job_id=job_id, sub="another@user.net") == []
+    assert len(registry.find(job_id_prefix=job_id[:8], sub=token_payload['sub'])) == 1
+
+    # a scratch directory removed outside the dispatcher is not reported, and dropped from the index
+    DispatcherJobState.remove_scratch_folders(job_id=job_id)
+
+    token_payload["roles"] = 'job manager'
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+    c = requests.get(server + "/inspect-state",
+                     params=dict(token=encoded_token, job_id=job_id[:8]))
+    assert c.status_code == 200
+    assert c.json()['records'] == []
+    assert registry.find(job_id=job_id) == []
+
+
+def test_job_registry_rebuild(tmpdir):
+    registry = JobRegistry(os.path.join(tmpdir, 'job_registry.sqlite'))
+    token_user_1 = jwt.encode({**default_token_payload, 'sub': 'user1@odahub.io'}, secret_key, algorithm='HS256')
+
+    scratch_dirs = {}
+    for i, (sub_token, status) in enumerate([(token_user_1, 'done'), (None, 'submitted')]):
+        job_id = make_hash(dict(i=i))
+        scratch_dir = os.path.join(tmpdir, f'scratch_sid_{"0" * 15}{i}_jid_{job_id}')
+        os.makedirs(scratch_dir)
+        analysis_parameters = dict(instrument='empty')
+        if sub_token is not None:
+            analysis_parameters['token'] = sub_token
+        with open(os.path.join(scratch_dir, 'analysis_parameters.json'), 'w') as f:
+            json.dump(analysis_parameters, f)
+        with open(os.path.join(scratch_dir, 'job_monitor.json'), 'w') as f:
+            json.dump(dict(job_id=job_id, status=status), f)
+        scratch_dirs[job_id] = scratch_dir
+
+    # unrelated entries are not indexed
+    os.makedirs(os.path.join(tmpdir, 'download_abc'))
+
+    assert registry.count() == 0
+    assert registry.rebuild(tmpdir) == 2
+    assert registry.count() == 2
+
+    job_id_user_1, job_id_public = list(scratch_dirs)
+    assert [e['job_id'] for e in registry.find(sub='user1@odahub.io')] == [job_id_user_1]
+    assert [e['job_id'] for e in registry.find(status='submitted')] == [job_id_public]
+    assert [e['job_id'] for e in registry.find(job_id_prefix=job_id_public[:8])] == [job_id_public]
+    assert registry.find(min_mtime=time.time() + 10) == []
+
+    # updates keep the values not provided
+    registry.update(scratch_dirs[job_id_user_1], status='failed')
+    entry = registry.find(job_id=job_id_user_1)[0]
+    assert entry['status'] == 'failed'
+    assert entry['sub'] == 'user1@odahub.io'
+
+    registry.remove(scratch_dirs[job_id_user_1])
+    assert registry.count() == 1
+
+
+def test_job_registry_journal(tmpdir):
+    import sqlite3
+
+    # a registry created in WAL mode, not usable on a network filesystem, is moved to the rollback journal
+    db_path = os.path.join(tmpdir, 'job_registry.sqlite')
+    connection = sqlite3.connect(db_path)
+    assert connection.execute("PRAGMA journal_mode=WAL").fetchone()[0] == 'wal'
+    connection.close()
+
+    registry = JobRegistry(db_path)
+    assert registry.count() == 0
+    assert registry._connection().execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+
+
+def test_job_registry_populated(tmpdir, monkeypatch):
+    db_path = os.path.join(tmpdir, 'job_registry.sqlite')
+    registry = JobRegistry(db_path)
+
+    old_job_id = make_hash(dict(i='old'))
+    old_scratch_dir = os.path.join(tmpdir, f'scratch_sid_{"0" * 16}_jid_{old_job_id}')
+    os.makedirs(old_scratch_dir)
+
+    # entries written before the rebuild do not make the index populated
+    registry.update(os.path.join(tmpdir, f'scratch_sid_{"1" * 16}_jid_{make_hash(dict(i="new"))}'), status='submitted')
+    assert not registry.is_populated()
+
+    # an interrupted rebuild leaves the index as it was
+    from cdci_data_analysis.analysis import scratch_layout
+
+    iter_scratch_dir_entries = scratch_layout.iter_scratch_dir_entries
+
+    def interrupted_iter_scratch_dir_entries(wd='.'):
+        yield from iter_scratch_dir_entries(wd)
+        raise OSError("interrupted")
+
+    with monkeypatch.context() as m:
+        m.setattr(scratch_layout, 'iter_scratch_dir_entries', interrupted_iter_scratch_dir_entries)
+        with pytest.raises(OSError):
+            registry.rebuild(tmpdir)
+    assert not JobRegistry(db_path).is_populated()
+    assert registry.find(job_id=old_job_id) == []
+
+    # in the meantime, the scratch directories are found listing the working directory
+    from cdci_data_analysis.analysis.job_registry import iter_scan
+    assert [e['job_id'] for e in iter_scan(str(tmpdir), job_id_prefix=old_job_id[:8])] == [old_job_id]
+
+    assert registry.ensure_populated(str(tmpdir))
+    assert JobRegistry(db_path).is_populated()
+    assert [e['job_id'] for e in registry.find(job_id=old_job_id)] == [old_job_id]
+    assert registry.find(status='submitted') != []
+
+
 @pytest.mark.parametrize("request_cred", ['public', 'valid_token', 'invalid_token'])
 def test_incident_report(dispatcher_live_fixture, dispatcher_local_mail_server, dispatcher_test_conf, request_cred):
     server = dispatcher_live_fixture
@@ -3546,3 +4189,448 @@ def test_session_log(dispatcher_live_fixture):
     assert '==============================> run query <==============================' in session_log_content
     assert "'p': '35'," in session_log_content
     assert "'p': '15'," not in session_log_content
+
+
+def test_make_hash_compatibility():
+    par_dic = {'instrument': 'empty',
+               'product_type': 'dummy',
+               'RA': 265.97845833,
+               'scw_list': ['066500230010.001', '066500240010.001'],
+               'selected_catalog': None}
+
+    # the job_id of the existing scratch directories
+    assert make_hash(par_dic) == 'ef9d9be8b2c2e73c'
+    assert make_hash(par_dic) == 'ef9d9be8b2c2e73c'
+    assert make_hash(['a', 1, 2.5, True, None]) == 'fab3998040af7648'
+
+    # as in the job_id, the order of the elements is not relevant
+    reordered_par_dic = {k: par_dic[k] for k in reversed(list(par_dic))}
+    reordered_par_dic['scw_list'] = list(reversed(par_dic['scw_list']))
+    assert make_hash(reordered_par_dic) == 'ef9d9be8b2c2e73c'
+
+    assert make_hash({**par_dic, 'RA': 1}) != make_hash(par_dic)
+
+    # the long leaves are cached by their digest, in a bounded cache
+    from cdci_data_analysis.analysis import hash as hash_module
+    selected_catalog = json.dumps({'cat_column_list': [list(range(200)), ['source'] * 200]})
+    assert len(json.dumps(selected_catalog)) > hash_module.max_short_leaf_size
+    for _ in range(2):
+        assert make_hash({**par_dic, 'selected_catalog': selected_catalog}) == \
+               make_hash_uncached({**par_dic, 'selected_catalog': selected_catalog})
+    assert not any(isinstance(k, str) for k in hash_module._long_leaf_hashes)
+    for i in range(hash_module.max_cached_long_leaves + 10):
+        make_hash(selected_catalog + str(i))
+    assert len(hash_module._long_leaf_hashes) == hash_module.max_cached_long_leaves
+
+
+def make_hash_uncached(o):
+    from cdci_data_analysis.analysis.hash import format_hash
+    if isinstance(o, (set, tuple, list)):
+        return format_hash([make_hash_uncached(x) for x in o])
+    elif isinstance(o, dict):
+        return make_hash_uncached(tuple(o.items()))
+    return format_hash(json.dumps(o))
+
+
+def test_call_back_coalescing(dispatcher_live_fixture_with_call_back_coalescing):
+    server = dispatcher_live_fixture_with_call_back_coalescing
+    logger.info("constructed server: %s", server)
+
+    DispatcherJobState.remove_scratch_folders()
+    DataServerQuery.set_status('submitted')
+
+    dict_param = dict(
+        query_status="new",
+        query_type="Real",
+        instrument="empty-async",
+        product_type="dummy"
+    )
+
+    c = requests.get(os.path.join(server, "run_analysis"), dict_param)
+    assert c.status_code == 200
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(c.json())
+
+    call_back_params = dict(
+        job_id=dispatcher_job_state.job_id,
+        session_id=dispatcher_job_state.session_id,
+        instrument_name="empty-async",
+        action='progress',
+        message='progressing',
+    )
+
+    # a burst of progress callbacks, one by one and batched
+    for i in range(3):
+        c = requests.get(os.path.join(server, "call_back"), params={**call_back_params, 'node_id': f'node_{i}'})
+        assert c.status_code == 200
+        assert c.json()['call_back_status'] == 'queued'
+
+    c = requests.post(os.path.join(server, "call_back"),
+                      json={'call_backs': [{**call_back_params, 'node_id': f'node_{i}'} for i in range(3, 6)]})
+    assert c.status_code == 200
+    assert c.json()['n_call_backs'] == 3
+    assert c.json()['n_queued'] == 3
+
+    c = requests.post(os.path.join(server, "call_back"), json={'call_backs': 'node_6'})
+    assert c.status_code == 400
+
+    # only the latest callback of the burst is processed
+    time.sleep(3)
+    assert dispatcher_job_state.load_job_state_record('node_5', 'progressing')['full_report_dict']['action'] == 'progress'
+    for i in range(5):
+        assert not os.path.exists(f'{dispatcher_job_state.scratch_dir}/job_monitor_node_{i}_progressing_.json')
+
+    # the callback completing the job supersedes the pending ones, and is processed right away
+    c = requests.get(os.path.join(server, "call_back"), params={**call_back_params, 'node_id': 'node_6'})
+    assert c.json()['call_back_status'] == 'queued'
+
+    c = requests.get(os.path.join(server, "call_back"), params={**call_back_params, 'action': 'done', 'node_id': 'node_7'})
+    assert c.status_code == 200
+    assert 'call_back_status' not in c.json()
+    assert dispatcher_job_state.load_job_state_record('node_7', 'progressing')['full_report_dict']['action'] == 'done'
+
+    time.sleep(3)
+    assert not os.path.exists(f'{dispatcher_job_state.scratch_dir}/job_monitor_node_6_progressing_.json')
+
+
+def test_call_back_job_lock(tmpdir):
+    import multiprocessing
+    from cdci_data_analysis.analysis.call_back_journal import CallBackJournal, CallBackCoalescer
+
+    processed = []
+    journal = CallBackJournal(os.path.join(tmpdir, 'call_back_journal'))
+    coalescer = CallBackCoalescer(journal,
+                                  lambda call_back_values, accepted_time: processed.append(time.time()),
+                                  interval_s=3600)
+    call_back_values = dict(job_id='a' * 16, session_id='B' * 16, action='progress', node_id='node_0')
+    key = journal.get_key(call_back_values)
+    assert coalescer.accept(call_back_values)
+
+    # the callbacks of the job are being processed by another worker process
+    context = multiprocessing.get_context('fork')
+    locked = context.Event()
+    released_time = context.Value('d', 0.)
+
+    def process_elsewhere():
+        with coalescer.job_lock(key):
+            locked.set()
+            time.sleep(1)
+            released_time.value = time.time()
+
+    process = context.Process(target=process_elsewhere)
+    process.start()
+    assert locked.wait(10)
+
+    assert coalescer.flush() == 1
+    process.join()
+    assert processed[0] >= released_time.value > 0
+    assert journal.keys() == []
+    coalescer.close()
+
+
+def test_status_poll_fast_path(dispatcher_live_fixture):
+    server = dispatcher_live_fixture
+    logger.info("constructed server: %s", server)
+
+    DispatcherJobState.remove_scratch_folders()
+    DataServerQuery.set_status('submitted')
+
+    encoded_token = jwt.encode(default_token_payload, secret_key, algorithm='HS256')
+
+    dict_param = dict(
+        query_status="new",
+        query_type="Real",
+        instrument="empty-async",
+        product_type="dummy",
+        token=encoded_token
+    )
+
+    c = requests.get(os.path.join(server, "run_analysis"), dict_param)
+    assert c.status_code == 200
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(c.json())
+    session_log_fn = os.path.join(dispatcher_job_state.scratch_dir, 'session.log')
+
+    for i in range(2):
+        requests.get(os.path.join(server, "call_back"),
+                     params=dict(
+                         job_id=dispatcher_job_state.job_id,
+                         session_id=dispatcher_job_state.session_id,
+                         instrument_name="empty-async",
+                         action='progress',
+                         node_id=f'node_{i}',
+                         message='progressing',
+                         token=encoded_token
+                     ))
+
+    poll_dict_param = {
+        **dict_param,
+        'query_status': 'submitted',
+        'job_id': dispatcher_job_state.job_id,
+        'session_id': dispatcher_job_state.session_id,
+    }
+
+    c = requests.get(os.path.join(server, "run_analysis"), poll_dict_param)
+    assert c.status_code == 200
+    jdata = c.json()
+    assert jdata['query_status'] == 'progress'
+    assert jdata['job_status'] == 'progress'
+    assert jdata['exit_status']['job_status'] == 'progress'
+    assert jdata['session_id'] == dispatcher_job_state.session_id
+    assert [d['action'] for d in jdata['job_monitor']['full_report_dict_list']] == ['progress', 'progress']
+
+    with open(session_log_fn) as session_log_fn_f:
+        session_log_content = session_log_fn_f.read()
+    # answered from the job monitor, without running the query
+    assert session_log_content.count('> status poll <') == 1
+    assert session_log_content.count('> run query <') == 1
+
+    # the job of the poll has to be validated for the user, otherwise the request is handled by run_query
+    other_user_token = jwt.encode({**default_token_payload, 'sub': "mtm1@mtmco.net"}, secret_key, algorithm='HS256')
+    c = requests.get(os.path.join(server, "run_analysis"), {**poll_dict_param, 'token': other_user_token})
+    assert c.status_code == 403
+    assert c.json()['exit_status']['message'] == "Request not authorized"
+
+    requests.get(os.path.join(server, "call_back"),
+                 params=dict(
+                     job_id=dispatcher_job_state.job_id,
+                     session_id=dispatcher_job_state.session_id,
+                     instrument_name="empty-async",
+                     action='done',
+                     node_id='node_2',
+                     message='done',
+                     token=encoded_token
+                 ))
+
+    c = requests.get(os.path.join(server, "run_analysis"), {**poll_dict_param, 'query_status': 'progress'})
+    assert c.status_code == 200
+    assert c.json()['query_status'] == 'ready'
+
+    with open(session_log_fn) as session_log_fn_f:
+        session_log_content = session_log_fn_f.read()
+    assert session_log_content.count('> status poll <') == 2
+
+    # the products are built by run_query
+    DataServerQuery.set_status('done')
+    c = requests.get(os.path.join(server, "run_analysis"), {**poll_dict_param, 'query_status': 'ready'})
+    assert c.status_code == 200
+    assert c.json()['query_status'] == 'done'
+
+    with open(session_log_fn) as session_log_fn_f:
+        session_log_content = session_log_fn_f.read()
+    assert session_log_content.count('> status poll <') == 2
+    assert session_log_content.count('> run query <') == 3
+
+
+def test_sharded_scratch_dir(dispatcher_live_fixture_with_sharded_scratch):
+    from cdci_data_analysis.analysis.scratch_layout import ScratchLayout
+
+    server = dispatcher_live_fixture_with_sharded_scratch
+    logger.info("constructed server: %s", server)
+
+    DispatcherJobState.remove_scratch_folders()
+    DataServerQuery.set_status('submitted')
+
+    dict_param = dict(
+        query_status="new",
+        query_type="Real",
+        instrument="empty-async",
+        product_type="dummy"
+    )
+
+    c = requests.get(os.path.join(server, "run_analysis"), dict_param)
+    assert c.status_code == 200
+    dispatcher_job_state = DispatcherJobState.from_run_analysis_response(c.json())
+    job_id = dispatcher_job_state.job_id
+    session_id = dispatcher_job_state.session_id
+
+    scratch_dir = f'scratch_shards/{job_id[:2]}/scratch_sid_{session_id}_jid_{job_id}'
+    assert os.path.isdir(scratch_dir)
+    assert glob.glob(f'scratch_sid_*_jid_{job_id}*') == []
+    assert [entry['scratch_dir'] for entry in get_job_registry().find(job_id=job_id)] == [scratch_dir]
+
+    c = requests.get(os.path.join(server, "call_back"),
+                     params=dict(
+                         job_id=job_id,
+                         session_id=session_id,
+                         instrument_name="empty-async",
+                         action='done',
+                         node_id='node_0',
+                         message='done'
+                     ))
+    assert c.status_code == 200
+    assert os.path.exists(f'{scratch_dir}/job_monitor_node_0_done_.json')
+
+    # the directories created with the flat layout are found, even if not in the registry, and moved to their shard
+    os.rename(scratch_dir, f'scratch_sid_{session_id}_jid_{job_id}')
+    assert ScratchLayout(layout='sharded').find_job_scratch_dirs(job_id) == [f'scratch_sid_{session_id}_jid_{job_id}']
+    assert [entry['scratch_dir'] for entry in get_job_registry().find(job_id=job_id)] == \
+           [f'scratch_sid_{session_id}_jid_{job_id}']
+
+    DataServerQuery.set_status('done')
+    c = requests.get(os.path.join(server, "run_analysis"),
+                     {**dict_param, 'query_status': 'ready', 'job_id': job_id, 'session_id': session_id})
+    assert c.status_code == 200
+    assert c.json()['query_status'] == 'done'
+    assert not os.path.exists(scratch_dir)
+
+    assert ScratchLayout(layout='sharded').migrate(dry_run=True) == 1
+    assert not os.path.exists(scratch_dir)
+    assert ScratchLayout(layout='sharded').migrate() == 1
+    assert os.path.isdir(scratch_dir)
+    assert glob.glob(f'scratch_sid_*_jid_{job_id}*') == []
+    assert ScratchLayout(layout='sharded').find_job_scratch_dirs(job_id) == [scratch_dir]
+
+
+def test_lock_manager(tmpdir):
+    import threading
+    import contextlib
+    from cdci_data_analysis.analysis.lock_manager import LockManager, LockTimeout
+
+    lock_dir = str(tmpdir)
+    job_id = 'aaaaaaaaaaaaaaaa'
+    lock_file = os.path.join(lock_dir, f'.lock_{job_id}')
+    manager = LockManager(timeout_s=5)
+
+    with manager.lock(job_id, lock_dir=lock_dir):
+        assert os.path.exists(lock_file)
+        with pytest.raises(LockTimeout):
+            with manager.lock(job_id, lock_dir=lock_dir, timeout_s=0.2):
+                pass
+    assert not os.path.exists(lock_file)
+    assert manager.get_jobs_contention()[job_id]['n_timeouts'] == 1
+
+    # the waiters are woken up by the release, and hold the lock one at a time
+    holders = []
+    n_holders = []
+
+    def hold_lock():
+        with manager.lock(job_id, lock_dir=lock_dir):
+            holders.append(threading.get_ident())
+            n_holders.append(len(holders))
+            time.sleep(0.1)
+            holders.remove(threading.get_ident())
+
+    with manager.lock(job_id, lock_dir=lock_dir):
+        threads = [threading.Thread(target=hold_lock) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        assert holders == []
+
+    t0 = time.time()
+    for thread in threads:
+        thread.join()
+    assert time.time() - t0 < 5
+    assert n_holders == [1, 1, 1, 1]
+    assert not os.path.exists(lock_file)
+
+    job_contention = manager.get_jobs_contention()[job_id]
+    assert job_contention['n_waits'] >= 5
+    assert job_contention['n_timeouts'] == 1
+    assert job_contention['max_wait_s'] >= 0.5
+
+    # the waits given up are taken over, and beyond the maximum number of waiting threads the acquisitions fail
+    manager = LockManager(timeout_s=5, n_max_waiters=2)
+    job_ids = [job_id, 'bbbbbbbbbbbbbbbb', 'cccccccccccccccc']
+    with contextlib.ExitStack() as stack:
+        for held_job_id in job_ids:
+            stack.enter_context(manager.lock(held_job_id, lock_dir=lock_dir))
+
+        for _ in range(5):
+            with pytest.raises(LockTimeout):
+                with manager.lock(job_ids[0], lock_dir=lock_dir, timeout_s=0.05):
+                    pass
+        assert manager.get_n_waiters() == 1
+
+        with pytest.raises(LockTimeout):
+            with manager.lock(job_ids[1], lock_dir=lock_dir, timeout_s=0.05):
+                pass
+        assert manager.get_n_waiters() == 2
+
+        t0 = time.time()
+        with pytest.raises(LockTimeout):
+            with manager.lock(job_ids[2], lock_dir=lock_dir):
+                pass
+        assert time.time() - t0 < 1
+        assert manager.get_n_waiters() == 2
+
+    t0 = time.time()
+    while manager.get_n_waiters() > 0 and time.time() - t0 < 5:
+        time.sleep(0.05)
+    assert manager.get_n_waiters() == 0
+    assert glob.glob(os.path.join(lock_dir, '.lock_*')) == []
+
+
+def test_job_monitor_summary(tmpdir):
+    from cdci_data_analysis.analysis.job_manager import OsaJob, job_monitor_summary_file_name
+
+    work_dir = str(tmpdir)
+
+    def write_job_file(file_name, status, action, mtime):
+        fn = os.path.join(work_dir, file_name)
+        with open(fn, 'w') as f:
+            json.dump(dict(job_id='aaa', session_id='bbb', status=status,
+                           full_report_dict=dict(action=action, progressing=True)), f)
+        os.utime(fn, (mtime, mtime))
+
+    def updated_monitor(**kwargs):
+        job = OsaJob('empty-async', work_dir, None, 'localhost', 8000, 'call_back', job_id='aaa', session_id='bbb')
+        return job.updated_dataserver_monitor(**kwargs)
+
+    t0 = time.time() - 100
+    for i in range(5):
+        write_job_file(f'job_monitor_node_{i}_progressing_.json', 'progress', 'progress', t0 + i)
+
+    job_monitor = updated_monitor()
+    assert job_monitor['status'] == 'progress'
+    assert [d['action'] for d in job_monitor['full_report_dict_list']] == ['progress'] * 5
+
+    summary = json.load(open(os.path.join(work_dir, job_monitor_summary_file_name)))
+    assert len(summary['job_files']) == 5
+
+    # only the new and the rewritten files are read again, the others are taken from the summary
+    cached_fn = os.path.join(work_dir, 'job_monitor_node_0_progressing_.json')
+    cached_stat = os.stat(cached_fn)
+    with open(cached_fn, 'w') as f:
+        f.write('not read')
+    os.truncate(cached_fn, cached_stat.st_size)
+    os.utime(cached_fn, ns=(cached_stat.st_atime_ns, cached_stat.st_mtime_ns))
+
+    write_job_file('job_monitor_node_1_progressing_.json', 'progress', 'main_done', t0 + 10)
+    write_job_file('job_monitor_node_5_progressing_.json', 'done', 'done', t0 + 20)
+
+    job_monitor = updated_monitor()
+    assert job_monitor['status'] == 'done'
+    assert [d['action'] for d in job_monitor['full_report_dict_list']] == \
+           ['progress'] * 4 + ['main_done', 'done']
+
+    job_monitor = updated_monitor(include_full_report_dict_list=False)
+    assert job_monitor['status'] == 'done'
+    assert 'full_report_dict_list' not in job_monitor
+
+    # a file which can not be read makes the monitor unaccessible, until a later one is written
+    with open(os.path.join(work_dir, 'job_monitor_node_6_progressing_.json'), 'w') as f:
+        f.write('{')
+    os.utime(os.path.join(work_dir, 'job_monitor_node_6_progressing_.json'), (t0 + 30, t0 + 30))
+    os.remove(os.path.join(work_dir, 'job_monitor_node_5_progressing_.json'))
+
+    job_monitor = updated_monitor()
+    assert job_monitor['status'] == 'progress'
+    assert len(job_monitor['full_report_dict_list']) == 5
+    assert len(json.load(open(os.path.join(work_dir, job_monitor_summary_file_name)))['job_files']) == 6
+
+    # the summary stored by several threads at once stays readable, without leftover temporary files
+    import threading
+
+    def write_and_update(i):
+        write_job_file(f'job_monitor_node_{i}_progressing_.json', 'progress', 'progress', t0 + i)
+        updated_monitor()
+
+    threads = [threading.Thread(target=write_and_update, args=(i,)) for i in range(40, 56)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    updated_monitor()
+    assert len(json.load(open(os.path.join(work_dir, job_monitor_summary_file_name)))['job_files']) == 22
+    assert glob.glob(os.path.join(work_dir, '*.tmp')) == []
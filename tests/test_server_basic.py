@@ -20,9 +20,11 @@ from urllib import parse
 from urllib.parse import urlencode, urlparse, parse_qs, urlunparse
 import yaml
 import gzip
+import tarfile
 import random
 import string
 
+from cdci_data_analysis.analysis import ownership_registry
 from cdci_data_analysis.analysis.catalog import BasicCatalog
 from cdci_data_analysis.pytest_fixtures import DispatcherJobState, ask, make_hash, dispatcher_fetch_dummy_products, make_hash_file
 from cdci_data_analysis.flask_app.dispatcher_query import InstrumentQueryBackEnd
@@ -90,6 +92,152 @@ def test_sanitize_dict_before_log():
     sanitized_dict = sanitize_dict_before_log(test_dict)
     assert sanitized_dict == expected_dict
 
+@pytest.mark.fast
+@pytest.mark.parametrize("framing", ['json', 'json_lines'])
+def test_logstash_shipper(framing):
+    import socket
+    import threading
+    from cdci_data_analysis.analysis import request_counters
+    from cdci_data_analysis.flask_app.logstash import LogstashShipper
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+    connections = []
+    received = []
+
+    def receive():
+        while True:
+            try:
+                connection, _ = server_socket.accept()
+            except OSError:
+                return
+            connections.append(connection)
+            with connection, connection.makefile('rb') as f:
+                if framing == 'json_lines':
+                    for line in f:
+                        received.append(json.loads(line))
+                else:
+                    received.append(json.loads(f.read()))
+
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+
+    counters = request_counters.get_counters()
+    shipper = LogstashShipper('127.0.0.1', server_socket.getsockname()[1], queue_max_size=3, batch_max_size=2,
+                              framing=framing)
+
+    # the oldest events are dropped when the queue is full
+    for i in range(5):
+        shipper.enqueue({'origin': 'test', 'event': i, 'request-data': {'args': {'a': [1, 2]}}})
+    new_counters = request_counters.get_counters()
+    assert new_counters.get('logstash_events_dropped', 0) == counters.get('logstash_events_dropped', 0) + 2
+
+    shipper.start()
+    # once the queued events are sent, not to drop any other
+    t0 = time.time()
+    while request_counters.get_counters().get('logstash_events_sent', 0) < \
+            counters.get('logstash_events_sent', 0) + 3 and time.time() - t0 < 10:
+        time.sleep(0.01)
+    shipper.enqueue(json.dumps({'origin': 'test', 'event': 5}))
+    shipper.stop(timeout=10)
+
+    t0 = time.time()
+    while len(received) < 4 and time.time() - t0 < 10:
+        time.sleep(0.1)
+
+    assert [event['event'] for event in received] == [2, 3, 4, 5]
+    assert received[0]['request-data.args.a.1'] == 2
+    # over a single connection, or one per event
+    assert len(connections) == (1 if framing == 'json_lines' else 4)
+    counters, new_counters = new_counters, request_counters.get_counters()
+    assert new_counters['logstash_events_sent'] == counters.get('logstash_events_sent', 0) + 4
+
+    server_socket.close()
+
+
+@pytest.fixture
+def app_with_logstash(app, dispatcher_test_conf_fn):
+    import socket
+    from cdci_data_analysis.configurer import ConfigEnv
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen()
+
+    conf = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+    conf.logstash_host = '127.0.0.1'
+    conf.logstash_port = server_socket.getsockname()[1]
+    conf.logstash_framing = 'json_lines'
+
+    previous_conf = app.config.get('conf')
+    app.config['conf'] = conf
+    yield app, server_socket
+    app.config['conf'] = previous_conf
+    server_socket.close()
+
+
+@pytest.mark.fast
+def test_log_run_query_summaries(app_with_logstash):
+    from flask import jsonify
+    from cdci_data_analysis.flask_app.app import log_run_query_request, log_run_query_result
+
+    app, server_socket = app_with_logstash
+
+    with app.test_request_context('/run_analysis?instrument=empty&query_status=new',
+                                  headers={'X-Forwarded-For': '1.2.3.4, 5.6.7.8'}):
+        request_summary = log_run_query_request()
+        result_summary = {'exit_status': {'status': 0, 'message': ''}, 'job_status': 'done'}
+        result = jsonify({**result_summary, 'products': {'data': 'x' * 1000}})
+        assert log_run_query_result(request_summary, result, result_summary=result_summary) is result
+
+    connection, _ = server_socket.accept()
+    with connection, connection.makefile('rb') as f:
+        request_event = json.loads(f.readline())
+        result_event = json.loads(f.readline())
+
+    assert request_event['origin'] == 'dispatcher-run-analysis'
+    assert request_event['request-data']['args'] == {'instrument': 'empty', 'query_status': 'new'}
+    assert request_event['clientip'] == '1.2.3.4'
+    assert 'dispatcher-state' not in request_event
+    assert result_event == {**request_event,
+                            'dispatcher-state': 'returning',
+                            'return_exit_status': result_summary['exit_status'],
+                            'return_job_status': 'done'}
+
+
+@pytest.mark.benchmark
+def test_log_run_query_summaries_benchmark(app_with_logstash):
+    from flask import jsonify
+    from cdci_data_analysis.flask_app.app import log_run_query_request, log_run_query_result
+
+    app, server_socket = app_with_logstash
+
+    n_requests = 200
+    result_summary = {'exit_status': {'status': 0, 'message': ''}, 'job_status': 'done'}
+    timings = {}
+    for response_size in [1000, 10 * 1000 * 1000]:
+        with app.test_request_context('/run_analysis?instrument=empty&query_status=new'):
+            result = jsonify({**result_summary, 'products': {'data': 'x' * response_size}})
+            t0 = time.perf_counter()
+            for i in range(n_requests):
+                request_summary = log_run_query_request()
+                log_run_query_result(request_summary, result, result_summary=result_summary)
+            timings[response_size] = (time.perf_counter() - t0) / n_requests
+
+        # as done before, parsing the response
+        t0 = time.perf_counter()
+        json.loads(result.data)
+        parsing_time = time.perf_counter() - t0
+
+        logger.info("logging of a request with a response of %s bytes: %.3g ms, parsing the response: %.3g ms",
+                    response_size, timings[response_size] * 1e3, parsing_time * 1e3)
+
+    # the overhead does not grow with the size of the response: parsing it takes about 20 ms,
+    # while logging takes about 0.2 ms for both sizes when measured
+    assert timings[10 * 1000 * 1000] < 10 * timings[1000] + 5e-3
+
+
 @pytest.mark.fast
 @pytest.mark.xfail
 def test_js9(dispatcher_live_fixture):
@@ -354,6 +502,8 @@ def test_scratch_dir_creation_lock_error(dispatcher_live_fixture):
     params['session_id'] = session_id
 
     lock_file = f".lock_{job_id}"
+    # the lock file is removed when the lock is released
+    assert not os.path.exists(lock_file)
 
     with open(lock_file, 'w') as f_lock:
         fcntl.flock(f_lock, fcntl.LOCK_EX)
@@ -363,13 +513,21 @@ def test_scratch_dir_creation_lock_error(dispatcher_live_fixture):
                     expected_status_code=500,
                     expected_query_status=None,
                     )
-    scratch_dir_retry_attempts = 6
+    scratch_dir_lock_timeout_s = 5
     wd = f"scratch_sid_{session_id}_jid_{job_id}"
-    assert jdata['error'] == f"InternalError():Failed to acquire lock for directory \"{wd}\" creation after {scratch_dir_retry_attempts} attempts."
-    assert jdata['error_message'] == f"Failed to acquire lock for directory \"{wd}\" creation after {scratch_dir_retry_attempts} attempts."
+    assert jdata['error'] == f"InternalError():Failed to acquire lock for directory \"{wd}\" creation within {scratch_dir_lock_timeout_s} seconds."
+    assert jdata['error_message'] == f"Failed to acquire lock for directory \"{wd}\" creation within {scratch_dir_lock_timeout_s} seconds."
     os.rmdir(fake_scratch_dir)
     os.remove(lock_file)
 
+    c = requests.get(server + "/request-counters")
+    assert c.status_code == 200
+    assert c.json()['counters']['scratch_dir_lock_timeouts'] >= 1
+    assert isinstance(c.json()['gallery_endpoints'], dict)
+    job_contention = c.json()['scratch_dir_lock_contention'][job_id]
+    assert job_contention['n_timeouts'] == 1
+    assert job_contention['max_wait_s'] >= scratch_dir_lock_timeout_s
+
 
 @pytest.mark.fast
 def test_same_request_different_users(dispatcher_live_fixture):
@@ -578,6 +736,188 @@ def test_download_products_public(dispatcher_long_living_fixture, empty_products
     assert data_downloaded == empty_products_files_fixture['content']
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize('return_archive', [True, False])
+def test_download_products_streaming(dispatcher_live_fixture_with_download_streaming, empty_products_files_fixture, return_archive):
+    server = dispatcher_live_fixture_with_download_streaming
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz',
+        'download_file_name': 'output_test',
+        'return_archive': return_archive,
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    assert 'attachment' in c.headers['Content-Disposition']
+    if return_archive:
+        # the archive is sent while being generated
+        assert 'Content-Length' not in c.headers
+        assert gzip.decompress(c.content) == empty_products_files_fixture['content']
+    else:
+        assert c.content == empty_products_files_fixture['content']
+
+        c = requests.get(server + "/download_products", params=params, headers={'Range': 'bytes=5-9'})
+        assert c.status_code == 206
+        assert c.content == empty_products_files_fixture['content'][5:10]
+
+    with open(os.path.join(scratch_dir_path, 'test_2.fits'), 'wb') as fout:
+        content_2 = os.urandom(3 * 1024 * 1024)
+        fout.write(content_2)
+
+    params['file_list'] = 'test.fits.gz,test_2.fits'
+    params['download_file_name'] = 'output_test.tar.gz'
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+
+    with tarfile.open(fileobj=io.BytesIO(c.content), mode='r:gz') as tar:
+        assert tar.getnames() == ['output_test/test.fits.gz', 'output_test/test_2.fits']
+        assert tar.extractfile('output_test/test.fits.gz').read() == empty_products_files_fixture['content']
+        assert tar.extractfile('output_test/test_2.fits').read() == content_2
+
+    assert glob.glob('download_*') == []
+
+
+@pytest.mark.fast
+def test_download_products_cache(dispatcher_live_fixture, empty_products_files_fixture):
+    from cdci_data_analysis.analysis.download_cache import DownloadCache
+
+    server = dispatcher_live_fixture
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+
+    with open(os.path.join(scratch_dir_path, 'test_2.fits'), 'wb') as fout:
+        fout.write(os.urandom(20))
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz,test_2.fits',
+        'download_file_name': 'output_test.tar.gz',
+        'session_id': session_id,
+        'job_id': job_id
+    }
+
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+    content = c.content
+    with tarfile.open(fileobj=io.BytesIO(content), mode='r:gz') as tar:
+        assert tar.extractfile('output_test/test.fits.gz').read() == empty_products_files_fixture['content']
+
+    cache_entries = [entry for entry in DownloadCache().entries() if entry.job_id == job_id]
+    assert len(cache_entries) == 1
+    assert glob.glob('download_*') == []
+
+    # the same archive is served from the cache
+    c = requests.get(server + "/download_products", params=params)
+    assert c.status_code == 200
+    assert c.headers['ETag'] == etag
+    assert c.content == content
+
+    c = requests.get(server + "/download_products", params=params, headers={'If-None-Match': etag})
+    assert c.status_code == 304
+
+    # any change of the files gives a new archive
+    with open(os.path.join(scratch_dir_path, 'test_2.fits'), 'ab') as fout:
+        fout.write(os.urandom(20))
+
+    c = requests.get(server + "/download_products", params=params, headers={'If-None-Match': etag})
+    assert c.status_code == 200
+    assert c.headers['ETag'] != etag
+    assert len([entry for entry in DownloadCache().entries() if entry.job_id == job_id]) == 2
+
+
+def test_download_products_cache_evicted(app, dispatcher_test_conf_fn, empty_products_files_fixture, monkeypatch):
+    from cdci_data_analysis.configurer import ConfigEnv
+    from cdci_data_analysis.analysis.download_cache import DownloadCache
+
+    session_id = empty_products_files_fixture['session_id']
+    job_id = empty_products_files_fixture['job_id']
+    scratch_dir_path = f'scratch_sid_{session_id}_jid_{job_id}'
+    with open(os.path.join(scratch_dir_path, 'test_2.fits'), 'wb') as fout:
+        fout.write(os.urandom(20))
+
+    # the archive is evicted by another process once found in the cache, before being sent
+    evicted_paths = []
+    cache_get = DownloadCache.get
+
+    def evicting_get(self, key):
+        path = cache_get(self, key)
+        if path is not None and len(evicted_paths) == 0:
+            os.remove(path)
+            evicted_paths.append(path)
+        return path
+
+    params = {
+        'query_status': 'ready',
+        'file_list': 'test.fits.gz,test_2.fits',
+        'download_file_name': 'output_test.tar.gz',
+        'session_id': session_id,
+        'job_id': job_id
+    }
+    previous_conf = app.config.get('conf')
+    app.config['conf'] = ConfigEnv.from_conf_file(dispatcher_test_conf_fn)
+    try:
+        with app.test_client() as client:
+            c = client.get('/download_products', query_string=params)
+            assert c.status_code == 200
+
+            monkeypatch.setattr(DownloadCache, 'get', evicting_get)
+            c = client.get('/download_products', query_string=params)
+            assert c.status_code == 200
+            with tarfile.open(fileobj=io.BytesIO(c.data), mode='r:gz') as tar:
+                assert tar.extractfile('output_test/test.fits.gz').read() == empty_products_files_fixture['content']
+            c.close()
+    finally:
+        app.config['conf'] = previous_conf
+
+    assert len(evicted_paths) == 1
+    assert os.path.exists(evicted_paths[0])
+
+
+def test_download_cache_eviction(tmpdir):
+    from cdci_data_analysis.analysis.download_cache import DownloadCache, make_download_cache_key
+
+    cache = DownloadCache(os.path.join(tmpdir, 'cache'), max_size=250)
+    file_path = os.path.join(tmpdir, 'test.fits')
+    with open(file_path, 'wb') as fout:
+        fout.write(os.urandom(20))
+
+    keys = []
+    for i in range(3):
+        key = make_download_cache_key(f'{i:016x}', [file_path], ['gz', f'output_{i}', 9])
+        assert cache.get(key) is None
+        archive_path = os.path.join(tmpdir, f'archive_{i}')
+        with open(archive_path, 'wb') as fout:
+            fout.write(os.urandom(100))
+        cache_path = cache.put(key, archive_path)
+        assert not os.path.exists(archive_path)
+        os.utime(cache_path, (time.time() + i, time.time() + i))
+        keys.append(key)
+
+    # the least recently used archive is removed to keep the cache within its maximum size
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) is not None
+    assert cache.get(keys[2]) is not None
+
+    assert make_download_cache_key('0' * 16, [file_path], ['gz', 'output_0', 9]) == \
+           make_download_cache_key('0' * 16, [file_path], ['gz', 'output_0', 9])
+    assert make_download_cache_key('0' * 16, [file_path], ['gz', 'output_0', 1]) != \
+           make_download_cache_key('0' * 16, [file_path], ['gz', 'output_0', 9])
+
+    assert [entry.key for entry in cache.remove_entries(job_ids={f'{1:016x}'})] == [keys[1]]
+    assert [entry.key for entry in cache.entries()] == [keys[2]]
+
+
 @pytest.mark.fast
 def test_head_download_products_public(dispatcher_long_living_fixture, empty_products_files_fixture):
     server = dispatcher_long_living_fixture
@@ -668,6 +1008,60 @@ def test_download_products_aliased_dir(dispatcher_live_fixture):
                      })
     assert d.status_code == 200
 
+def test_request_temp_dir(dispatcher_live_fixture):
+    DispatcherJobState.remove_scratch_folders()
+    server = dispatcher_live_fixture
+
+    logger.info("constructed server: %s", server)
+
+    def get_counters():
+        c = requests.get(server + "/request-counters")
+        assert c.status_code == 200
+        return c.json()['counters']
+
+    params = {
+        **default_params,
+        'product_type': 'dummy',
+        'query_type': "Real",
+        'instrument': 'empty-async',
+        'p': 5.,
+    }
+
+    DataServerQuery.set_status('submitted')
+
+    counters = get_counters()
+    # no file uploaded, no temporary directory
+    jdata = ask(server,
+                params,
+                expected_query_status='submitted',
+                expected_job_status=['submitted'],
+                expected_status_code=200,
+                max_time_s=150,
+                method='get')
+    new_counters = get_counters()
+    assert new_counters.get('temp_dir_avoided', 0) == counters.get('temp_dir_avoided', 0) + 1
+    assert new_counters.get('temp_dir_created', 0) == counters.get('temp_dir_created', 0)
+
+    file_path = DispatcherJobState.create_p_value_file(p_value=6)
+    with open(file_path) as list_file:
+        jdata = ask(server,
+                    {**params, 'use_scws': 'user_file', 'p': 6.},
+                    expected_query_status='submitted',
+                    expected_job_status=['submitted'],
+                    expected_status_code=200,
+                    max_time_s=150,
+                    method='post',
+                    files={'user_scw_list_file': list_file.read()})
+    counters, new_counters = new_counters, get_counters()
+    assert new_counters.get('temp_dir_avoided', 0) == counters.get('temp_dir_avoided', 0)
+    assert new_counters.get('temp_dir_created', 0) == counters.get('temp_dir_created', 0) + 1
+
+    # the uploaded file is moved to the scratch_dir, and the temporary directory removed
+    scratch_dir = f'scratch_sid_{jdata["session_id"]}_jid_{jdata["job_monitor"]["job_id"]}'
+    assert os.path.exists(os.path.join(scratch_dir, 'user_scw_list_file'))
+    assert glob.glob(os.path.join(scratch_dir, 'tmp*')) == []
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize('filelist', ['../external_file', '/tmp/external_file', 'test.fits.gz'])
 @pytest.mark.parametrize('outname', ['/tmp/output_test', '../output_test', 'output_test'])
@@ -1036,6 +1430,78 @@ def test_instrument_list_redirection(dispatcher_live_fixture, allow_redirect):
         assert c.status_code == 200
 
 
+def test_gallery_client_retries(monkeypatch):
+    from cdci_data_analysis.analysis.drupal_helper import GalleryClient
+    from cdci_data_analysis.analysis.exceptions import InternalError
+
+    gallery_client = GalleryClient(n_max_tries=3, retry_sleep_s=0.01, max_retry_sleep_s=0.02)
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+
+    responses = [requests.exceptions.ConnectionError('connection refused'), 200]
+
+    def mock_get(url, params=None, headers=None, timeout=None):
+        assert params['_format'] == 'hal_json'
+        assert timeout == gallery_client.timeout
+        r = responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        res = requests.Response()
+        res.status_code = r
+        return res
+
+    monkeypatch.setattr(gallery_client.session, 'get', mock_get)
+
+    res = gallery_client.execute_request('http://localhost/mmoda/galleryd/users/mtm@mtmco.net/id')
+    assert res.status_code == 200
+    assert len(sleeps) == 1
+    assert 0 <= sleeps[0] <= 0.01
+
+    metrics = gallery_client.get_metrics()
+    assert list(metrics) == ['GET /mmoda/galleryd/users/{id}/id']
+    endpoint_metrics = metrics['GET /mmoda/galleryd/users/{id}/id']
+    assert endpoint_metrics['n_requests'] == 2
+    assert endpoint_metrics['n_successful_requests'] == 1
+    assert endpoint_metrics['n_retries'] == 1
+    assert gallery_client.average_retries == 1
+
+    # the backoff is increasing up to its maximum
+    assert gallery_client.get_retry_sleep_s(10) <= 0.02
+
+    responses = [requests.exceptions.Timeout('timeout')] * 3
+    with pytest.raises(InternalError):
+        gallery_client.execute_request('http://localhost/mmoda/galleryd/users/mtm@mtmco.net/id')
+    assert gallery_client.get_metrics()['GET /mmoda/galleryd/users/{id}/id']['n_failed_requests'] == 1
+
+
+def test_gallery_endpoint_metrics_threads():
+    import threading
+    from cdci_data_analysis.analysis.drupal_helper import GalleryEndpointMetrics
+
+    metrics = GalleryEndpointMetrics()
+    n_threads = 8
+    n_updates = 2000
+
+    def update():
+        for i in range(n_updates):
+            metrics.add_request(0.001, successful=i % 2 == 0)
+            metrics.add_retry()
+            metrics.add_failure()
+
+    threads = [threading.Thread(target=update) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    metrics_dict = metrics.as_dict()
+    assert metrics_dict['n_requests'] == n_threads * n_updates
+    assert metrics_dict['n_successful_requests'] == n_threads * n_updates // 2
+    assert metrics_dict['n_retries'] == n_threads * n_updates
+    assert metrics_dict['n_failed_requests'] == n_threads * n_updates
+    assert metrics.average_retries == 2
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize("endpoint_url", ["instr-list", "api/instr-list"])
 def test_per_user_instrument_list(dispatcher_live_fixture, endpoint_url):
@@ -1087,6 +1553,182 @@ def test_per_user_instrument_list(dispatcher_live_fixture, endpoint_url):
     assert not 'empty-development' in jdata
 
 
+def test_instrument_factory_index():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument, empty_development_instrument
+
+    n_built_instruments = 0
+
+    def counting_factory(factory):
+        def _factory():
+            nonlocal n_built_instruments
+            n_built_instruments += 1
+            return factory()
+        return _factory
+
+    instr_factory_iter = InstrumentFactoryIterator()
+    instr_factory_iter.extend([counting_factory(empty_instrument.my_instr_factory)])
+    instr_factory_iter.extend([counting_factory(empty_development_instrument.my_instr_factory)])
+
+    assert instr_factory_iter.instrument_names == ['empty', 'empty-development']
+    # factories without instr_name are built only once, to index them
+    assert n_built_instruments == 2
+
+    for i in range(3):
+        assert instr_factory_iter.get_entry('empty').name == 'empty'
+        assert instr_factory_iter.get_accessible_instrument_names() == ['empty']
+        assert instr_factory_iter.get_accessible_instrument_names(['general']) == ['empty']
+        assert instr_factory_iter.get_accessible_instrument_names(['oda workflow developer']) == ['empty', 'empty-development']
+    assert instr_factory_iter.get_entry('unknown') is None
+    assert n_built_instruments == 2
+
+    # the index follows the lists of factories exposed by the plugins
+    instr_factory_iter.extend([])
+    instr_factory_iter.extend([empty_instrument.my_instr_factory])
+    assert instr_factory_iter.instrument_names == ['empty', 'empty-development', 'empty']
+
+
+def test_instrument_prototype_pool():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    instr_factory_iter = InstrumentFactoryIterator()
+    instr_factory_iter.extend([empty_instrument.my_instr_factory])
+
+    instrument_1 = instr_factory_iter.get_instrument('empty')
+    instrument_2 = instr_factory_iter.get_instrument('empty')
+    assert instrument_1 is not instrument_2
+
+    instrument_1.set_pars_from_dic({'instrument': 'empty', 'product_type': 'numerical', 'p': 5, 'RA': 10})
+
+    # the values are set only in the copy used by the request
+    assert instrument_1.get_query_by_name('numerical_parameters_dummy_query').get_par_by_name('p').value == 5
+    assert instrument_1.get_query_by_name('file_parameters_dummy_query').get_par_by_name('p').value == 5
+    assert instrument_1.src_query.get_par_by_name('RA').value == 10
+    for instrument in [instrument_2, instr_factory_iter.get_instrument('empty')]:
+        assert instrument.get_query_by_name('numerical_parameters_dummy_query').get_par_by_name('p').value == 10
+        assert instrument.src_query.get_par_by_name('RA').value == pytest.approx(265.97845833)
+
+    # the parameters shared between the queries are still shared in the copy
+    assert instrument_1.get_query_by_name('numerical_parameters_dummy_query').get_par_by_name('p') is \
+        instrument_1.get_query_by_name('file_parameters_dummy_query').get_par_by_name('p')
+
+    assert type(instr_factory_iter.get_instrument('empty', use_prototype=False)) is type(instrument_1)
+    assert instr_factory_iter.get_instrument('unknown') is None
+
+    # the instruments of the factories not declaring the pool are built for each request
+    n_built = []
+
+    def my_instr_factory():
+        n_built.append(1)
+        instrument = empty_instrument.my_instr_factory()
+        instrument.name = 'empty-not-pooled'
+        instrument.request_state = {}
+        return instrument
+
+    instr_factory_iter.extend([my_instr_factory])
+    instrument_1 = instr_factory_iter.get_instrument('empty-not-pooled')
+    instrument_2 = instr_factory_iter.get_instrument('empty-not-pooled')
+    assert instrument_1.request_state is not instrument_2.request_state
+    assert len(n_built) == 3
+
+
+@pytest.mark.benchmark
+def test_instrument_prototype_pool_benchmark():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin import (empty_instrument,
+                                                         empty_async_instrument,
+                                                         empty_semi_async_instrument,
+                                                         empty_development_instrument)
+
+    instr_factory_iter = InstrumentFactoryIterator()
+    instr_factory_iter.extend([empty_instrument.my_instr_factory,
+                               empty_async_instrument.my_instr_factory,
+                               empty_semi_async_instrument.my_instr_factory,
+                               empty_development_instrument.my_instr_factory])
+
+    n_requests = 100
+    total_timings = {False: 0., True: 0.}
+    for instrument_name in instr_factory_iter.instrument_names:
+        timings = {}
+        for use_prototype in [False, True]:
+            instr_factory_iter.get_instrument(instrument_name, use_prototype=use_prototype)
+            t0 = time.perf_counter()
+            for i in range(n_requests):
+                instr_factory_iter.get_instrument(instrument_name, use_prototype=use_prototype)
+            timings[use_prototype] = (time.perf_counter() - t0) / n_requests
+            total_timings[use_prototype] += timings[use_prototype]
+
+        logger.info("instrument %s setup per request: %.3g ms with the factory, %.3g ms with the prototype pool",
+                    instrument_name, timings[False] * 1e3, timings[True] * 1e3)
+
+    # about ten times faster when measured
+    assert total_timings[True] < total_timings[False]
+
+
+def test_instrument_set_pars_plan():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin import empty_instrument
+
+    instr_factory_iter = InstrumentFactoryIterator()
+    instr_factory_iter.extend([empty_instrument.my_instr_factory])
+
+    instrument_1 = instr_factory_iter.get_instrument('empty')
+    updated_arg_dic = instrument_1.set_pars_from_dic({'instrument': 'empty',
+                                                      'product_type': 'numerical',
+                                                      'p': 5,
+                                                      'unknown_arg': 1})
+    assert updated_arg_dic['p'] == 5
+    assert updated_arg_dic['T_format'] == 'isot'
+    assert 'unknown_arg' not in updated_arg_dic
+    assert instrument_1.unknown_arguments_name_list == ['unknown_arg']
+
+    plan = instrument_1.get_set_pars_plan('numerical')
+    assert 'p' in plan.known_argument_names
+    assert 'instrument' in plan.known_argument_names
+
+    # the plan is compiled once, and used by the copies of the instrument with their own parameters
+    instrument_2 = instr_factory_iter.get_instrument('empty')
+    assert instrument_2.get_set_pars_plan('numerical') is plan
+    updated_arg_dic = instrument_2.set_pars_from_dic({'instrument': 'empty', 'product_type': 'numerical', 'p': 7})
+    assert updated_arg_dic['p'] == 7
+    assert instrument_2.get_query_by_name('numerical_parameters_dummy_query').get_par_by_name('p').value == 7
+    assert instrument_1.get_query_by_name('numerical_parameters_dummy_query').get_par_by_name('p').value == 5
+
+
+@pytest.mark.benchmark
+def test_instrument_set_pars_plan_benchmark():
+    from cdci_data_analysis.analysis.instrument import InstrumentFactoryIterator
+    from cdci_data_analysis.plugins.dummy_plugin import (empty_instrument,
+                                                         empty_async_instrument,
+                                                         empty_semi_async_instrument,
+                                                         empty_development_instrument)
+
+    instr_factory_iter = InstrumentFactoryIterator()
+    instr_factory_iter.extend([empty_instrument.my_instr_factory,
+                               empty_async_instrument.my_instr_factory,
+                               empty_semi_async_instrument.my_instr_factory,
+                               empty_development_instrument.my_instr_factory])
+
+    n_requests = 100
+    for instrument_name in instr_factory_iter.instrument_names:
+        instrument = instr_factory_iter.get_instrument(instrument_name)
+        for product_type in instrument.query_dictionary:
+            arg_dic = {'instrument': instrument_name, 'product_type': product_type}
+            timings = {}
+            for use_plan in [False, True]:
+                instrument.set_pars_from_dic(arg_dic)
+                t0 = time.perf_counter()
+                for i in range(n_requests):
+                    if not use_plan:
+                        instrument._set_pars_plans.clear()
+                    instrument.set_pars_from_dic(arg_dic)
+                timings[use_plan] = (time.perf_counter() - t0) / n_requests
+
+            logger.info("instrument %s product %s set_pars_from_dic: %.3g ms compiling the plan, %.3g ms with the compiled plan",
+                        instrument_name, product_type, timings[False] * 1e3, timings[True] * 1e3)
+
+
 @pytest.mark.fast
 @pytest.mark.parametrize("endpoint_url", ["instr-list", "api/instr-list"])
 def test_per_user_instrument_list_no_custom_products_url(dispatcher_live_fixture, endpoint_url):
@@ -1381,6 +2023,59 @@ def test_invalid_token(dispatcher_live_fixture):
     assert number_scartch_dirs == len(dir_list)
 
 
+@pytest.mark.fast
+def test_verified_token_cache(dispatcher_live_fixture):
+    from cdci_data_analysis.analysis import tokenHelper
+
+    server = dispatcher_live_fixture
+    logger.info("constructed server: %s", server)
+
+    def get_counters():
+        c = requests.get(server + "/request-counters")
+        assert c.status_code == 200
+        return c.json()['counters']
+
+    # a new token, verified once by the request
+    encoded_token = jwt.encode({**default_token_payload, 'nonce': uuid.uuid4().hex}, secret_key, algorithm='HS256')
+    params = {
+        **default_params,
+        'product_type': 'dummy',
+        'query_type': "Dummy",
+        'instrument': 'empty',
+        'token': encoded_token
+    }
+
+    counters = get_counters()
+    ask(server, params, expected_query_status=["done"], max_time_s=50)
+    new_counters = get_counters()
+    assert new_counters.get('token_verifications', 0) == counters.get('token_verifications', 0) + 1
+
+    ask(server, params, expected_query_status=["done"], max_time_s=50)
+    counters, new_counters = new_counters, get_counters()
+    assert new_counters.get('token_verifications', 0) == counters.get('token_verifications', 0)
+    assert new_counters['token_verification_cache_hits'] > counters.get('token_verification_cache_hits', 0)
+
+    # the cached payloads are copied, verified with their secret key, and expire
+    token_payload = {**default_token_payload, 'exp': int(time.time()) + 2}
+    encoded_token = jwt.encode(token_payload, secret_key, algorithm='HS256')
+    decoded_token = tokenHelper.get_decoded_token(encoded_token, secret_key)
+    assert decoded_token == token_payload
+    decoded_token['roles'] = 'space manager'
+    assert tokenHelper.get_decoded_token(encoded_token, secret_key) == token_payload
+
+    with pytest.raises(jwt.exceptions.InvalidSignatureError):
+        tokenHelper.get_decoded_token(encoded_token, 'another_secret_key')
+
+    time.sleep(2)
+    with pytest.raises(jwt.exceptions.ExpiredSignatureError):
+        tokenHelper.get_decoded_token(encoded_token, secret_key)
+
+    # the claims can still be inspected
+    assert tokenHelper.get_decoded_token(encoded_token, secret_key=None, validate_token=False) == token_payload
+    with pytest.raises(jwt.exceptions.DecodeError):
+        tokenHelper.get_decoded_token('not.a-token', secret_key=None, validate_token=False)
+
+
 @pytest.mark.fast
 def test_call_back_invalid_token(dispatcher_live_fixture):
     server = dispatcher_live_fixture
@@ -1893,15 +2588,17 @@ def test_file_ownerships(dispatcher_live_fixture):
     first_file_hash = make_hash_file(p_file_path_first)
     second_file_hash = make_hash_file(p_file_path_second)
 
-    first_ownership_file_path = os.path.join('request_files', first_file_hash + '_ownerships.json')
-    second_ownership_file_path = os.path.join('request_files', second_file_hash + '_ownerships.json')
-    assert os.path.exists(first_ownership_file_path)
-    assert os.path.exists(second_ownership_file_path)
+    assert os.path.exists(os.path.join('request_files', first_file_hash))
+    assert os.path.exists(os.path.join('request_files', second_file_hash))
+    assert not os.path.exists(os.path.join('request_files', first_file_hash + '_ownerships.json'))
+    # the uploaded files are stored with the mode given by the umask, not only readable by the dispatcher
+    umask = os.umask(0o022)
+    os.umask(umask)
+    assert os.stat(os.path.join('request_files', first_file_hash)).st_mode & 0o777 == 0o666 & ~umask
 
-    with open(first_ownership_file_path) as first_ownership_file:
-        first_ownerships = json.load(first_ownership_file)
-    with open(second_ownership_file_path) as second_ownership_file:
-        second_ownerships = json.load(second_ownership_file)
+    registry = ownership_registry.get_ownership_registry('request_files')
+    first_ownerships = registry.get_ownerships(first_file_hash)
+    second_ownerships = registry.get_ownerships(second_file_hash)
 
     assert token_payload['sub'] in first_ownerships['user_emails']
     assert token_payload['sub'] in second_ownerships['user_emails']
@@ -1932,8 +2629,10 @@ def test_file_ownerships(dispatcher_live_fixture):
 
     list_file_first.close()
 
-    with open(first_ownership_file_path) as first_ownership_file:
-        first_ownerships = json.load(first_ownership_file)
+    # the same content is stored once
+    assert len([f for f in os.listdir('request_files') if not f.startswith('.')]) == 2
+
+    first_ownerships = registry.get_ownerships(first_file_hash)
 
     assert token_payload['sub'] in first_ownerships['user_emails']
     token_roles = [r.strip() for r in token_payload['roles'].split(',')]
@@ -1974,13 +2673,35 @@ def test_public_file_ownerships(dispatcher_live_fixture):
     list_file.close()
     file_hash = make_hash_file(p_file_path)
 
-    ownership_file_path = os.path.join('request_files', file_hash + '_ownerships.json')
-    assert os.path.exists(ownership_file_path)
-    with open(ownership_file_path) as ownership_file:
-        ownerships = json.load(ownership_file)
+    ownerships = ownership_registry.get_ownership_registry('request_files').get_ownerships(file_hash)
+    assert ownerships['user_emails'] == ['public']
     assert ownerships['user_roles'] == []
 
 
+@pytest.mark.fast
+@pytest.mark.parametrize("first_access", ['get', 'add'])
+def test_legacy_file_ownerships(tmpdir, first_access):
+    registry = ownership_registry.OwnershipRegistry(str(tmpdir))
+    file_hash = make_hash(dict(content='legacy'))
+
+    # the ownership file of the previous layout
+    with open(os.path.join(tmpdir, file_hash + '_ownerships.json'), 'w') as ownership_file:
+        json.dump(dict(user_emails=['first@odahub.io'], user_roles=['role_1']), ownership_file)
+
+    if first_access == 'get':
+        assert registry.get_ownerships(file_hash) == dict(user_emails=['first@odahub.io'], user_roles=['role_1'])
+
+    # the same content uploaded by another user keeps the previous owners
+    registry.add_ownerships(file_hash, 'second@odahub.io', ['role_2'])
+
+    assert registry.get_ownerships(file_hash) == dict(user_emails=['first@odahub.io', 'second@odahub.io'],
+                                                      user_roles=['role_1', 'role_2'])
+    assert registry.get_ownerships(make_hash(dict(content='other'))) is None
+    # no write-ahead log, the request files directory can be on a network filesystem
+    assert registry._connection().execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+    assert not os.path.exists(registry.db_path + '-wal')
+
+
 @pytest.mark.parametrize("include_file_arg", [True, False])
 def test_default_value_empty_posix_path(dispatcher_live_fixture, include_file_arg):
     DispatcherJobState.remove_scratch_folders()
@@ -1,8 +1,11 @@
+import io
 import os.path
 import logging
+import collections
 
 import pytest
 import pyvo
+import requests
 
 from pytest_postgresql import factories
 from psycopg2 import connect, DatabaseError
@@ -150,4 +153,71 @@ def test_local_tap_load_tables(dispatcher_live_fixture_with_tap, postgresql):
     assert table_obj[1][1].description == 'This is the view of the data_products of the gallery'
     for column in table_obj[0][1].columns:
         assert column.name in column_names
-        assert column.description is not None and column.description == f"{column.name} of the data product"
\ No newline at end of file
+        assert column.description is not None and column.description == f"{column.name} of the data product"
+
+@pytest.mark.test_tap
+def test_local_tap_tables_revalidation(dispatcher_live_fixture_with_tap, postgresql):
+    server = dispatcher_live_fixture_with_tap
+
+    c = requests.get(os.path.join(server, "tap/tables"))
+    assert c.status_code == 200
+    etag = c.headers['ETag']
+    last_modified = c.headers['Last-Modified']
+
+    c = requests.get(os.path.join(server, "tap/tables"), headers={'If-None-Match': etag})
+    assert c.status_code == 304
+
+    c = requests.get(os.path.join(server, "tap/tables"), headers={'If-Modified-Since': last_modified})
+    assert c.status_code == 304
+
+    # the same document is built again, and still valid
+    c = requests.get(os.path.join(server, "reload-tap-tables"))
+    assert c.status_code == 200
+
+    c = requests.get(os.path.join(server, "tap/tables"), headers={'If-None-Match': etag})
+    assert c.status_code == 304
+
+
+class FakeCursor:
+    """
+    returns the rows in chunks, as a server-side cursor
+    """
+    Column = collections.namedtuple('Column', ['name', 'type_code'])
+    # bigint, text and double precision
+    description = [Column('nid', 20), Column('title', 25), Column('file_uri', 25), Column('ra', 701)]
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def fetchmany(self, size):
+        chunk, self.rows = self.rows[:size], self.rows[size:]
+        return chunk
+
+
+@pytest.mark.parametrize("n_rows", [0, 1, 5])
+def test_iter_votable_from_cursor(n_rows):
+    from astropy.io.votable import parse
+    from cdci_data_analysis.analysis.ivoa_helper import iter_votable_from_cursor
+
+    product_gallery_url = 'http://gallery.test'
+    rows = [(i, f'product {i}', f'product_{i}.fits', 10. * i if i % 2 else None) for i in range(n_rows)]
+
+    single_chunk_votable_xml = ''.join(iter_votable_from_cursor(FakeCursor(rows), n_rows + 10,
+                                                                product_gallery_url=product_gallery_url))
+
+    # the rows of the chunks serialized separately are spliced in the TABLEDATA of the first one
+    for fetch_chunk_size in sorted({1, n_rows - 1, n_rows, n_rows + 1}):
+        if fetch_chunk_size < 1:
+            continue
+        votable_xml = ''.join(iter_votable_from_cursor(FakeCursor(rows), fetch_chunk_size,
+                                                       product_gallery_url=product_gallery_url))
+        assert votable_xml == single_chunk_votable_xml
+
+    table = parse(io.BytesIO(single_chunk_votable_xml.encode())).get_first_table()
+    assert [field.name for field in table.fields] == ['title', 'file_uri', 'ra']
+    assert len(table.array) == n_rows
+    for i in range(n_rows):
+        assert table.array['title'][i] == f'product {i}'
+        assert table.array['file_uri'][i] == f'{product_gallery_url}/sites/default/files/product_{i}.fits'
+        if i % 2:
+            assert table.array['ra'][i] == 10. * i